@@ -13,5 +13,8 @@ setup(
         'nose==1.1.2',
         'mockery',
         ],
+    extras_require={
+        'msgpack': ['msgpack-python'],
+        },
     platforms=["any"],
 )
@@ -1,16 +1,35 @@
-import inspect
+from contextlib import contextmanager
+import hashlib
+import logging
+import random
 import threading
+import time
 import traceback
+import weakref
 
+from django.conf import settings
 from django.conf.urls.defaults import *
 from django.http import HttpResponse, HttpRequest, HttpResponseNotAllowed
 from django.utils import simplejson as json
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
-from .utils import MagicEnum, Val, magic_enum_meta_cls
+from .utils import MagicEnum, Val, magic_enum_meta_cls, class_attributes
 from .auth import DefaultAuthentication
-from .fields import ApiField
+from .fields import ApiField, serializes_by_value
+from .coalescing import SingleFlight
 from .mixins import BaseMixin
+from .query_counter import QueryCounter
+from . import compression
+from . import deferred
+from . import formats
+from . import idempotency
+from . import profiling
+from . import slow_requests
+
+logger = logging.getLogger(__name__)
+
 
 class ResourceMeta(object):
     resource_name = None
@@ -18,6 +37,78 @@ class ResourceMeta(object):
     includes = []
     excludes = []
     filtering = None
+    # DjangoModelResource: database alias that GET requests read from. Writes and the
+    # reads that happen while handling a write always go to the primary.
+    read_replica_alias = None
+    # DjangoModelResource: for this many seconds after a client writes, its reads stay
+    # on the primary so that it sees its own changes.
+    read_your_writes_seconds = 5
+    # Per-request SQL instrumentation, any of 'log', 'headers' and 'raise'. Falls back to
+    # settings.SPROCKET_QUERY_INSTRUMENTATION when not set.
+    query_instrumentation = None
+    # Maximum number of queries a request may make, unless its EndPoint declares its own budget
+    query_budget = None
+    # A query shape repeated this many times in one request is reported as an N+1 pattern
+    repeated_query_threshold = 3
+    # Compress responses with gzip or deflate when the client's Accept-Encoding allows it
+    compress_responses = False
+    # Responses smaller than this many bytes are sent uncompressed
+    compression_min_size = 1024
+    # zlib compression level, from 1 (fastest) to 9 (smallest)
+    compression_level = 6
+    # DjangoModelResource: serve paged_list from values_list rows, without instantiating models,
+    # when the resource has no handlers that need the objects
+    values_list_fast_path = True
+    # DjangoModelResource: adds an aggregate/ endpoint computing count, sum, avg, min and max over
+    # the fields in filtering
+    allow_aggregation = False
+    # DjangoModelResource: fields the aggregate endpoint may group by. Only list indexed fields.
+    group_by_whitelist = ()
+    # DjangoModelResource: the aggregate endpoint refuses group-bys with more groups than this
+    max_aggregate_groups = 1000
+    # DjangoModelResource: fields clients may sort lists by with order_by=field or order_by=-field.
+    # Only list indexed fields, a warning is logged at startup for the others.
+    ordering_whitelist = ()
+    # DjangoModelResource: ORM ordering used when the client sends no order_by. Defaults to the
+    # model's Meta.ordering, or else the primary key.
+    default_ordering = None
+    # DjangoModelResource: an __in filter with more values than this runs as one query per chunk
+    # of values. Defaults to a size for the database backend, see chunked_query.get_chunk_size.
+    in_filter_chunk_size = None
+    # DjangoModelResource: adds a query/ endpoint taking paged_list's filters as a JSON POST body
+    allow_query_by_post = False
+    # DjangoModelResource: fetch paged_list's total count with the page in one query, with a
+    # COUNT(*) OVER () column, on databases that support window functions
+    count_in_page_query = False
+    # Executor for handlers marked @deferrable, defaults to deferred.get_default_executor()
+    deferred_executor = None
+    # Fraction of requests to run under cProfile, unless their EndPoint sets its own rate.
+    # Requests with an X-Sprocket-Profile header matching settings.SPROCKET_PROFILE_TOKEN
+    # are always profiled.
+    profile_sample_rate = 0.0
+    # Also record memory allocations of profiled requests, needs tracemalloc
+    profile_memory = False
+    # Where profiles are written, defaults to profiling.get_default_ring()
+    profile_ring = None
+    # Requests taking longer than this many seconds are logged with a breakdown of where the
+    # time went, unless their EndPoint sets its own threshold. Falls back to
+    # settings.SPROCKET_SLOW_REQUEST_THRESHOLD, None turns slow request logging off.
+    slow_request_threshold = None
+    # Where slow requests are logged, defaults to slow_requests.get_default_log()
+    slow_request_log = None
+    # Identical GET requests that arrive while one of them is running share its response,
+    # unless their EndPoint says otherwise. See get_coalescing_scope.
+    coalesce_requests = False
+    # Seconds a coalesced request waits for the shared response before running on its own
+    coalescing_timeout = 5.0
+    # Writes sent with an Idempotency-Key header run once per key. Retries get the stored
+    # response of the first, for idempotency_ttl seconds. See _call_idempotent.
+    idempotency_keys = False
+    idempotency_ttl = 24 * 60 * 60
+    # Seconds a retry waits for the first request with its key to finish, before failing with a 409
+    idempotency_wait = 10.0
+    # Where responses are stored, defaults to idempotency.get_default_store()
+    idempotency_store = None
 
     def __init__(self):
         if not self.filtering:
@@ -28,7 +119,28 @@ class ResourceMeta(object):
             self.filtering['pk'] = ['exact']
 
 
+class ApiResourceType(type):
+    '''
+    Finds the mixins that are assigned as class attributes of a resource, and the events it has
+    on_<event> handlers for, once when the class is created, so that constructing a resource
+    does not have to getattr() everything in dir(self).
+    '''
+    def __init__(cls, name, bases, attrs):
+        super(ApiResourceType, cls).__init__(name, bases, attrs)
+        mixin_names = []
+        handler_event_names = []
+        for attr_name, attr in class_attributes(cls).items():
+            if not attr_name.startswith('__') and isinstance(attr, BaseMixin):
+                mixin_names.append(attr_name)
+            elif attr_name.startswith('on_') and callable(attr):
+                handler_event_names.append(attr_name[3:])
+        cls._class_mixin_names = tuple(sorted(mixin_names))
+        cls._handler_event_names = tuple(sorted(handler_event_names))
+
+
 class BaseApiResource(object):
+    __metaclass__ = ApiResourceType
+
     _meta = ResourceMeta()  # Overwritten by the __new__ method, but kept here so pylint can do type inference
 
     class Meta(ResourceMeta):
@@ -41,32 +153,38 @@ class BaseApiResource(object):
         return obj
 
     def __init__(self, *args, **kwargs):
-        self._event_handlers = {}
+        # Nothing set up here changes after construction, so one resource can serve requests
+        # from many threads at once. Anything that varies per request lives in thread_current.
         self._merge_in_mixins()
+        self._event_handlers = self._build_event_handlers()
+        self._unbatched_obj_to_dict_handlers = self._build_unbatched_obj_to_dict_handlers()
+        # Lists go through a subclass's or mixin's own serialization methods
+        self._obj_to_dict_replaced = self._replaces_method(BaseApiResource, 'obj_to_dict')
+        self._obj_list_to_dicts_replaced = self._replaces_method(BaseApiResource, 'obj_list_to_dicts')
+        # Set while obj_list_to_dicts calls an overridden obj_to_dict, see obj_to_dict
+        self._listing = threading.local()
         self.fields = self._init_fields()
         self.field_names = [field.name for field in self.fields]
         self.field_by_name = dict([(field.name, field) for field in self.fields])
+        self.serialized_fields = self._compile_serialized_fields()
+        self._serializes_by_value = all([serializes_by_value(field) for field in self.serialized_fields])
         self.urls = self._build_urls()
+        self._single_flight = SingleFlight()
+        _resources.add(self)
 
     # Initialize endpoints and mixins
     def _merge_in_mixins(self):
         '''
         All the methods in mixins that do not being with 'on_' or '_' get mixed into the API
-        class - however we have to do some trickery so that when they are called 'self' is the
-        'self' of the mixin, not of the API Resource.
+        class. They are set on the resource as the mixin's own bound methods, so when they are
+        called 'self' is the 'self' of the mixin, not of the API Resource, and calling them costs
+        the same as calling a method of the resource.
         '''
         self.mixins = self.get_mixins()
         # New: rather than doing this magic where we merge in the mixin methods, we can just assign
-        # mixin as an attribute of the resource
-        for cls_attr_name in dir(self):
-            if cls_attr_name.startswith('__'):
-                continue
-            try:
-                mixin = getattr(self, cls_attr_name)
-            except:
-                continue
-            if not isinstance(mixin, BaseMixin):
-                continue
+        # mixin as an attribute of the resource. ApiResourceType finds these when the class is created.
+        for cls_attr_name in self._class_mixin_names:
+            mixin = getattr(self, cls_attr_name)
             mixin._should_merge_in_methods = False
             # Set the parent api on the mixin, in case the mixin was defined at the class level
             # and doesn't have access to the singleton
@@ -81,25 +199,9 @@ class BaseApiResource(object):
             self.mixins_by_name[mixin.__class__.__name__] = mixin
             if not merge_in_methods:
                 continue
-            for attr_name in dir(mixin):
-                if not isinstance(attr_name, basestring):
-                    continue
-                if attr_name.startswith('on_'):
-                    continue
-                if attr_name == 'get_endpoints':
-                    continue
-                if attr_name.startswith('_'):
-                    continue
-                attr = getattr(mixin, attr_name)
-                if inspect.ismethod(attr):
-                    wrapped_method = self._wrap_mixin_method(attr)
-                    setattr(self, attr_name, wrapped_method)
-            
-
-    def _wrap_mixin_method(self, attr, *args, **kwargs):
-        def func(*args, **kwargs):
-            return attr(*args, **kwargs)
-        return func
+            # MixinType works out which methods to merge in when the mixin class is created
+            for attr_name in mixin._mergeable_method_names:
+                setattr(self, attr_name, getattr(mixin, attr_name))
 
     def get_mixins(self):
         # Override in subclasses
@@ -127,6 +229,13 @@ class BaseApiResource(object):
         # Override me in a subclass, return a list of Endpoint objects
         raise NotImplementedError()
 
+    def warm_up(self):
+        '''
+        Called by sprocket.warmup.warm_up() before a pre-fork server starts its workers. Override
+        to load anything the resource would otherwise set up on its first requests.
+        '''
+        pass
+
     def get_override_endpoints(self):
         # Override in a subclass - these endpoints have precedence over any mixin endpoints
         return []
@@ -136,42 +245,316 @@ class BaseApiResource(object):
     def wrap(self, endpoint):
         @csrf_exempt
         def handler(request, **kwargs):
+            collecting_deferred = False
             try:
-                _thread_local.current = CurrentRequestThreadHolder(request)
+                current = _thread_local.current = CurrentRequestThreadHolder(request)
+                collecting_deferred = deferred.start_collecting()
                 request.endpoint = endpoint
-                return self._dispatch(endpoint, request, kwargs)
-            except UserError, ex:
-                return self.handle_user_error(request, endpoint, ex, ex.to_response())
-            except ApiError, ex:
-                return self.handle_server_error(request, endpoint, ex, ex.to_response())
-            except Exception, ex:
-                return self.handle_server_error(
-                    request,
-                    endpoint,
-                    ex,
-                    HttpResponse(
-                        json.dumps({'message': 'There was an internal error'}),
-                        status=500
-                    ))
+                threshold = self._get_slow_request_threshold(endpoint)
+                if threshold != None:
+                    current.stage_timer = slow_requests.StageTimer()
+                response = self._handle_request(endpoint, request, kwargs)
+                if threshold != None and current.stage_timer.elapsed >= threshold:
+                    self._log_slow_request(endpoint, request, response, current.stage_timer)
+                return response
             finally:
+                current = _thread_local.current
+                if current != None and current.identity_map != None:
+                    current.identity_map.clear()
                 _thread_local.current = None
+                if collecting_deferred:
+                    deferred.flush()
         return handler
 
+    def _handle_request(self, endpoint, request, kwargs):
+        try:
+            if self._should_profile(endpoint, request):
+                return self._dispatch_profiling(endpoint, request, kwargs)
+            return self._dispatch_instrumented(endpoint, request, kwargs)
+        except UserError, ex:
+            return self.handle_user_error(request, endpoint, ex, ex.to_response())
+        except ApiError, ex:
+            return self.handle_server_error(request, endpoint, ex, ex.to_response())
+        except Exception, ex:
+            return self.handle_server_error(
+                request,
+                endpoint,
+                ex,
+                HttpResponse(
+                    json.dumps({'message': 'There was an internal error'}),
+                    status=500
+                ))
+
     def _dispatch(self, endpoint, request, kwargs):
+        # Set when slow requests are logged, see _log_slow_request
+        timer = self.thread_current.stage_timer
         self._authenticate(request)
+        if timer:
+            timer.mark('auth')
         if not request.method in endpoint.http_method_dict:
             return HttpResponseNotAllowed(endpoint.http_method_dict.keys())
         method_endpoint = request.method_endpoint = endpoint.http_method_dict[request.method]
+        self.thread_current.response_format = self._negotiate_response_format(request)
         if isinstance(method_endpoint.api_method_name, basestring):
             method = getattr(self, method_endpoint.api_method_name)
         else:
             method = method_endpoint.api_method_name
         self._adjust_kwargs(method_endpoint, request, kwargs)
         self.execute_handlers(BaseEvents.pre_dispatch_request, request, kwargs)
+        if timer:
+            timer.mark('arg_filters')
+            timer.kwargs = dict(kwargs)
+        if request.method == 'GET' and self._should_coalesce(endpoint):
+            response = self._call_coalesced(endpoint, request, method, kwargs)
+        elif request.method != 'GET' and self._meta.idempotency_keys and request.META.get('HTTP_IDEMPOTENCY_KEY'):
+            response = self._call_idempotent(request, method, kwargs)
+        else:
+            response = self._call_api_method(method, kwargs)
+        self.execute_handlers(BaseEvents.process_response, response)
+        self._compress_response(request, response)
+        if timer:
+            timer.mark('response_handlers')
+        return response
+
+    def _call_api_method(self, method, kwargs):
+        ''' Calls the api method and turns its result into a response '''
+        timer = self.thread_current.stage_timer
         result = method(**kwargs)
+        if timer:
+            timer.mark('api_method')
         response = self._result_to_response(result)
+        if timer:
+            timer.mark('serialization')
         self.add_preset_response_info(response)
-        self.execute_handlers(BaseEvents.process_response, response)
+        return response
+
+    def _should_coalesce(self, endpoint):
+        if endpoint.coalesce != None:
+            return endpoint.coalesce
+        return self._meta.coalesce_requests
+
+    def _call_coalesced(self, endpoint, request, method, kwargs):
+        '''
+        Shares one call of the api method between identical requests made at the same time.
+        Each request has already been authenticated on its own. The others get a copy of the
+        first one's response, before process_response handlers and compression, which still run
+        for every request.
+        '''
+        key = (endpoint.url_pattern, self.current_response_format, self.get_coalescing_scope(request),
+               repr(sorted(kwargs.items())))
+        def call():
+            response = self._call_api_method(method, kwargs)
+            return response, _freeze_response(response)
+        (response, frozen), ran = self._single_flight.do(key, call, self._meta.coalescing_timeout)
+        if ran:
+            return response
+        if frozen == None:
+            # The response could not be shared, so this request makes its own
+            return self._call_api_method(method, kwargs)
+        return _thaw_response(frozen)
+
+    def get_coalescing_scope(self, request):
+        '''
+        What besides the url and arguments a response depends on. Only requests with the same
+        scope share a response. Defaults to the username and the request's credentials, its
+        Authorization and Cookie headers, so clients that authenticate differently never share
+        responses. Override this when responses also depend on something else, such as a header.
+        '''
+        user = getattr(request, 'user', None)
+        return (getattr(user, 'username', None), request.META.get('HTTP_AUTHORIZATION'),
+                request.META.get('HTTP_COOKIE'))
+
+    def get_idempotency_scope(self, request):
+        '''
+        Who an Idempotency-Key belongs to: the username, or for anonymous clients the
+        Authorization header. Unlike get_coalescing_scope, cookies are left out, since a retry
+        often carries different ones, such as a rotated session or load balancer cookie.
+        '''
+        username = getattr(getattr(request, 'user', None), 'username', None)
+        if username:
+            return ('user', username)
+        return ('authorization', request.META.get('HTTP_AUTHORIZATION'))
+
+    def _call_idempotent(self, request, method, kwargs):
+        '''
+        Runs a write once per Idempotency-Key and client. Its response is stored, and retries get
+        a copy with an Idempotent-Replayed header, without any cookies the first one set. The
+        response is only stored once the request is done, after its transaction commits under
+        DeferredHandlersMiddleware; if the request's deferred calls are discarded instead, the
+        key is freed for a retry. A retry that arrives while the first request is still running
+        waits for it, through the single flight in this process, or by polling the store in
+        others. Server errors are forgotten so that a retry runs again. Streamed responses
+        cannot be stored, so for those the store only records that the write ran, and retries
+        fail with a 409.
+        '''
+        idempotency_key = request.META['HTTP_IDEMPOTENCY_KEY']
+        if len(idempotency_key) > 255:
+            raise UserError("The Idempotency-Key header can be at most 255 characters long", 400)
+        store_key = 'sprocket-idempotency:%s:%s' % (self._meta.resource_name, hashlib.md5(
+            repr((self.get_idempotency_scope(request), idempotency_key))).hexdigest())
+        # Reusing a key for a different request is a client error, not a retry
+        fingerprint = hashlib.md5(repr((request.method, request.path, _request_body_key(request)))).hexdigest()
+        call = lambda: self._run_once(store_key, fingerprint, method, kwargs)
+        response, ran = self._single_flight.do(('idempotency', store_key), call, self._meta.idempotency_wait)
+        if ran:
+            return response
+        # The first request's response is not stored until it commits, so it is read from the store
+        return call()
+
+    def _run_once(self, store_key, fingerprint, method, kwargs):
+        store = self._meta.idempotency_store or idempotency.get_default_store()
+        deadline = time.time() + self._meta.idempotency_wait
+        while True:
+            entry = store.get(store_key)
+            if entry == None:
+                if store.add(store_key, (idempotency.PENDING, fingerprint, None), idempotency.PENDING_TIMEOUT):
+                    return self._run_first(store, store_key, fingerprint, method, kwargs)
+                # Another request took the key between get and add, or the store keeps nothing
+            else:
+                status, stored_fingerprint, frozen = entry
+                if stored_fingerprint != fingerprint:
+                    raise UserError("This Idempotency-Key was already used for a different request", 422)
+                if status == idempotency.COMPLETED:
+                    if frozen == None:
+                        raise UserError("A request with this Idempotency-Key was already processed, "
+                                        "and its response cannot be repeated", 409)
+                    return _replay_response(frozen)
+            if time.time() >= deadline:
+                if entry == None:
+                    raise ApiError("The idempotency store is not available", 503)
+                raise UserError("A request with this Idempotency-Key is still being processed", 409)
+            time.sleep(0.05)
+
+    def _run_first(self, store, store_key, fingerprint, method, kwargs):
+        try:
+            response = self._call_api_method(method, kwargs)
+        except:
+            store.delete(store_key)
+            raise
+        if response.status_code >= 500:
+            store.delete(store_key)
+            return response
+        entry = (idempotency.COMPLETED, fingerprint, _freeze_response(response, drop_cookies=True))
+        deferred.on_commit(
+            lambda: store.set(store_key, entry, self._meta.idempotency_ttl),
+            lambda: store.delete(store_key))
+        return response
+
+    def _get_slow_request_threshold(self, endpoint):
+        threshold = endpoint.slow_request_threshold
+        if threshold == None:
+            threshold = self._meta.slow_request_threshold
+        if threshold == None:
+            threshold = getattr(settings, 'SPROCKET_SLOW_REQUEST_THRESHOLD', None)
+        return threshold
+
+    def _log_slow_request(self, endpoint, request, response, timer):
+        '''
+        Queues a record of a request that took longer than its slow request threshold. Stages
+        that were not reached, because the request failed, are left out of the breakdown.
+        '''
+        method_endpoint = getattr(request, 'method_endpoint', None)
+        api_method_name = getattr(method_endpoint, 'api_method_name', None)
+        if not isinstance(api_method_name, basestring):
+            api_method_name = getattr(api_method_name, '__name__', None)
+        record = {
+            'resource': self._meta.resource_name,
+            'url_pattern': endpoint.url_pattern,
+            'http_method': request.method,
+            'api_method': api_method_name,
+            'path': request.path,
+            'status_code': response.status_code,
+            'kwargs': slow_requests.sanitize_kwargs(timer.kwargs or {}),
+            'total_ms': round(timer.elapsed * 1000, 1),
+            'stages_ms': dict([(stage, round(seconds * 1000, 1)) for stage, seconds in timer.stages]),
+        }
+        (self._meta.slow_request_log or slow_requests.get_default_log()).log(record)
+
+    def _dispatch_instrumented(self, endpoint, request, kwargs):
+        instrumentation = self._get_query_instrumentation()
+        if instrumentation:
+            return self._dispatch_counting_queries(endpoint, request, kwargs, instrumentation)
+        return self._dispatch(endpoint, request, kwargs)
+
+    def _should_profile(self, endpoint, request):
+        token = getattr(settings, 'SPROCKET_PROFILE_TOKEN', None)
+        header = request.META.get('HTTP_X_SPROCKET_PROFILE')
+        if token and header and constant_time_compare(header, token):
+            return True
+        rate = endpoint.profile_sample_rate
+        if rate == None:
+            rate = self._meta.profile_sample_rate
+        return rate > 0 and random.random() < rate
+
+    def _dispatch_profiling(self, endpoint, request, kwargs):
+        '''
+        Dispatches the request under cProfile, and tracemalloc with Meta.profile_memory, and saves
+        the profile to the profile ring, also when the request fails. The response names the
+        profile in an X-Sprocket-Profile header.
+        '''
+        capture = profiling.Capture(trace_memory=self._meta.profile_memory)
+        try:
+            with capture:
+                response = self._dispatch_instrumented(endpoint, request, kwargs)
+        finally:
+            method_endpoint = getattr(request, 'method_endpoint', None)
+            api_method_name = getattr(method_endpoint, 'api_method_name', None)
+            if not isinstance(api_method_name, basestring):
+                api_method_name = getattr(api_method_name, '__name__', 'unknown')
+            tag = '%s-%s-%s' % (self._meta.resource_name, endpoint.name or api_method_name, request.method)
+            ring = self._meta.profile_ring or profiling.get_default_ring()
+            try:
+                name = ring.save(tag, capture.profiler, capture.memory_stats)
+            except (IOError, OSError):
+                logger.exception("Could not save the profile of %s %s", request.method, request.path)
+                name = None
+        if name != None:
+            response['X-Sprocket-Profile'] = name
+        return response
+
+    def _get_query_instrumentation(self):
+        modes = self._meta.query_instrumentation
+        if modes == None:
+            modes = getattr(settings, 'SPROCKET_QUERY_INSTRUMENTATION', None)
+        if isinstance(modes, basestring):
+            modes = (modes,)
+        return modes
+
+    def _dispatch_counting_queries(self, endpoint, request, kwargs, modes):
+        '''
+        Dispatches the request while counting its SQL queries, then reports on them according to
+        the instrumentation modes:
+
+        'log' - logs a warning when the query budget is exceeded or a query shape repeats
+        'headers' - adds the query count, database time and repeated shape count to the response
+        'raise' - fails the request with a QueryBudgetExceeded error when the budget is exceeded,
+            meant for test suites
+        '''
+        counter = QueryCounter()
+        with counter:
+            response = self._dispatch(endpoint, request, kwargs)
+        budget = endpoint.query_budget
+        if budget == None:
+            budget = self._meta.query_budget
+        over_budget = budget != None and counter.count > budget
+        repeated = counter.repeated_shapes(self._meta.repeated_query_threshold)
+        if 'log' in modes:
+            if over_budget:
+                logger.warning(
+                    "%s %s made %s queries, over its budget of %s",
+                    request.method, request.path, counter.count, budget)
+            for shape, count in repeated:
+                logger.warning(
+                    "%s %s repeated a query %s times, possible N+1: %s",
+                    request.method, request.path, count, shape)
+        if 'raise' in modes and over_budget:
+            raise QueryBudgetExceeded(counter.count, budget, repeated)
+        if 'headers' in modes:
+            response['X-Sprocket-Query-Count'] = str(counter.count)
+            response['X-Sprocket-Query-Time-Ms'] = '%.1f' % (counter.total_time * 1000)
+            response['X-Sprocket-Repeated-Queries'] = str(len(repeated))
+            if budget != None:
+                response['X-Sprocket-Query-Budget'] = str(budget)
         return response
 
     def _authenticate(self, request):
@@ -188,6 +571,22 @@ class BaseApiResource(object):
         for filter in method_endpoint.arg_filters:
             filter(self, request, kwargs)
 
+        # The format parameter picks the response format, it is not an argument to the api method
+        if formats.format_from_param(kwargs.get('format')) and 'format' not in self.field_by_name:
+            del kwargs['format']
+
+    def _negotiate_response_format(self, request):
+        '''
+        The response format comes from the format query parameter, or else the Accept header,
+        and defaults to JSON.
+        '''
+        format = formats.format_from_param(request.GET.get('format')) or \
+            formats.format_from_content_type(request.META.get('HTTP_ACCEPT')) or \
+            formats.JSON
+        if format == formats.MSGPACK and formats.msgpack == None:
+            raise UserError("The msgpack format is not available", 406)
+        return format
+
     def _result_to_response(self, result):
         response = self.current_request.method_endpoint.to_response_func(result)
         if response:
@@ -198,22 +597,32 @@ class BaseApiResource(object):
         if self.current_response_status_code != None:
             status_code = self.current_response_status_code
         if isinstance(result, basestring):
-            return HttpResponse(result, status=status_code)
+            # Strings are sent as they are, so they are labelled JSON whatever format was asked for
+            response = HttpResponse(result, status=status_code)
+            response.sprocket_format = formats.JSON
+            return response
         elif isinstance(result, dict):
-            return HttpResponse(json.dumps(result), status=status_code)
+            return HttpResponse(self.serialize(result), status=status_code)
         elif isinstance(result, list) and len(result) > 0 and isinstance(result[0], self._meta.model_class):
             return HttpResponse(self.obj_list_to_str(result), status=status_code)
         elif isinstance(result, list):
-            return HttpResponse(json.dumps(result), status=status_code)
+            return HttpResponse(self.serialize(result), status=status_code)
         elif isinstance(result, self._meta.model_class):
             return HttpResponse(self.obj_to_str(result), status=status_code)
         elif result == None and self.current_request.method == 'GET':
-            return HttpResponse('{"message": "Object not found"}', status=404)
+            return self._message_response({'message': 'Object not found'}, 404)
         elif result == True:
-            return HttpResponse('{"succeeded": true, "message": "Action succeeded"}', status=status_code)
+            return self._message_response({'succeeded': True, 'message': 'Action succeeded'}, status_code)
         else:
             raise Exception("Response was of an unexpected type")
 
+    def _message_response(self, data, status_code):
+        response = HttpResponse(self.serialize(data), status=status_code)
+        if self.current_response_format == formats.COLUMNAR:
+            # Not a list, so it is sent, and labelled, as plain JSON
+            response.sprocket_format = formats.JSON
+        return response
+
     def add_preset_response_info(self, response):
         '''
         Adds any headers or cookies that were set during the processing of the api call
@@ -223,14 +632,49 @@ class BaseApiResource(object):
         for args, kwargs in _thread_local.current.cookie_setters:
             response.set_cookie(*args, **kwargs)
         if 'content-type' not in _thread_local.current.response_headers:
-            response['Content-type'] = 'application/json'
+            format = getattr(response, 'sprocket_format', _thread_local.current.response_format)
+            response['Content-type'] = formats.CONTENT_TYPES[format]
+
+    def _compress_response(self, request, response):
+        '''
+        Compresses the response body according to the request's Accept-Encoding header.
+        Streamed responses, whose content is an iterator, are compressed incrementally.
+        '''
+        if not self._meta.compress_responses:
+            return
+        if response.has_header('Content-Encoding') or response.status_code in (204, 304):
+            return
+        if response.get('Content-Type', '').split(';')[0] in compression.COMPRESSED_CONTENT_TYPES:
+            return
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = compression.negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if not encoding:
+            return
+        level = self._meta.compression_level
+        if getattr(response, '_is_string', True):
+            content = response.content
+            if len(content) < self._meta.compression_min_size:
+                return
+            compressed = compression.compress(content, encoding, level)
+            if len(compressed) >= len(content):
+                return
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+        else:
+            response._container = compression.compress_iter(response._container, encoding, level, response._charset)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        response['Content-Encoding'] = encoding
 
     def handle_user_error(self, request, endpoint, exc, response):
         ''' Override this to add any custom error reporting logic '''
         return response
 
     def handle_server_error(self, request, endpoint, exc, response):
-        ''' Override this to add any custom error reporting logic '''
+        '''
+        Override this to add any custom error reporting logic. Also called, with a response of
+        None, when a deferred handler fails in the background.
+        '''
         traceback.print_exc()
         return response
 
@@ -243,10 +687,42 @@ class BaseApiResource(object):
             items = handler(items, *args)
         return items
 
+    def execute_deferrable_handlers(self, event_name, *args):
+        '''
+        Like execute_handlers, except that handlers marked @deferrable are run on the deferred
+        executor once the request is done.
+        '''
+        for handler in self._get_handlers(event_name):
+            if getattr(handler, 'deferrable', False):
+                deferred.defer(
+                    self._get_deferred_executor(), self._run_deferred_handler,
+                    self.current_request or None, handler, args)
+            else:
+                handler(*args)
+
+    def _get_deferred_executor(self):
+        return self._meta.deferred_executor or deferred.get_default_executor()
+
+    def _run_deferred_handler(self, request, handler, args):
+        # Make the original request current again, so handlers can still use current_user
+        with request_context(request):
+            try:
+                handler(*args)
+            except Exception, ex:
+                self.handle_server_error(request, getattr(request, 'endpoint', None), ex, None)
+
     def _get_handlers(self, event_name):
-        if event_name not in self._event_handlers:
-            self._event_handlers[event_name] = self._build_handlers_list(event_name)
-        return self._event_handlers[event_name]
+        return self._event_handlers.get(event_name, ())
+
+    def _build_event_handlers(self):
+        '''
+        Looks up the handlers of every event that the resource or one of its mixins handles,
+        so that dispatching requests only ever reads _event_handlers.
+        '''
+        event_names = set(self._handler_event_names)
+        for mixin in self.mixins:
+            event_names.update(mixin.event_handler_by_event_name.keys())
+        return dict([(name, tuple(self._build_handlers_list(name))) for name in event_names])
 
     def _build_handlers_list(self, event_name):
         handlers = []
@@ -259,30 +735,59 @@ class BaseApiResource(object):
             handlers.append(handler)
         return handlers
 
+    def _build_unbatched_obj_to_dict_handlers(self):
+        '''
+        The obj_to_dict handlers that obj_list_to_dicts runs for each object. Handlers marked
+        @batch_capable are left out when the mixin they belong to also handles obj_list_to_dicts.
+        '''
+        batching = set([id(getattr(handler, 'im_self', None)) for handler in self._get_handlers(BaseEvents.obj_list_to_dicts)])
+        return tuple([
+            handler for handler in self._get_handlers(BaseEvents.obj_to_dict)
+            if not (getattr(handler, 'batch_capable', False) and id(getattr(handler, 'im_self', None)) in batching)])
+
+    def _replaces_method(self, cls, method_name):
+        '''
+        Whether this resource's method_name is something other than cls's: a subclass overrides
+        it, or a mixin merged in a method of that name.
+        '''
+        if method_name in self.__dict__:
+            return True
+        return getattr(type(self), method_name).im_func is not getattr(cls, method_name).im_func
+
     # Fields and Serialization
     def _init_fields(self):
         fields = []
         self.execute_handlers(BaseEvents.init_fields, fields)
         return fields
 
+    def _compile_serialized_fields(self):
+        '''
+        The fields that obj_to_dict outputs, in order, with the includes and excludes applied
+        '''
+        includes = self._meta.includes
+        excludes = self._meta.excludes
+        return [
+            field for field in self.fields
+            if field.name not in excludes and (not includes or field.name in includes)]
+
     def obj_to_str(self, obj):
         data = self.obj_to_dict(obj)
         return self.serialize(data)
 
     def serialize(self, data):
-        return json.dumps(data)
+        return formats.encode(data, self.current_response_format)
 
     def obj_to_dict(self, obj):
-        includes = self._meta.includes
-        excludes = self._meta.excludes
         data = {}
-        for field in self.fields:
-            if field.name in excludes:
-                continue
-            if includes and field.name not in includes:
-                continue
+        for field in self.serialized_fields:
             field.obj_to_dict(obj, data)
-        self.execute_handlers(BaseEvents.obj_to_dict, obj, data)
+        if getattr(self._listing, 'active', False):
+            # Part of a list, whose obj_list_to_dicts handlers run the @batch_capable ones' work
+            handlers = self._unbatched_obj_to_dict_handlers
+        else:
+            handlers = self._get_handlers(BaseEvents.obj_to_dict)
+        for handler in handlers:
+            handler(obj, data)
         return data
 
     def str_to_obj(self, post_data_byte_str):
@@ -290,8 +795,15 @@ class BaseApiResource(object):
         return self.dict_to_obj(data)
 
     def deserialize(self, data_str):
+        '''
+        Decodes data in the format named by the request's Content-Type, JSON by default.
+        Columnar lists are turned back into a list of dicts.
+        '''
+        format = formats.format_from_content_type(self.current_request.META.get('CONTENT_TYPE')) or formats.JSON
         try:
-            return json.loads(data_str)
+            return formats.decode(data_str, format)
+        except formats.UnavailableFormat, e:
+            raise UserError(str(e), status_code=415)
         except ValueError, e:
             raise UserError(e.message, status_code=400)
 
@@ -310,10 +822,64 @@ class BaseApiResource(object):
         return obj
 
     def obj_list_to_str(self, objects):
-        return json.dumps(self.obj_list_to_dicts(objects))
+        return self.serialize(self.obj_list_to_data(objects))
+
+    def obj_list_to_data(self, objects):
+        '''
+        Serializes a list of objects for the current response format: a list of dicts for JSON,
+        or a ColumnarList for the columnar formats.
+        '''
+        if self.current_response_format in formats.COLUMNAR_FORMATS:
+            return self.obj_list_to_columns(objects)
+        return self.obj_list_to_dicts(objects)
 
     def obj_list_to_dicts(self, objects):
-        return [self.obj_to_dict(obj) for obj in objects]
+        '''
+        Serializes each object like obj_to_dict, then runs the obj_list_to_dicts handlers once
+        with all the objects and their dicts, so they can load what they add for the whole list
+        in one query. A resource that overrides obj_to_dict has it called for every object. While
+        it is, BaseApiResource.obj_to_dict leaves out the @batch_capable handlers that the
+        obj_list_to_dicts handlers stand in for, so an override must call it for its data.
+        '''
+        batch_handlers = self._get_handlers(BaseEvents.obj_list_to_dicts)
+        if not batch_handlers:
+            return [self.obj_to_dict(obj) for obj in objects]
+        objects = list(objects)
+        if self._obj_to_dict_replaced:
+            listing = getattr(self._listing, 'active', False)
+            self._listing.active = True
+            try:
+                dicts = [self.obj_to_dict(obj) for obj in objects]
+            finally:
+                self._listing.active = listing
+        else:
+            fields = self.serialized_fields
+            handlers = self._unbatched_obj_to_dict_handlers
+            dicts = []
+            for obj in objects:
+                data = {}
+                for field in fields:
+                    field.obj_to_dict(obj, data)
+                for handler in handlers:
+                    handler(obj, data)
+                dicts.append(data)
+        for handler in batch_handlers:
+            handler(objects, dicts)
+        return dicts
+
+    def obj_list_to_columns(self, objects):
+        '''
+        Returns a ColumnarList of the objects. Rows are read straight off the objects through the
+        serialized fields, unless handlers, custom fields or overridden serialization methods need
+        a dict per object.
+        '''
+        if self._serializes_by_value and not self._get_handlers(BaseEvents.obj_to_dict) \
+                and not self._get_handlers(BaseEvents.obj_list_to_dicts) \
+                and not self._obj_to_dict_replaced and not self._obj_list_to_dicts_replaced:
+            fields = self.serialized_fields
+            rows = [[field.obj_to_value(obj) for field in fields] for obj in objects]
+            return formats.ColumnarList([field.name for field in fields], rows)
+        return formats.ColumnarList.from_dicts(self.obj_list_to_dicts(objects))
 
     # Helpers - we store the request object in thread local so we don't pass it around everywhere
 
@@ -336,6 +902,10 @@ class BaseApiResource(object):
         else:
             return user.username
 
+    @property
+    def current_response_format(self):
+        return self.thread_current.response_format
+
     @property
     def current_response_status_code(self):
         return self.thread_current.status_code
@@ -351,8 +921,10 @@ class BaseApiResource(object):
 
     @property
     def thread_current(self):
-        c = getattr(_thread_local, 'current', None)
+        c = _thread_local.current
         if c == None:
+            # Outside of a request, such as in a direct python call, nothing set on it is kept.
+            # Use request_context to make a request current for a block of code.
             c = CurrentRequestThreadHolder(None)
         return c
 
@@ -461,15 +1033,39 @@ class ArgFilters(object):
 
     @staticmethod
     def with_data(api, request, kwargs):
+        post_data = ArgFilters.get_post_data(request)
         try:
-            data = json.loads(request.raw_post_data)
+            data = json.loads(post_data)
         except Exception:
-            raise UserError("Invalid syntax for the json data %s " % request.raw_post_data, status_code=400)
+            raise UserError("Invalid syntax for the json data %s " % post_data, status_code=400)
         kwargs['data'] = data
 
     @staticmethod
-    def get_json_data(request, allow_empty=False):
+    def get_post_data(request):
+        '''
+        Returns the request body, decompressed if the client sent it with a gzip or deflate
+        Content-Encoding.
+        '''
+        if hasattr(request, '_sprocket_post_data'):
+            return request._sprocket_post_data
         post_data = request.raw_post_data
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if post_data and encoding and encoding != 'identity':
+            max_size = getattr(settings, 'SPROCKET_MAX_DECOMPRESSED_BODY_SIZE', 64 * 1024 * 1024)
+            try:
+                post_data = compression.decompress(post_data, encoding, max_size)
+            except compression.BodyTooLarge, e:
+                raise UserError(str(e), status_code=413)
+            except compression.UnsupportedEncoding, e:
+                raise UserError(str(e), status_code=415)
+            except compression.DecompressionError, e:
+                raise UserError(str(e), status_code=400)
+        request._sprocket_post_data = post_data
+        return post_data
+
+    @staticmethod
+    def get_json_data(request, allow_empty=False):
+        post_data = ArgFilters.get_post_data(request)
         if allow_empty and \
            (post_data is None or len(post_data) == 0 or post_data == ''):
             return None
@@ -533,6 +1129,45 @@ class ArgFilters(object):
         return filter_func
 
 
+def _freeze_response(response, drop_cookies=False):
+    '''
+    Copies what other requests need to rebuild a response, or returns None for responses that
+    cannot be shared: streamed ones, and ones that set cookies. With drop_cookies, responses
+    that set cookies are copied without them.
+    '''
+    if not getattr(response, '_is_string', True) or (response.cookies and not drop_cookies):
+        return None
+    return response.status_code, response.items(), response.content
+
+
+def _request_body_key(request):
+    '''
+    What identifies a request's body. The body of a multipart request is gone once its form
+    has been read, so those are identified by their fields and the names and sizes of their files.
+    '''
+    if not request.META.get('CONTENT_TYPE', '').startswith('multipart'):
+        try:
+            return request.raw_post_data
+        except Exception:
+            pass
+    return (sorted(request.POST.lists()),
+            sorted((name, f.name, f.size) for name, files in request.FILES.lists() for f in files))
+
+
+def _thaw_response(frozen):
+    status_code, headers, content = frozen
+    response = HttpResponse(content, status=status_code)
+    for name, value in headers:
+        response[name] = value
+    return response
+
+
+def _replay_response(frozen):
+    response = _thaw_response(frozen)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
 class EndPoint(object):
     def __init__(
         self,
@@ -544,6 +1179,14 @@ class EndPoint(object):
         for epm in end_point_methods:
             self.http_method_dict[epm.__class__.__name__.upper()] = epm
         self.name = kwargs.get('name', '')
+        # Maximum number of SQL queries a request to this endpoint may make, see ResourceMeta.query_instrumentation
+        self.query_budget = kwargs.get('query_budget', None)
+        # Fraction of requests to this endpoint to profile, see ResourceMeta.profile_sample_rate
+        self.profile_sample_rate = kwargs.get('profile_sample_rate', None)
+        # Seconds after which requests to this endpoint are logged as slow, see ResourceMeta
+        self.slow_request_threshold = kwargs.get('slow_request_threshold', None)
+        # Whether identical GET requests share a response, see ResourceMeta.coalesce_requests
+        self.coalesce = kwargs.get('coalesce', None)
 
 
 class EndPointMethod(object):
@@ -591,6 +1234,7 @@ class BaseEvents(object):
     process_response = Val()
     dict_to_obj = Val()
     obj_to_dict = Val()
+    obj_list_to_dicts = Val()
     init_fields = Val()
 
 
@@ -630,12 +1274,54 @@ class UnauthenticatedError(UserError):
         super(UnauthenticatedError, self).__init__(message, status_code)
 
 
+class QueryBudgetExceeded(ApiError):
+    def __init__(self, query_count, budget, repeated_shapes=()):
+        super(QueryBudgetExceeded, self).__init__(
+            "The request made %s queries, over its budget of %s" % (query_count, budget),
+            500,
+            extra_data={
+                'query_count': query_count,
+                'query_budget': budget,
+                'repeated_queries': [{'sql': shape, 'count': count} for shape, count in repeated_shapes],
+            })
+
+
 class CurrentRequestThreadHolder(object):
     def __init__(self, request):
         self.request = request
         self.response_headers = {}
         self.cookie_setters = []
         self.status_code = None
+        self.response_format = formats.JSON
+        # Objects loaded by primary key during this request, keyed by (resource, pk). Only
+        # kept while handling a request, so that nothing outlives it.
+        self.identity_map = {} if request != None else None
+        # A slow_requests.StageTimer, when slow requests are being logged
+        self.stage_timer = None
 
-_thread_local = threading.local()
-_thread_local.current = CurrentRequestThreadHolder(None)
+
+# Every resource constructed in this process, for sprocket.warmup
+_resources = weakref.WeakSet()
+
+
+class _RequestLocal(threading.local):
+    # __init__ runs again in every thread that touches the object, so each thread starts out
+    # with current set, not only the thread that imported this module
+    def __init__(self):
+        self.current = None
+
+_thread_local = _RequestLocal()
+
+
+@contextmanager
+def request_context(request):
+    '''
+    Makes request the current request of this thread until the block ends, for work done on
+    behalf of a request outside of dispatching it. Yields its CurrentRequestThreadHolder.
+    '''
+    previous = _thread_local.current
+    current = _thread_local.current = CurrentRequestThreadHolder(request)
+    try:
+        yield current
+    finally:
+        _thread_local.current = previous
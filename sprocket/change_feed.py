@@ -0,0 +1,257 @@
+'''
+A feed of the objects a resource created, updated and deleted, so clients can keep a copy of a
+resource in sync by asking for what changed instead of listing everything again:
+
+    def get_mixins(self):
+        return [ChangeFeedMixin(self)]
+
+    GET <resource>/changes/                       {"changes": [], "next": "<token>", "reset": false}
+    GET <resource>/changes/?since=<token>&wait=20
+
+returns the ids and operations ("create", "update" or "delete") of the changes after the token,
+and the token to ask with next. With wait, a request that finds no changes waits up to that many
+seconds for one. "reset": true means the changes since the token are no longer known, because
+they were dropped from the log or the log was restarted, and the client has to list the
+resource again and continue from the new token.
+
+The feed only has ids. Clients load the objects through the resource's other endpoints, which
+apply the usual permission checks.
+'''
+from collections import deque
+import itertools
+import threading
+import time
+import uuid
+
+from .base_resource import EndPoint, GET, ArgFilters, UserError
+from .deferred import deferrable
+from .mixins import BaseMixin
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class ChangeLog(object):
+    '''
+    Keeps the last max_entries changes in memory. It only sees the changes made by its own
+    process, so under several processes each needs clients that stick to it, or a shared
+    CacheChangeLog. The epoch is new every time the process starts, which makes the tokens of
+    an earlier log reset.
+    '''
+    def __init__(self, max_entries=10000):
+        self.epoch = uuid.uuid4().hex[:12]
+        self._entries = deque(maxlen=max_entries)
+        self._last_seq = 0
+        self._changed = threading.Condition()
+
+    def last_seq(self):
+        return self._last_seq
+
+    def append(self, pk, operation):
+        with self._changed:
+            self._last_seq += 1
+            self._entries.append((self._last_seq, pk, operation))
+            self._changed.notify_all()
+
+    def read(self, since, limit):
+        '''
+        Returns up to limit (seq, pk, operation) entries after since, or None if some of them
+        were dropped.
+        '''
+        with self._changed:
+            if since > self._last_seq:
+                return None
+            oldest = self._entries and self._entries[0][0] or self._last_seq + 1
+            if since + 1 < oldest:
+                return None
+            start = since + 1 - oldest
+            return list(itertools.islice(self._entries, start, start + limit))
+
+    def wait(self, since, timeout):
+        ''' Waits up to timeout seconds for a change after since '''
+        deadline = time.time() + timeout
+        with self._changed:
+            while self._last_seq <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self._changed.wait(remaining)
+
+
+class CacheChangeLog(object):
+    '''
+    Keeps changes in a Django cache that every process shares, such as memcached, for timeout
+    seconds. The sequence is the cache's incr(), which memcached does atomically. Waiting polls
+    the cache every poll_interval seconds. A change that was counted but is missing is taken to
+    be on its way from another process, until it has been missing for gap_grace seconds.
+    '''
+    def __init__(self, cache, key_prefix, timeout=24 * 60 * 60, poll_interval=0.5, gap_grace=10):
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.gap_grace = gap_grace
+
+    @property
+    def epoch(self):
+        epoch_key = self.key_prefix + ':epoch'
+        epoch = self.cache.get(epoch_key)
+        if epoch == None:
+            self.cache.add(epoch_key, uuid.uuid4().hex[:12], self.timeout)
+            epoch = self.cache.get(epoch_key)
+        return epoch
+
+    def last_seq(self):
+        return self.cache.get(self._seq_key(self.epoch)) or 0
+
+    def append(self, pk, operation):
+        epoch = self.epoch
+        seq_key = self._seq_key(epoch)
+        try:
+            seq = self.cache.incr(seq_key)
+        except ValueError:
+            # The first change of this epoch
+            self.cache.add(seq_key, 0, self.timeout)
+            seq = self.cache.incr(seq_key)
+        self.cache.set(self._entry_key(epoch, seq), (pk, operation), self.timeout)
+
+    def read(self, since, limit):
+        epoch = self.epoch
+        last_seq = self.last_seq()
+        if since > last_seq:
+            return None
+        seqs = range(since + 1, min(last_seq, since + limit) + 1)
+        found = self.cache.get_many([self._entry_key(epoch, seq) for seq in seqs])
+        entries = []
+        for seq in seqs:
+            entry = found.get(self._entry_key(epoch, seq))
+            if entry == None:
+                # Counted, but its writer may not have stored it yet, so the changes after it wait.
+                # Only a change missing for longer than gap_grace is lost.
+                if not entries and self._missing_for(epoch, seq) > self.gap_grace:
+                    return None
+                break
+            entries.append((seq, entry[0], entry[1]))
+        return entries
+
+    def _missing_for(self, epoch, seq):
+        ''' Seconds since a reader first found the change seq missing '''
+        key = '%s:%s:%s:missing' % (self.key_prefix, epoch, seq)
+        now = time.time()
+        first_missed = self.cache.get(key)
+        if first_missed == None:
+            self.cache.add(key, now, self.timeout)
+            return 0
+        return now - first_missed
+
+    def wait(self, since, timeout):
+        '''
+        Waits up to timeout seconds for the change after since to be stored. A change that is
+        counted but not stored yet cannot be read, so waiting for the count alone would return
+        at once and have clients poll in a loop.
+        '''
+        deadline = time.time() + timeout
+        entry_key = self._entry_key(self.epoch, since + 1)
+        while self.cache.get(entry_key) == None and time.time() < deadline:
+            time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
+
+    def _seq_key(self, epoch):
+        return '%s:%s:seq' % (self.key_prefix, epoch)
+
+    def _entry_key(self, epoch, seq):
+        return '%s:%s:%s' % (self.key_prefix, epoch, seq)
+
+
+class ChangeFeedMixin(BaseMixin):
+    '''
+    Records the resource's creates, updates and deletes in log, an in-process ChangeLog by
+    default, and adds the changes/ endpoint. Changes are recorded by deferrable handlers, so
+    with DeferredHandlersMiddleware above TransactionMiddleware clients only hear of changes
+    once they are committed. A request waits at most max_wait seconds and gets at most
+    page_size changes.
+    '''
+    def __init__(self, api_resource, log=None, max_wait=30, page_size=1000):
+        super(ChangeFeedMixin, self).__init__(api_resource)
+        self.log = log or ChangeLog()
+        self.max_wait = max_wait
+        self.page_size = page_size
+
+    def get_endpoints(self):
+        return [
+            EndPoint(r"^(?P<resource_name>%s)/changes/$" % self.api._meta.resource_name,
+                GET('changes', ArgFilters.keys_from_query(['since', 'wait', 'limit'], all_required=False))),
+        ]
+
+    def changes(self, since=None, wait=0, limit=None):
+        log = self.log
+        limit = min(_parse_int('limit', limit or self.page_size), self.page_size)
+        wait = min(_parse_int('wait', wait), self.max_wait)
+        if since == None:
+            return self._page([], log.epoch, log.last_seq(), False)
+        epoch, seq = _parse_token(since)
+        if epoch != log.epoch:
+            return self._page([], log.epoch, log.last_seq(), True)
+        entries = log.read(seq, limit)
+        if entries == [] and wait > 0:
+            log.wait(seq, wait)
+            entries = log.read(seq, limit)
+        if entries == None:
+            return self._page([], log.epoch, log.last_seq(), True)
+        return self._page(entries, epoch, entries and entries[-1][0] or seq, False)
+
+    def _page(self, entries, epoch, seq, reset):
+        return {
+            'changes': _compact(entries),
+            'next': '%s:%s' % (epoch, seq),
+            'reset': reset,
+        }
+
+    @deferrable
+    def on_post_create(self, obj):
+        self.log.append(obj.pk, CREATE)
+
+    @deferrable
+    def on_post_update(self, obj, previous_data):
+        self.log.append(obj.pk, UPDATE)
+
+    def on_delete_process(self, obj):
+        # Django clears obj.pk when the object is deleted
+        obj._change_feed_pk = obj.pk
+
+    @deferrable
+    def on_post_delete(self, obj):
+        self.log.append(getattr(obj, '_change_feed_pk', obj.pk), DELETE)
+
+
+def _compact(entries):
+    '''
+    One change per object, where it last changed. An object created and then updated is still
+    new to the client, so it stays a create.
+    '''
+    operations = {}
+    positions = {}
+    for position, (seq, pk, operation) in enumerate(entries):
+        if operation == UPDATE and operations.get(pk) == CREATE:
+            operation = CREATE
+        operations[pk] = operation
+        positions[pk] = position
+    return [{'id': pk, 'op': operations[pk]} for pk in sorted(positions, key=positions.get)]
+
+
+def _parse_token(token):
+    try:
+        epoch, seq = token.split(':')
+        return epoch, int(seq)
+    except ValueError:
+        raise UserError("%s is not a change feed token" % token, 400)
+
+
+def _parse_int(name, value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise UserError("%s must be a whole number of at least 0" % name, 400)
+    return value
@@ -0,0 +1,154 @@
+'''
+Running a queryset whose __in filter has too many values for a single query, by splitting the
+values into chunks and merging the results of one query per chunk.
+'''
+from django.conf import settings
+from django.db import connections
+from django.db.models.fields import FieldDoesNotExist
+
+# Most values a single __in filter is sent to each database backend with. SQLite refuses more
+# than 999 parameters per query and Oracle more than 1000 items in an IN list. The others
+# accept more, but plan and run very long IN lists badly.
+DEFAULT_CHUNK_SIZES = {
+    'sqlite': 500,
+    'oracle': 1000,
+    'postgresql': 5000,
+    'mysql': 5000,
+}
+DEFAULT_CHUNK_SIZE = 1000
+
+# Types of model fields whose values python sorts the same way as every database does
+MERGEABLE_FIELD_TYPES = (
+    'AutoField', 'BigIntegerField', 'IntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+    'SmallIntegerField', 'FloatField', 'DecimalField', 'DateField', 'DateTimeField', 'TimeField',
+)
+
+
+def get_chunk_size(db_alias):
+    '''
+    The chunk size for the database behind db_alias. settings.SPROCKET_IN_FILTER_CHUNK_SIZES
+    can override the defaults, keyed by backend vendor.
+    '''
+    vendor = connections[db_alias].vendor
+    sizes = getattr(settings, 'SPROCKET_IN_FILTER_CHUNK_SIZES', {})
+    return sizes.get(vendor, DEFAULT_CHUNK_SIZES.get(vendor, DEFAULT_CHUNK_SIZE))
+
+
+def can_merge_ordering(queryset):
+    '''
+    Whether python sorts rows by the queryset's ordering the same way as the database, which
+    merging the chunks of a ChunkedInQuery relies on. Text is sorted by the database's collation,
+    and NULLs come first in some databases and last in others, so only the primary key and
+    numeric, date and time columns that cannot be NULL qualify.
+    '''
+    opts = queryset.model._meta
+    for term in _get_ordering(queryset):
+        name = term.lstrip('-')
+        if name == 'pk':
+            continue
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        if field.primary_key:
+            continue
+        if field.null or field.get_internal_type() not in MERGEABLE_FIELD_TYPES:
+            return False
+    return True
+
+
+class ChunkedInQuery(object):
+    '''
+    Stands in for queryset.filter(**{filter_key: values}) when values is too long to send in one
+    query. It supports the parts of the QuerySet api that list endpoints use: count(), slicing,
+    iteration and values_list().
+
+    A slice runs one query per chunk for the primary keys and ordering columns of the first
+    offset + limit rows of that chunk, sorts those in python, and then loads the objects on the
+    requested page by primary key. Every chunk is ordered the same way as the whole result, so
+    the page comes out the same as it would from a single query, as long as can_merge_ordering()
+    is true of the queryset.
+    '''
+    def __init__(self, queryset, filter_key, values, chunk_size, values_columns=None):
+        self.queryset = queryset
+        self.filter_key = filter_key
+        # Distinct values put every row in exactly one chunk, so counts can be added up
+        self.values = _distinct(values)
+        self.chunk_size = chunk_size
+        self.values_columns = values_columns
+
+    def values_list(self, *columns):
+        return ChunkedInQuery(self.queryset, self.filter_key, self.values, self.chunk_size, columns)
+
+    def count(self):
+        return sum([chunk.count() for chunk in self._chunks()])
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step != None:
+            raise TypeError("ChunkedInQuery only supports slices without a step")
+        return self._fetch(k.start or 0, k.stop)
+
+    def __iter__(self):
+        return iter(self._fetch(0, None))
+
+    def __len__(self):
+        return len(self._fetch(0, None))
+
+    def _chunks(self):
+        for i in range(0, len(self.values), self.chunk_size):
+            yield self.queryset.filter(**{self.filter_key: self.values[i:i + self.chunk_size]})
+
+    def _fetch(self, offset, stop):
+        ordering = _get_ordering(self.queryset)
+        columns = [term.lstrip('-') for term in ordering]
+        descending = [term.startswith('-') for term in ordering]
+        rows = []
+        for chunk in self._chunks():
+            chunk_rows = chunk.values_list('pk', *columns)
+            if stop != None:
+                chunk_rows = chunk_rows[:stop]
+            rows.extend(chunk_rows)
+
+        def compare(a, b):
+            for i, reverse in enumerate(descending):
+                result = cmp(a[i + 1], b[i + 1])
+                if result:
+                    return -result if reverse else result
+            return 0
+        rows.sort(cmp=compare)
+        pks = [row[0] for row in rows[offset:stop]]
+        return self._load(pks)
+
+    def _load(self, pks):
+        by_pk = {}
+        for i in range(0, len(pks), self.chunk_size):
+            queryset = self.queryset.filter(pk__in=pks[i:i + self.chunk_size])
+            if self.values_columns != None:
+                for row in queryset.values_list('pk', *self.values_columns):
+                    by_pk[row[0]] = row[1:]
+            else:
+                for obj in queryset:
+                    by_pk[obj.pk] = obj
+        # Rows deleted since their pks were read are left out
+        return [by_pk[pk] for pk in pks if pk in by_pk]
+
+
+def _get_ordering(queryset):
+    query = queryset.query
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = queryset.model._meta.ordering
+    else:
+        ordering = []
+    return [term for term in ordering if term != '?'] or ['pk']
+
+
+def _distinct(values):
+    seen = set()
+    distinct = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            distinct.append(value)
+    return distinct
@@ -0,0 +1,65 @@
+'''
+Coalescing identical calls that are made at the same time. When many requests for the same
+thing arrive together, such as the GET of a popular object right after it changed, the first
+one runs and the others wait for its result instead of each doing the same work.
+'''
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+        # The callers waiting for this call's result
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''
+    Runs a function once for all the callers that ask for the same key while it is running.
+    Keys only group calls that overlap in time; nothing is cached once the call is done.
+    '''
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        '''
+        Returns (result, ran). The first caller with a key runs fn. The others wait up to
+        timeout seconds and get the same result, with ran False. If fn raises, or takes longer
+        than timeout, the callers that were waiting run fn themselves, and get ran True.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call == None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if leader:
+            try:
+                call.result = fn()
+            except:
+                call.failed = True
+                raise
+            finally:
+                self._finish(key, call)
+            return call.result, True
+        if call.done.wait(timeout) and not call.failed:
+            return call.result, False
+        return fn(), True
+
+    def in_flight(self):
+        ''' The number of keys with a call running '''
+        return len(self._calls)
+
+    def waiting(self):
+        ''' The number of callers waiting for a call that is running '''
+        with self._lock:
+            return sum(call.waiters for call in self._calls.values())
+
+    def _finish(self, key, call):
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
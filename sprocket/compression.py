@@ -0,0 +1,100 @@
+'''
+Helpers for gzip and deflate content-coding of response and request bodies.
+'''
+import zlib
+
+from django.utils.encoding import smart_str
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+
+# zlib window bits for each content-coding. Adding 16 makes zlib write and read a gzip
+# header instead of a zlib one.
+_wbits = {
+    GZIP: 16 + zlib.MAX_WBITS,
+    DEFLATE: zlib.MAX_WBITS,
+}
+
+# Preferred content-coding first, used to break ties between equal q-values
+SUPPORTED_ENCODINGS = (GZIP, DEFLATE)
+
+# Responses of these types are already compressed, and are sent as they are
+COMPRESSED_CONTENT_TYPES = ('application/gzip', 'application/x-gzip', 'application/zip')
+
+
+class DecompressionError(Exception):
+    pass
+
+
+class BodyTooLarge(DecompressionError):
+    pass
+
+
+class UnsupportedEncoding(DecompressionError):
+    pass
+
+
+def negotiate_encoding(accept_encoding):
+    '''
+    Picks the content-coding to use for a response from an Accept-Encoding header value,
+    or returns None if the response should not be compressed.
+    '''
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, sep, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    best = None
+    best_q = 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_iter(chunks, encoding, level=6, charset='utf-8'):
+    '''
+    Compresses a streamed body incrementally, yielding compressed data as it becomes available
+    so the whole body never has to be held in memory.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits[encoding])
+    for chunk in chunks:
+        data = compressor.compress(smart_str(chunk, charset))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def decompress(data, encoding, max_size):
+    '''
+    Decompresses a request body, refusing to inflate it beyond max_size bytes so a small
+    compressed body can not exhaust the worker's memory.
+    '''
+    if encoding not in _wbits:
+        raise UnsupportedEncoding("Unsupported content encoding %s" % encoding)
+    decompressor = zlib.decompressobj(_wbits[encoding])
+    try:
+        result = decompressor.decompress(data, max_size + 1)
+    except zlib.error, e:
+        raise DecompressionError("Invalid %s data: %s" % (encoding, e))
+    if len(result) > max_size or decompressor.unconsumed_tail:
+        raise BodyTooLarge("The decompressed body is larger than %s bytes" % max_size)
+    return result
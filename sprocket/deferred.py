@@ -0,0 +1,216 @@
+'''
+Running post_save, post_create, post_update and post_delete handlers in the background.
+
+Mark a handler with the @deferrable decorator and it runs on an executor once the request is
+done, instead of inline before the response is returned:
+
+    class AuditLogMixin(BaseMixin):
+        @deferrable
+        def on_post_save(self, obj):
+            ...
+
+Deferred calls are collected while a request is handled and handed to the executor when it
+finishes. Under TransactionMiddleware, add DeferredHandlersMiddleware above it in
+MIDDLEWARE_CLASSES so the calls are only handed over after the transaction commits, and are
+dropped if it rolls back.
+'''
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def deferrable(handler):
+    '''
+    Marks a post_* event handler as safe to run in the background after the request.
+    '''
+    handler.deferrable = True
+    return handler
+
+
+class SynchronousExecutor(object):
+    '''
+    Runs deferred calls right away in the calling thread, for tests.
+    '''
+    def submit(self, fn, *args):
+        fn(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ThreadPoolExecutor(object):
+    '''
+    Runs deferred calls on a fixed pool of daemon threads, started on first use.
+
+    The queue of waiting calls is bounded. When it is full, submit blocks for up to
+    submit_timeout seconds and then runs the call in the calling thread, so a backlog slows
+    requests down instead of growing without bound. Without inline_when_full it raises
+    Queue.Full instead.
+
+    Workers close their database connections after each call, so no transaction or broken
+    connection is kept from one call to the next.
+    '''
+    def __init__(self, max_workers=4, max_queue_size=1000, submit_timeout=1.0, inline_when_full=True,
+                 thread_name='sprocket-deferred'):
+        self.max_workers = max_workers
+        self.submit_timeout = submit_timeout
+        self.inline_when_full = inline_when_full
+        self.thread_name = thread_name
+        self._queue = Queue.Queue(max_queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if len(self._threads) < self.max_workers:
+            self._start_workers()
+        try:
+            self._queue.put((fn, args), True, self.submit_timeout)
+        except Queue.Full:
+            if not self.inline_when_full:
+                raise
+            logger.warning("Deferred handler queue is full, running %r inline", fn)
+            fn(*args)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, name='%s-%s' % (self.thread_name, len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item == None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                # Calls submitted by resources report their own errors, this is a last resort
+                logger.exception("Deferred call %r failed", fn)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    '''
+    The executor used by resources that do not set ResourceMeta.deferred_executor. Configured by
+    settings.SPROCKET_DEFERRED_SYNCHRONOUS, SPROCKET_DEFERRED_WORKERS and
+    SPROCKET_DEFERRED_QUEUE_SIZE.
+    '''
+    global _default_executor
+    if _default_executor == None:
+        with _default_executor_lock:
+            if _default_executor == None:
+                if getattr(settings, 'SPROCKET_DEFERRED_SYNCHRONOUS', False):
+                    _default_executor = SynchronousExecutor()
+                else:
+                    _default_executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, 'SPROCKET_DEFERRED_WORKERS', 4),
+                        max_queue_size=getattr(settings, 'SPROCKET_DEFERRED_QUEUE_SIZE', 1000))
+    return _default_executor
+
+
+def set_default_executor(executor):
+    global _default_executor
+    _default_executor = executor
+
+
+_synchronous = SynchronousExecutor()
+
+
+class _Pending(threading.local):
+    def __init__(self):
+        self.calls = None
+
+_pending = _Pending()
+
+
+def defer(executor, fn, *args):
+    '''
+    Submits fn(*args) to the executor once the current request is done, or right away
+    outside of a request.
+    '''
+    if _pending.calls == None:
+        executor.submit(fn, *args)
+    else:
+        _pending.calls.append((executor, fn, args, None))
+
+
+def on_commit(fn, on_discard):
+    '''
+    Calls fn() in this thread once the current request is done, after its transaction commits
+    under DeferredHandlersMiddleware, or right away outside of a request. If the request's calls
+    are discarded instead, on_discard() is called.
+    '''
+    if _pending.calls == None:
+        fn()
+    else:
+        _pending.calls.append((_synchronous, fn, (), on_discard))
+
+
+def start_collecting():
+    '''
+    Starts holding back deferred calls until flush() or discard(). Returns False if calls are
+    already being collected, by the middleware or an outer request.
+    '''
+    if _pending.calls != None:
+        return False
+    _pending.calls = []
+    return True
+
+
+def flush():
+    calls = _pending.calls or []
+    _pending.calls = None
+    for executor, fn, args, on_discard in calls:
+        executor.submit(fn, *args)
+
+
+def discard():
+    calls = _pending.calls or []
+    _pending.calls = None
+    for executor, fn, args, on_discard in calls:
+        if on_discard != None:
+            try:
+                on_discard()
+            except Exception:
+                logger.exception("Undoing deferred call %r failed", fn)
+
+
+class DeferredHandlersMiddleware(object):
+    '''
+    Holds deferred handler calls until the response has passed through the middleware below this
+    one. Listed above TransactionMiddleware, the calls run only once the transaction commits.
+    '''
+    def process_request(self, request):
+        start_collecting()
+
+    def process_response(self, request, response):
+        flush()
+        return response
+
+    def process_exception(self, request, exception):
+        discard()
@@ -1,8 +1,20 @@
 
-from .base_resource import EndPoint, UserError, ArgFilters, GET, PUT, DELETE, POST, BaseApiResource
+from .base_resource import EndPoint, UserError, ArgFilters, GET, PUT, DELETE, POST, BaseApiResource, BaseEvents
+from . import formats
 from .utils import Val, magic_enum_meta_cls
 from .fields import DateTimeField, ApiField, SimpleForeignKeyField, CharField, IntegerField, TextField
+from .filters import parse_filter_params, validate_filter
+from .chunked_query import ChunkedInQuery, can_merge_ordering, get_chunk_size
+from .window_count import (
+    TOTAL_COUNT_COLUMN, supports_window_count, with_total_count, pop_total_count, split_total_count)
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
+from django.db.models.query import QuerySet
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 django_field_to_sprocket_field = {
@@ -18,8 +30,28 @@ django_field_to_sprocket_field = {
 
 class DjangoModelResource(BaseApiResource):
 
+    def __init__(self, *args, **kwargs):
+        super(DjangoModelResource, self).__init__(*args, **kwargs)
+        self._values_columns = self._build_values_columns()
+        self._ordering_columns = self._build_ordering_columns()
+        self._default_ordering = self._build_default_ordering()
+        for option, name in self._find_unindexed_fields():
+            logger.warning("%s: %s in Meta.%s is not indexed, the database will have to sort on it",
+                self.__class__.__name__, name, option)
+
     def get_endpoints(self):
         endpoints = []
+        if self._meta.allow_aggregation:
+            # These have to come before the object endpoint, which would match them as a pk
+            endpoints.append(EndPoint(
+                r"^(?P<resource_name>%s)/aggregate/$" % self._meta.resource_name,
+                GET('aggregate', ArgFilters.all_from_query),
+                ))
+        if self._meta.allow_query_by_post:
+            endpoints.append(EndPoint(
+                r"^(?P<resource_name>%s)/query/$" % self._meta.resource_name,
+                POST('query', ArgFilters.all_from_json),
+                ))
         endpoints += [
             EndPoint(
                 r"^(?P<resource_name>%s)/$" % self._meta.resource_name,
@@ -35,6 +67,16 @@ class DjangoModelResource(BaseApiResource):
         ]
         return endpoints
 
+    def warm_up(self):
+        # Django fills in these caches of model metadata the first time a query needs them
+        opts = self._meta.model_class._meta
+        opts.get_all_field_names()
+        opts.get_all_related_objects()
+        opts.get_all_related_many_to_many_objects()
+        # Imports the backend's SQL compiler module, without connecting to the database
+        queryset = self._get_read_queryset()
+        queryset.query.get_compiler(queryset.db)
+
     def on_init_fields(self, fields):
         for field in self._meta.model_class._meta.fields:
             cls = django_field_to_sprocket_field.get(field.__class__.__name__, ApiField)
@@ -56,9 +98,10 @@ class DjangoModelResource(BaseApiResource):
         self.execute_handlers(ModelEvents.pre_process_update, obj)
 
         obj.save()
+        self._mark_client_wrote()
 
-        self.execute_handlers(ModelEvents.post_save, obj)
-        self.execute_handlers(ModelEvents.post_create, obj)
+        self.execute_deferrable_handlers(ModelEvents.post_save, obj)
+        self.execute_deferrable_handlers(ModelEvents.post_create, obj)
 
         return obj
 
@@ -85,9 +128,12 @@ class DjangoModelResource(BaseApiResource):
         self.execute_handlers(ModelEvents.pre_process_update, obj, previous_data)
 
         obj.save()
+        self._mark_client_wrote()
+        # The update may have taken the object out of what get() can see, so it is loaded again
+        self._forget_loaded_object(obj.pk)
 
-        self.execute_handlers(ModelEvents.post_save, obj)
-        self.execute_handlers(ModelEvents.post_update, obj, previous_data)
+        self.execute_deferrable_handlers(ModelEvents.post_save, obj)
+        self.execute_deferrable_handlers(ModelEvents.post_update, obj, previous_data)
 
         return obj
 
@@ -101,47 +147,469 @@ class DjangoModelResource(BaseApiResource):
         self.execute_handlers(ModelEvents.delete_prepare, obj)
         self.execute_handlers(ModelEvents.delete_validate, obj)
         self.execute_handlers(ModelEvents.delete_process, obj)
+        self._forget_loaded_object(obj.pk)
         obj.delete()
-        self.execute_handlers(ModelEvents.post_delete, obj)
+        self._mark_client_wrote()
+        self.execute_deferrable_handlers(ModelEvents.post_delete, obj)
         return True
 
     def get(self, **kwargs):
+        pk = self._get_pk_lookup(kwargs)
+        if pk != None:
+            obj = self._get_loaded_object(pk)
+            if obj != None:
+                self.execute_handlers(ModelEvents.get_object, obj)
+                return obj
         items = self._list_and_count(limit=1, _include_total=False, **kwargs)
         if items:
-            self.execute_handlers(ModelEvents.get_object, items[0])
-            return items[0]
+            obj = items[0]
+            if pk != None:
+                # Loaded through the resource's filters, so later lookups may skip them
+                self._remember_loaded_object(pk, obj)
+                obj = _copy_model(obj)
+            self.execute_handlers(ModelEvents.get_object, obj)
+            return obj
         else:
             return None
 
     def paged_list(self, offset=0, limit=20, **kwargs):
-        items, total = self._list_and_count(offset=int(offset), limit=int(limit), **kwargs)
+        if self._values_columns != None:
+            objects, total = self._list_values_and_count(offset=int(offset), limit=int(limit), **kwargs)
+        else:
+            items, total = self._list_and_count(offset=int(offset), limit=int(limit), **kwargs)
+            objects = self.obj_list_to_data(items)
         data = {
             'offset': int(offset),
             'limit': int(limit),
             'total_count': total,
-            'objects': self.obj_list_to_dicts(items)
+            'objects': objects
             }
         return data
 
     def list(self, **kwargs):
         return self._list_and_count(_include_total=False, **kwargs)
 
+    def query(self, **kwargs):
+        '''
+        paged_list with the filters sent as a JSON body, for filters too long to fit in a url,
+        such as an id__in with thousands of ids.
+        '''
+        return self.paged_list(**kwargs)
+
     def _list_and_count(self, offset=0, limit=None, _include_total=True, **kwargs):
-        q_filters, filters = build_django_orm_filters_from_params(self, kwargs)
-        self.execute_handlers(ModelEvents.adjust_orm_filters, q_filters, filters)
-        queryset = self._meta.model_class.objects.filter(*q_filters, **filters)
-        queryset = self.execute_filters(ModelEvents.chain_queryset, queryset)
+        queryset = self._get_list_queryset(kwargs, allow_chunking=True)
+        count_in_page = _include_total and self._can_count_in_page_query(queryset)
+        page_queryset = queryset
+        if count_in_page:
+            page_queryset = with_total_count(queryset)
         if limit != None:
-            items = queryset[offset:offset + limit]
+            items = page_queryset[offset:offset + limit]
         else:
-            items = list(queryset)
+            items = list(page_queryset)
+        total = None
+        if count_in_page:
+            items = list(items)
+            total = self._page_total_count(pop_total_count(items), offset)
         items = self.execute_filters(ModelEvents.filter_objects, items)
         items = list(items)
         self.execute_handlers(ModelEvents.list_objects, items)
         if _include_total:
-            return items, queryset.count()
+            if total == None:
+                total = queryset.count()
+            return items, total
         return items
 
+    def _can_count_in_page_query(self, queryset):
+        '''
+        Whether the total count can come with the page, in a COUNT(*) OVER () column. Not for
+        chunked queries, or distinct ones, which the window would count before removing duplicates.
+        '''
+        return (self._meta.count_in_page_query and isinstance(queryset, QuerySet)
+                and not queryset.query.distinct and supports_window_count(queryset.db))
+
+    def _page_total_count(self, total, offset):
+        '''
+        An empty page has no row to read the total from. On the first page that means there are
+        no rows at all, past it the count takes a query of its own, so None is returned.
+        '''
+        if total == None and not offset:
+            return 0
+        return total
+
+    def _get_list_queryset(self, kwargs, allow_chunking=False):
+        '''
+        With allow_chunking, an __in filter with more values than the database should get in one
+        query is left out of the queryset, and a ChunkedInQuery runs it in chunks instead. That
+        is only done for orderings that chunks can be merged by, see can_merge_ordering.
+        '''
+        ordering = self._get_ordering(kwargs.pop('order_by', None))
+        q_filters, filters = build_django_orm_filters_from_params(self, kwargs)
+        self.execute_handlers(ModelEvents.adjust_orm_filters, q_filters, filters)
+        queryset = self._get_read_queryset()
+        chunked_key = None
+        if allow_chunking:
+            chunk_size = self._meta.in_filter_chunk_size or get_chunk_size(queryset.db)
+            chunked_key = self._find_chunked_in_filter(filters, chunk_size)
+        if chunked_key != None:
+            filters = dict(filters)
+            chunked_values = list(filters.pop(chunked_key))
+        queryset = queryset.filter(*q_filters, **filters).order_by(*ordering)
+        queryset = self.execute_filters(ModelEvents.chain_queryset, queryset)
+        if chunked_key != None:
+            if can_merge_ordering(queryset):
+                return ChunkedInQuery(queryset, chunked_key, chunked_values, chunk_size)
+            queryset = queryset.filter(**{chunked_key: chunked_values})
+        return queryset
+
+    def _find_chunked_in_filter(self, filters, chunk_size):
+        ''' Returns the key of the longest __in filter if it has more than chunk_size values '''
+        longest = None
+        for key, value in filters.items():
+            if key.endswith('__in') and len(value) > chunk_size:
+                if longest == None or len(value) > len(filters[longest]):
+                    longest = key
+        return longest
+
+    # Ordering
+
+    def _get_ordering(self, order_by):
+        '''
+        Turns the order_by the client sent, such as 'age', '-age,label' or a list of those, into
+        ORM ordering. Fields must be in Meta.ordering_whitelist.
+        '''
+        if not order_by:
+            return self._default_ordering
+        if isinstance(order_by, basestring):
+            order_by = [order_by]
+        ordering = []
+        for term in ','.join(order_by).split(','):
+            term = term.strip()
+            field_name = term.lstrip('-')
+            if field_name not in self._ordering_columns:
+                raise UserError("You cannot order by the field %s" % field_name, 400)
+            prefix = '-' if term.startswith('-') else ''
+            ordering.append(prefix + self._ordering_columns[field_name])
+        return self._add_ordering_tiebreaker(ordering)
+
+    def _add_ordering_tiebreaker(self, ordering):
+        # Rows that tie on every ordering column come back in any order, which would make
+        # slices overlap or skip rows, so the primary key breaks ties
+        for term in ordering:
+            field = self._get_model_field(term.lstrip('-'))
+            if field is not None and (field.primary_key or field.unique):
+                return ordering
+        return list(ordering) + ['pk']
+
+    def _build_ordering_columns(self):
+        columns = {}
+        for field_name in self._meta.ordering_whitelist:
+            field = self.field_by_name.get(field_name)
+            column = field and self._get_model_field_name(field)
+            if column == None:
+                raise ImproperlyConfigured("%s: %s in Meta.ordering_whitelist is not a model field" % (
+                    self.__class__.__name__, field_name))
+            columns[field_name] = column
+        return columns
+
+    def _build_default_ordering(self):
+        ordering = self._meta.default_ordering or self._meta.model_class._meta.ordering
+        if not ordering:
+            return ['pk']
+        return self._add_ordering_tiebreaker(ordering)
+
+    def _get_model_field(self, name):
+        if name == 'pk':
+            return self._meta.model_class._meta.pk
+        for field in self._meta.model_class._meta.fields:
+            if field.name == name:
+                return field
+        return None
+
+    def _find_unindexed_fields(self):
+        '''
+        Returns (Meta option, field name) pairs for the fields that clients can sort or group by
+        without an index to back it.
+        '''
+        leading_columns = set([names[0] for names in self._meta.model_class._meta.unique_together])
+        def is_indexed(name):
+            field = self._get_model_field(name)
+            return field is None or field.db_index or field.unique or field.name in leading_columns
+
+        unindexed = []
+        for field_name in self._meta.ordering_whitelist:
+            if not is_indexed(self._ordering_columns[field_name]):
+                unindexed.append(('ordering_whitelist', field_name))
+        for field_name in self._meta.group_by_whitelist:
+            field = self.field_by_name.get(field_name)
+            column = field and self._get_model_field_name(field)
+            if column != None and not is_indexed(column):
+                unindexed.append(('group_by_whitelist', field_name))
+        # Only the leading column of the default ordering can come from an index
+        leading = self._default_ordering[0].lstrip('-')
+        if '__' not in leading and not is_indexed(leading):
+            unindexed.append(('default_ordering', leading))
+        return unindexed
+
+    # values_list fast path
+
+    def _build_values_columns(self):
+        '''
+        Returns the model columns that paged_list can fetch with values_list, one per serialized
+        field, or None if the resource needs real model instances. That is the case when handlers
+        look at the objects, when a subclass or mixin replaces how objects are listed or
+        serialized, or when a field serializes something other than a model field.
+        '''
+        if not self._meta.values_list_fast_path or not self._serializes_by_value:
+            return None
+        for event_name in (BaseEvents.obj_to_dict, BaseEvents.obj_list_to_dicts,
+                           ModelEvents.filter_objects, ModelEvents.list_objects):
+            if self._get_handlers(event_name):
+                return None
+        for method_name in ('obj_to_dict', 'obj_list_to_dicts', 'obj_list_to_data', '_list_and_count'):
+            if self._replaces_method(DjangoModelResource, method_name):
+                return None
+        columns = []
+        for field in self.serialized_fields:
+            column = self._get_model_field_name(field)
+            if column == None:
+                return None
+            columns.append(column)
+        return columns
+
+    def _get_model_field_name(self, api_field):
+        '''
+        Returns the name of the model field that an api field reads, as used by values() and
+        values_list(), or None if the api field does not read a model field.
+        '''
+        for field in self._meta.model_class._meta.fields:
+            if field.attname == api_field.obj_attr_name:
+                return field.name
+        return None
+
+    def _list_values_and_count(self, offset=0, limit=None, **kwargs):
+        '''
+        Like _list_and_count, but returns the serialized objects for the current response format,
+        built from values_list rows without instantiating any models.
+        '''
+        queryset = self._get_list_queryset(kwargs, allow_chunking=True)
+        if self._can_count_in_page_query(queryset):
+            rows = with_total_count(queryset).values_list(*(self._values_columns + [TOTAL_COUNT_COLUMN]))
+            if limit != None:
+                rows = rows[offset:offset + limit]
+            rows, total = split_total_count(list(rows))
+            total = self._page_total_count(total, offset)
+        else:
+            rows = queryset.values_list(*self._values_columns)
+            if limit != None:
+                rows = rows[offset:offset + limit]
+            total = None
+        if total == None:
+            total = queryset.count()
+        return self._values_rows_to_data(rows), total
+
+    def _values_rows_to_data(self, rows):
+        fields = self.serialized_fields
+        converted = [[field.value_to_data(val) for field, val in zip(fields, row)] for row in rows]
+        names = [field.name for field in fields]
+        if self.current_response_format in formats.COLUMNAR_FORMATS:
+            return formats.ColumnarList(names, converted)
+        return [dict(zip(names, row)) for row in converted]
+
+    # Identity map - within a request, an object loaded by primary key is only loaded once.
+    # The map keeps the object as it was loaded, and every get() returns a copy of it, so that
+    # changing one caller's object does not change another's.
+
+    def _get_pk_lookup(self, kwargs):
+        ''' Returns the primary key if kwargs look up nothing but the primary key, otherwise None '''
+        if len(kwargs) != 1:
+            return None
+        name, value = kwargs.items()[0]
+        if name not in ('pk', self._meta.model_class._meta.pk.name) or value == None:
+            return None
+        return value
+
+    def _get_loaded_object(self, pk):
+        identity_map = self.thread_current.identity_map
+        if identity_map == None:
+            return None
+        obj = identity_map.get((self, unicode(pk)))
+        if obj == None:
+            return None
+        return _copy_model(obj)
+
+    def _remember_loaded_object(self, pk, obj):
+        identity_map = self.thread_current.identity_map
+        if identity_map != None:
+            identity_map[(self, unicode(pk))] = obj
+
+    def _forget_loaded_object(self, pk):
+        ''' Forgets the object for every resource of the model, since they all saw it change '''
+        identity_map = self.thread_current.identity_map
+        if identity_map == None:
+            return
+        model_class = self._meta.model_class
+        for key in [key for key in identity_map if key[1] == unicode(pk)]:
+            if key[0]._meta.model_class is model_class:
+                del identity_map[key]
+
+    # Read replica routing
+
+    def _get_read_queryset(self):
+        queryset = self._meta.model_class.objects.all()
+        alias = self._get_read_db_alias()
+        if alias:
+            queryset = queryset.using(alias)
+        return queryset
+
+    def _get_read_db_alias(self):
+        '''
+        Returns the database alias reads should use, or None for the default routing.
+
+        Only reads made while dispatching a GET request, or a POST to the query or export
+        endpoints, go to the replica. The lookups that update and delete make happen during a PUT or DELETE, so
+        they stay on the primary, as do direct python calls made outside of a request.
+        '''
+        alias = self._meta.read_replica_alias
+        if not alias:
+            return None
+        request = self.current_request
+        if not request or not self._is_read_request(request):
+            return None
+        if self._meta.read_your_writes_seconds and cache.get(self._get_read_your_writes_key()):
+            return None
+        return alias
+
+    def get_coalescing_scope(self, request):
+        # A client reading its own writes from the primary must not share a replica's response
+        return super(DjangoModelResource, self).get_coalescing_scope(request), self._get_read_db_alias()
+
+    def _is_read_request(self, request):
+        if request.method == 'GET':
+            return True
+        method_endpoint = getattr(request, 'method_endpoint', None)
+        return method_endpoint != None and method_endpoint.api_method_name in ('query', 'start_export')
+
+    def _mark_client_wrote(self):
+        '''
+        Pins the current client's reads to the primary for read_your_writes_seconds, so that
+        a GET right after a write does not miss the write because of replication lag.
+        '''
+        if not self._meta.read_replica_alias or not self._meta.read_your_writes_seconds:
+            return
+        if not self.current_request:
+            return
+        cache.set(self._get_read_your_writes_key(), True, self._meta.read_your_writes_seconds)
+
+    def _get_read_your_writes_key(self):
+        return 'sprocket-read-your-writes:%s:%s' % (
+            self._meta.resource_name, self.get_read_your_writes_client_id(self.current_request))
+
+    def get_read_your_writes_client_id(self, request):
+        '''
+        Override to identify clients differently, for example by an api key.
+        Defaults to the username, or the remote address for anonymous requests.
+        '''
+        user = getattr(request, 'user', None)
+        if user != None and user.is_authenticated():
+            return user.username
+        return request.META.get('REMOTE_ADDR', '')
+
+
+    # Aggregation
+
+    aggregate_functions = {
+        'count': models.Count,
+        'sum': models.Sum,
+        'avg': models.Avg,
+        'min': models.Min,
+        'max': models.Max,
+    }
+
+    def aggregate(self, aggregate=None, group_by=None, **kwargs):
+        '''
+        Computes aggregates over the objects matching the filters in one query, optionally broken
+        down by group_by fields.
+
+        aggregate - one or more of 'count', or '<field>__<function>' where function is one of
+            count, sum, avg, min or max, and the field is in Meta.filtering
+        group_by - one or more fields from Meta.group_by_whitelist
+        '''
+        if not aggregate:
+            raise UserError("Expected at least one aggregate, such as aggregate=count", 400)
+        if isinstance(aggregate, basestring):
+            aggregate = [aggregate]
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        aggregates = {}
+        aggregate_fields = {}
+        for name in aggregate:
+            field_name, function = self._parse_aggregate(name)
+            if field_name == None:
+                aggregates[name] = models.Count('pk')
+            else:
+                field = self.field_by_name[field_name]
+                aggregates[name] = self.aggregate_functions[function](self._get_model_field_name(field))
+                if function in ('min', 'max'):
+                    aggregate_fields[name] = field
+        group_fields = [self._validate_group_by(name) for name in group_by or []]
+
+        queryset = self._get_list_queryset(kwargs)
+        if not group_fields:
+            result = queryset.aggregate(**aggregates)
+            return {'aggregates': self._aggregate_row_to_data(result, aggregate_fields)}
+
+        columns = [self._get_model_field_name(field) for field in group_fields]
+        max_groups = self._meta.max_aggregate_groups
+        rows = list(queryset.values(*columns).annotate(**aggregates).order_by(*columns)[:max_groups + 1])
+        if len(rows) > max_groups:
+            raise UserError("The aggregate has more than %s groups, add filters to narrow it down" % max_groups, 400)
+        for field, column in zip(group_fields, columns):
+            aggregate_fields[column] = field
+        groups = []
+        for row in rows:
+            data = self._aggregate_row_to_data(row, aggregate_fields)
+            for field, column in zip(group_fields, columns):
+                data[field.name] = data.pop(column)
+            groups.append(data)
+        return {'groups': groups}
+
+    def _parse_aggregate(self, name):
+        if name == 'count':
+            return None, 'count'
+        field_name, sep, function = name.rpartition('__')
+        if not sep or function not in self.aggregate_functions:
+            raise UserError("Unknown aggregate %s, expected <field>__<%s>" % (
+                name, '|'.join(sorted(self.aggregate_functions.keys()))), 400)
+        if field_name not in self.field_by_name or field_name not in self._meta.filtering:
+            raise UserError("You cannot aggregate on the field %s" % field_name, 400)
+        if self._get_model_field_name(self.field_by_name[field_name]) == None:
+            raise UserError("You cannot aggregate on the field %s" % field_name, 400)
+        return field_name, function
+
+    def _validate_group_by(self, field_name):
+        field = self.field_by_name.get(field_name)
+        if field == None or field_name not in self._meta.group_by_whitelist:
+            raise UserError("You cannot group by the field %s" % field_name, 400)
+        if self._get_model_field_name(field) == None:
+            raise UserError("You cannot group by the field %s" % field_name, 400)
+        return field
+
+    def _aggregate_row_to_data(self, row, fields_by_key):
+        # Values that come straight from a field, such as a min or a group, are serialized by it
+        data = {}
+        for key, value in row.items():
+            field = fields_by_key.get(key)
+            if field != None:
+                value = field.value_to_data(value)
+            data[key] = value
+        return data
+
+
+def _copy_model(obj):
+    obj = copy.copy(obj)
+    obj._state = copy.copy(obj._state)
+    return obj
+
 
 def build_django_orm_filters_from_params(api_resource, params):
     '''
@@ -150,23 +618,7 @@ def build_django_orm_filters_from_params(api_resource, params):
     '''
     q_filters = []
     dj_filters = {}
-    for key, value in params.items():
-        parts = key.split('__')
-        field_name = parts.pop(0)
-        if field_name not in api_resource.field_by_name and not field_name == 'pk':
-            continue
-        filter_type = 'exact'
-        if parts:
-            filter_type = parts[-1]
-        validate_filter(api_resource, field_name, filter_type)
-
-        if value in [True, 'true', 'True']:
-            value = True
-        elif value in [False, 'false', 'False']:
-            value = False
-        elif value in (None, 'nil', 'none', 'None') and filter_type == 'exact':
-            value = None
-
+    for field_name, filter_type, value in parse_filter_params(api_resource, params):
         if filter_type == 'ne':
             q_filters.append(
                 ~models.Q(**{field_name: value})
@@ -175,18 +627,6 @@ def build_django_orm_filters_from_params(api_resource, params):
 
         filter_key = field_name + '__' + filter_type
 
-        is_container = type(value) in (list, set, frozenset, tuple)
-        # if we're doing an "in" query, all queries need to be in an iterable container, even if one variable.
-        if filter_type in ["in", "range"]:
-            if not is_container:
-                value = [value]
-        else:
-            if is_container:
-                if len(value) > 0:
-                    value = value[0]
-                else:
-                    value = None
-
         # Hack to fix filtering of foreign keys, which need to be filtered
         # on the field without the _id part addded
         if isinstance(api_resource.field_by_name.get(field_name), SimpleForeignKeyField):
@@ -198,13 +638,6 @@ def build_django_orm_filters_from_params(api_resource, params):
     return q_filters, dj_filters
 
 
-def validate_filter(api, field_name, filter_type):
-    if not field_name in api._meta.filtering:
-        raise UserError('You cannot filter on the field %s ' % field_name, status_code=400)
-    if not filter_type in api._meta.filtering.get(field_name, []):
-        raise UserError('You cannot filter on the field %s in the form of %s ' % (field_name, filter_type), 400)
-
-
 class ModelEvents(object):
     __metaclass__ = magic_enum_meta_cls
 
@@ -0,0 +1,323 @@
+'''
+Exporting every object that matches a list's filters to a gzipped NDJSON or CSV file. Exports
+run on a pool of background threads, so a long export never holds a request worker:
+
+    def get_mixins(self):
+        return [ExportMixin(self)]
+
+adds these endpoints to a DjangoModelResource:
+
+    POST <resource>/exports/                       starts an export, with the same filters as the
+                                                   list endpoint and "format": "ndjson" or "csv"
+    GET  <resource>/exports/<job id>/              the export's status and how many rows it wrote
+    GET  <resource>/exports/<job id>/download/     the file, once the status is "done"
+
+Rows are read in batches in primary key order, each batch starting after the last key of the
+one before, so every query is short and the export never holds more than one batch in memory.
+Jobs and their files are kept in settings.SPROCKET_EXPORT_DIR, where every process on the host
+can see them, and deleted after settings.SPROCKET_EXPORT_MAX_AGE seconds, a day by default.
+'''
+import csv
+import gzip
+import os
+import Queue
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+from django.utils import simplejson as json
+
+from . import formats
+from .base_resource import EndPoint, GET, POST, ArgFilters, UserError, request_context
+from .deferred import ThreadPoolExecutor
+from .django_model_resource import ModelEvents
+from .mixins import BaseMixin
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+EXPORT_FORMATS = (NDJSON, CSV)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_job_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ExportJob(object):
+    def __init__(self, id, resource, format, username='', status=PENDING, rows=0, created=None,
+                 finished=None, error=None):
+        self.id = id
+        self.resource = resource
+        self.format = format
+        self.username = username
+        self.status = status
+        self.rows = rows
+        self.created = created or time.time()
+        self.finished = finished
+        self.error = error
+
+    def to_dict(self):
+        ''' What clients polling the job see '''
+        return {
+            'id': self.id,
+            'resource': self.resource,
+            'format': self.format,
+            'status': self.status,
+            'rows': self.rows,
+            'created': self.created,
+            'finished': self.finished,
+            'error': self.error,
+        }
+
+
+class ExportJobStore(object):
+    '''
+    Keeps each job as a small JSON file next to its export, replaced whole on every update so
+    readers in other processes never see half of one.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def create(self, resource, format, username=''):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another thread or process created it first
+                pass
+        job = ExportJob(uuid.uuid4().hex, resource, format, username)
+        self.save(job)
+        return job
+
+    def get(self, job_id):
+        if not _job_id_re.match(job_id):
+            return None
+        try:
+            f = open(self._status_path(job_id))
+        except IOError:
+            return None
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        return ExportJob(**dict([(str(key), value) for key, value in data.items()]))
+
+    def save(self, job):
+        path = self._status_path(job.id)
+        temp_path = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        f = open(temp_path, 'w')
+        try:
+            json.dump(job.__dict__, f)
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+
+    def data_path(self, job):
+        return os.path.join(self.directory, '%s.%s.gz' % (job.id, job.format))
+
+    def delete(self, job):
+        for path in (self._status_path(job.id), self.data_path(job)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def purge(self, max_age):
+        ''' Deletes the files of jobs created more than max_age seconds ago '''
+        cutoff = time.time() - max_age
+        try:
+            file_names = os.listdir(self.directory)
+        except OSError:
+            return
+        for file_name in file_names:
+            path = os.path.join(self.directory, file_name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                # Deleted by another process purging at the same time
+                pass
+
+    def _status_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.json')
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    '''
+    The pool exports run on unless ExportMixin is given one. Sized by
+    settings.SPROCKET_EXPORT_WORKERS, 2 by default, and SPROCKET_EXPORT_QUEUE_SIZE, 100 by
+    default. Exports started while the queue is full are refused.
+    '''
+    global _default_executor
+    if _default_executor == None:
+        with _default_executor_lock:
+            if _default_executor == None:
+                _default_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SPROCKET_EXPORT_WORKERS', 2),
+                    max_queue_size=getattr(settings, 'SPROCKET_EXPORT_QUEUE_SIZE', 100),
+                    submit_timeout=0, inline_when_full=False, thread_name='sprocket-export')
+    return _default_executor
+
+
+def get_default_directory():
+    return getattr(settings, 'SPROCKET_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'sprocket-exports'))
+
+
+class ExportMixin(BaseMixin):
+    '''
+    Adds the export endpoints to a DjangoModelResource. Objects are serialized with
+    obj_list_to_dicts, batch_size at a time, and filter_objects and list_objects handlers run
+    on every batch. Jobs can only be seen by the user that started them.
+    '''
+    def __init__(self, api_resource, batch_size=1000, directory=None, executor=None, max_age=None):
+        super(ExportMixin, self).__init__(api_resource)
+        self.batch_size = batch_size
+        self.store = ExportJobStore(directory or get_default_directory())
+        self.executor = executor
+        self.max_age = max_age or getattr(settings, 'SPROCKET_EXPORT_MAX_AGE', 24 * 60 * 60)
+
+    def get_endpoints(self):
+        name = self.api._meta.resource_name
+        return [
+            EndPoint(r"^(?P<resource_name>%s)/exports/$" % name,
+                POST('start_export', ArgFilters.all_from_json)),
+            EndPoint(r"^(?P<resource_name>%s)/exports/(?P<job_id>[0-9a-f]+)/$" % name,
+                GET('export_status')),
+            EndPoint(r"^(?P<resource_name>%s)/exports/(?P<job_id>[0-9a-f]+)/download/$" % name,
+                GET('download_export')),
+        ]
+
+    def start_export(self, format=NDJSON, **kwargs):
+        api = self.api
+        if format not in EXPORT_FORMATS:
+            raise UserError("Exports can be in these formats: %s" % ', '.join(EXPORT_FORMATS), 400)
+        # Exports always run in primary key order, which the batches depend on
+        kwargs.pop('order_by', None)
+        # Built here so that invalid filters fail the request instead of the job
+        queryset = api._get_list_queryset(kwargs)
+        job = self.store.create(api._meta.resource_name, format, api.current_username)
+        # Taken first, the job changes as soon as it runs
+        data = job.to_dict()
+        try:
+            (self.executor or get_default_executor()).submit(self._run, job, queryset, api.current_request)
+        except Queue.Full:
+            self.store.delete(job)
+            raise UserError("Too many exports are waiting to run, try again later", 503)
+        api.set_current_status_code(202)
+        return data
+
+    def export_status(self, job_id):
+        return self._get_job(job_id).to_dict()
+
+    def download_export(self, job_id):
+        job = self._get_job(job_id)
+        if job.status != DONE:
+            raise UserError("Export %s is %s, not done" % (job_id, job.status), 409)
+        try:
+            data_file = open(self.store.data_path(job), 'rb')
+        except IOError:
+            # Purged since its status was read
+            raise UserError("Export %s has expired" % job_id, 410)
+        api = self.api
+        api.set_response_header('Content-Type', 'application/gzip')
+        api.set_response_header('Content-Disposition', 'attachment; filename=%s-%s.%s.gz' % (
+            job.resource, job.id, job.format))
+        api.set_response_header('Content-Length', str(os.fstat(data_file.fileno()).st_size))
+        return HttpResponse(FileWrapper(data_file))
+
+    def _get_job(self, job_id):
+        job = self.store.get(job_id)
+        if job == None or job.resource != self.api._meta.resource_name or \
+                (job.username and job.username != self.api.current_username):
+            raise UserError("Export %s was not found" % job_id, 404)
+        return job
+
+    def _run(self, job, queryset, request):
+        path = self.store.data_path(job)
+        temp_path = path + '.part'
+        # Make the request that started the export current, so handlers can still use current_user
+        with request_context(request):
+            try:
+                job.status = RUNNING
+                self.store.save(job)
+                out = gzip.open(temp_path, 'wb')
+                try:
+                    write_batch = self._get_writer(job.format, out)
+                    for dicts in self._batches(queryset):
+                        write_batch(dicts)
+                        job.rows += len(dicts)
+                        self.store.save(job)
+                finally:
+                    out.close()
+                os.rename(temp_path, path)
+                job.status = DONE
+            except Exception, ex:
+                job.status = FAILED
+                job.error = "The export failed"
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                self.api.handle_server_error(request, getattr(request, 'endpoint', None), ex, None)
+            finally:
+                job.finished = time.time()
+                self.store.save(job)
+                # Done here rather than in the request, since it lists the whole directory
+                self.store.purge(self.max_age)
+
+    def _batches(self, queryset):
+        ''' Yields the serialized objects batch_size at a time '''
+        api = self.api
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            page = queryset
+            if last_pk != None:
+                page = page.filter(pk__gt=last_pk)
+            objects = list(page[:self.batch_size])
+            if not objects:
+                return
+            last_pk = objects[-1].pk
+            is_last = len(objects) < self.batch_size
+            objects = list(api.execute_filters(ModelEvents.filter_objects, objects))
+            api.execute_handlers(ModelEvents.list_objects, objects)
+            yield api.obj_list_to_dicts(objects)
+            if is_last:
+                return
+
+    def _get_writer(self, format, out):
+        if format == NDJSON:
+            def write_ndjson(dicts):
+                out.write(''.join([formats.encode(data, formats.JSON) + '\n' for data in dicts]))
+            return write_ndjson
+
+        writer = csv.writer(out)
+        columns = []
+
+        def write_csv(dicts):
+            if not columns and dicts:
+                # The serialized fields, then anything obj_to_dict handlers add
+                columns.extend([field.name for field in self.api.serialized_fields])
+                columns.extend(sorted(set(dicts[0].keys()) - set(columns)))
+                writer.writerow(columns)
+            writer.writerows([[_csv_value(data.get(column)) for column in columns] for data in dicts])
+        return write_csv
+
+
+def _csv_value(value):
+    if value == None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+    return str(value)
@@ -7,12 +7,29 @@ class ApiField(object):
         self.label = label if label else name
         
     def obj_to_dict(self, obj, data):
-        data[self.name] = getattr(obj, self.obj_attr_name)
+        data[self.name] = self.obj_to_value(obj)
+
+    def obj_to_value(self, obj):
+        return self.value_to_data(getattr(obj, self.obj_attr_name))
+
+    def value_to_data(self, val):
+        '''
+        Converts an attribute value into its serialized form. Override this rather than
+        obj_to_dict so the field can also be used for columnar output.
+        '''
+        return val
 
     def dict_to_obj(self, data, obj):
         if self.name in data:
             setattr(obj, self.obj_attr_name, data[self.name])
 
+    def parse_value(self, val):
+        '''
+        Converts a value that came in from a query string into the attribute's type.
+        Raises ValueError if it can not be converted.
+        '''
+        return val
+
     @classmethod
     def type_name(cls):
         return cls.__name__
@@ -25,27 +42,31 @@ class CharField(ApiField):
     pass    
 
 class IntegerField(ApiField):
-    pass
+    def parse_value(self, val):
+        if isinstance(val, basestring):
+            return int(val)
+        return val
 
 class TextField(ApiField):
     pass
 
 class DateTimeField(ApiField):
     DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-    def obj_to_dict(self, obj, data):
-        val = getattr(obj, self.obj_attr_name)
+    def value_to_data(self, val):
         # and not isinstance(val, basestring):
         if val != None:
             val = val.strftime(self.DATE_FORMAT)
-        data[self.name] = val
+        return val
 
     def dict_to_obj(self, data, obj):
         if not self.name in data:
             return
-        val = data.get(self.name)
+        setattr(obj, self.obj_attr_name, self.parse_value(data.get(self.name)))
+
+    def parse_value(self, val):
         if val != None and not isinstance(val, datetime):
             val = datetime.strptime(val, self.DATE_FORMAT)
-        setattr(obj, self.obj_attr_name, val)
+        return val
 
 
 class SimpleForeignKeyField(ApiField):
@@ -53,3 +74,11 @@ class SimpleForeignKeyField(ApiField):
         self.name = name + '_id'
         self.obj_attr_name = obj_attr_name if obj_attr_name else self.name
         self.label = label if label else name
+
+
+def serializes_by_value(field):
+    '''
+    True if the field serializes through obj_to_value, so its value can be read without building a
+    dict. Fields that override obj_to_dict itself have to be serialized through it.
+    '''
+    return type(field).obj_to_dict.im_func is ApiField.obj_to_dict.im_func
@@ -0,0 +1,53 @@
+'''
+Parsing of the filters that clients send as query parameters, shared by the resource backends.
+'''
+from .base_resource import UserError
+
+
+def parse_filter_params(api_resource, params):
+    '''
+    Takes filters that came in from a query string and returns them as a list of
+    (field_name, filter_type, value) tuples, after checking them against Meta.filtering.
+    Parameters that do not name a field are skipped. Values of 'in' and 'range' filters are
+    always containers, values of other filters are never lists.
+    '''
+    filters = []
+    for key, value in params.items():
+        parts = key.split('__')
+        field_name = parts.pop(0)
+        if field_name not in api_resource.field_by_name and not field_name == 'pk':
+            continue
+        filter_type = 'exact'
+        if parts:
+            filter_type = parts[-1]
+        validate_filter(api_resource, field_name, filter_type)
+
+        if value in [True, 'true', 'True']:
+            value = True
+        elif value in [False, 'false', 'False']:
+            value = False
+        elif value in (None, 'nil', 'none', 'None') and filter_type == 'exact':
+            value = None
+
+        if filter_type != 'ne':
+            is_container = type(value) in (list, set, frozenset, tuple)
+            # if we're doing an "in" query, all queries need to be in an iterable container, even if one variable.
+            if filter_type in ["in", "range"]:
+                if not is_container:
+                    value = [value]
+            else:
+                if is_container:
+                    if len(value) > 0:
+                        value = value[0]
+                    else:
+                        value = None
+
+        filters.append((field_name, filter_type, value))
+    return filters
+
+
+def validate_filter(api, field_name, filter_type):
+    if not field_name in api._meta.filtering:
+        raise UserError('You cannot filter on the field %s ' % field_name, status_code=400)
+    if not filter_type in api._meta.filtering.get(field_name, []):
+        raise UserError('You cannot filter on the field %s in the form of %s ' % (field_name, filter_type), 400)
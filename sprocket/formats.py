@@ -0,0 +1,172 @@
+'''
+Response formats. Besides plain JSON, lists of objects can be sent in a columnar form, where the
+field names are sent once followed by one row of values per object, either as JSON or as
+MessagePack. msgpack is an optional dependency, only needed for the MessagePack format.
+'''
+import uuid
+
+from django.utils import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+COLUMNAR = 'columnar'
+MSGPACK = 'msgpack'
+
+CONTENT_TYPES = {
+    JSON: 'application/json',
+    COLUMNAR: 'application/vnd.sprocket.columnar+json',
+    MSGPACK: 'application/x-msgpack',
+}
+
+# Formats that send lists of objects as a ColumnarList
+COLUMNAR_FORMATS = (COLUMNAR, MSGPACK)
+
+_format_by_content_type = {
+    'application/json': JSON,
+    'application/vnd.sprocket.columnar+json': COLUMNAR,
+    'application/x-msgpack': MSGPACK,
+    'application/msgpack': MSGPACK,
+}
+
+
+class UnavailableFormat(Exception):
+    pass
+
+
+class ColumnarList(object):
+    '''
+    A list of objects as the names of their fields, sent once, and one row of values per object.
+    Encoded as {"fields": [...], "rows": [[...], ...]}
+    '''
+    def __init__(self, fields, rows):
+        self.fields = fields
+        self.rows = rows
+
+    @classmethod
+    def from_dicts(cls, dicts):
+        fields = []
+        seen = set()
+        for data in dicts:
+            for name in data:
+                if name not in seen:
+                    seen.add(name)
+                    fields.append(name)
+        rows = [[data.get(name) for name in fields] for data in dicts]
+        return cls(fields, rows)
+
+    def to_data(self):
+        return {'fields': self.fields, 'rows': self.rows}
+
+    def to_dicts(self):
+        return [dict(zip(self.fields, row)) for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class JSONFragments(object):
+    '''
+    A list of objects that are already encoded as JSON. encode() splices the fragments into the
+    JSON output as they are, instead of decoding and encoding them again.
+    '''
+    def __init__(self, fragments):
+        self.fragments = fragments
+
+    def to_json(self):
+        return '[' + ','.join(self.fragments) + ']'
+
+    def to_data(self):
+        return [json.loads(fragment) for fragment in self.fragments]
+
+    def __len__(self):
+        return len(self.fragments)
+
+
+# Stands in for JSONFragments while the rest of a response is encoded. The random part keeps it
+# from matching a string in the data.
+_fragments_placeholder = '__sprocket_fragments_%s_%%s__' % uuid.uuid4().hex
+
+
+def format_from_param(value):
+    if isinstance(value, basestring) and value in CONTENT_TYPES:
+        return value
+    return None
+
+
+def format_from_content_type(content_type):
+    '''
+    Returns the format of an Accept or Content-Type header value, or None if it names none of
+    the formats. For Accept headers the format with the highest q value wins, the first listed
+    of those that tie, and formats with a q of 0 are never picked.
+    '''
+    best = None
+    best_quality = 0
+    for part in (content_type or '').split(','):
+        params = part.split(';')
+        media_type = params.pop(0).strip().lower()
+        if media_type not in _format_by_content_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > best_quality:
+            best = _format_by_content_type[media_type]
+            best_quality = quality
+    return best
+
+
+def encode(data, format):
+    if format == MSGPACK:
+        if msgpack == None:
+            raise UnavailableFormat("The msgpack format requires the msgpack package")
+        return msgpack.packb(data, default=_to_primitive)
+    if isinstance(data, JSONFragments):
+        return data.to_json()
+    if isinstance(data, dict):
+        return _encode_with_fragments(data)
+    return json.dumps(data, default=_to_primitive)
+
+
+def _encode_with_fragments(data):
+    ''' Encodes a dict, such as a page of a list, splicing in any JSONFragments among its values '''
+    spliced = {}
+    for key, value in data.items():
+        if isinstance(value, JSONFragments):
+            spliced[key] = _fragments_placeholder % len(spliced)
+    if not spliced:
+        return json.dumps(data, default=_to_primitive)
+    encoded = json.dumps(dict(data, **spliced), default=_to_primitive)
+    for key, placeholder in spliced.items():
+        encoded = encoded.replace('"%s"' % placeholder, data[key].to_json(), 1)
+    return encoded
+
+
+def decode(data_str, format):
+    '''
+    Decodes a request body. A columnar list is turned back into a list of dicts, so bulk writes
+    can be sent in the same form that lists are read in.
+    '''
+    if format == MSGPACK:
+        if msgpack == None:
+            raise UnavailableFormat("The msgpack format requires the msgpack package")
+        data = msgpack.unpackb(data_str)
+    else:
+        data = json.loads(data_str)
+    if format in COLUMNAR_FORMATS and isinstance(data, dict) and set(data.keys()) == set(['fields', 'rows']):
+        data = ColumnarList(data['fields'], data['rows']).to_dicts()
+    return data
+
+
+def _to_primitive(obj):
+    if isinstance(obj, (ColumnarList, JSONFragments)):
+        return obj.to_data()
+    raise TypeError("%r is not serializable" % obj)
@@ -0,0 +1,152 @@
+'''
+Caching the JSON of each object in a list, so objects that show up on many list pages are only
+serialized once for as long as they stay unchanged. Add FragmentCacheMixin to a resource:
+
+    def get_mixins(self):
+        return [FragmentCacheMixin(self, version_field='updated')]
+
+A cached fragment is used only while the object's version field has the value it had when the
+fragment was cached, so the version field must change whenever the object does. Fragments are
+also dropped when the resource saves or deletes an object. obj_to_dict and obj_list_to_dicts
+handlers of a resource using the cache must depend on nothing but the object: not on the current
+user or request.
+
+Fragments are kept in a bounded LRU in each process, and optionally in a shared Django cache
+backend too, so processes can reuse each other's work. Resources that serialize straight from
+values_list rows do not call obj_to_dict and get nothing from the cache; it pays off for
+resources with obj_to_dict handlers or fields that compute their values.
+'''
+from collections import OrderedDict
+import hashlib
+import threading
+
+from . import formats
+from .mixins import BaseMixin
+
+
+class FragmentCache(object):
+    '''
+    Maps primary keys to (version, fragment) pairs. Keeps up to max_entries in memory, dropping
+    the least recently used first, and with a backend shares them under keys that start with
+    key_prefix.
+    '''
+    def __init__(self, key_prefix, max_entries=10000, backend=None, timeout=300):
+        self.key_prefix = key_prefix
+        self.max_entries = max_entries
+        self.backend = backend
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, versions):
+        '''
+        Takes a dict of primary key to current version, and returns a dict of primary key to
+        fragment for those that are cached at that version.
+        '''
+        found = {}
+        with self._lock:
+            for pk, version in versions.items():
+                entry = self._entries.pop(pk, None)
+                if entry == None:
+                    continue
+                self._entries[pk] = entry
+                if entry[0] == version:
+                    found[pk] = entry[1]
+        missing = [pk for pk in versions if pk not in found]
+        if self.backend != None and missing:
+            shared = self.backend.get_many([self._backend_key(pk) for pk in missing])
+            for pk in missing:
+                entry = shared.get(self._backend_key(pk))
+                if entry != None and entry[0] == versions[pk]:
+                    found[pk] = entry[1]
+                    self._store_locally(pk, entry)
+        self.hits += len(found)
+        self.misses += len(versions) - len(found)
+        return found
+
+    def set_many(self, entries):
+        ''' Takes a dict of primary key to (version, fragment) '''
+        for pk, entry in entries.items():
+            self._store_locally(pk, entry)
+        if self.backend != None and entries:
+            self.backend.set_many(
+                dict([(self._backend_key(pk), entry) for pk, entry in entries.items()]), self.timeout)
+
+    def delete(self, pk):
+        with self._lock:
+            self._entries.pop(pk, None)
+        if self.backend != None:
+            self.backend.delete(self._backend_key(pk))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store_locally(self, pk, entry):
+        with self._lock:
+            self._entries.pop(pk, None)
+            self._entries[pk] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _backend_key(self, pk):
+        return '%s:%s' % (self.key_prefix, pk)
+
+
+class FragmentCacheMixin(BaseMixin):
+    '''
+    Builds JSON list responses from cached fragments. version_field names the attribute that
+    changes whenever an object does, such as an auto_now DateTimeField. backend is a Django
+    cache, such as django.core.cache.cache, shared by every process.
+    '''
+    def __init__(self, api_resource, version_field='updated', max_entries=10000, backend=None, timeout=300):
+        super(FragmentCacheMixin, self).__init__(api_resource)
+        self.version_field = version_field
+        self._cache_args = (max_entries, backend, timeout)
+        self._cache = None
+        self._cache_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        '''
+        Created on first use, once the resource's serialized fields are known. They are part of
+        the backend keys, so fragments of an old field set are not used after a deploy.
+        '''
+        if self._cache == None:
+            with self._cache_lock:
+                if self._cache == None:
+                    field_names = ','.join([field.name for field in self.api.serialized_fields])
+                    key_prefix = 'sprocket-fragment:%s:%s' % (
+                        self.api._meta.resource_name, hashlib.md5(field_names).hexdigest())
+                    self._cache = FragmentCache(key_prefix, *self._cache_args)
+        return self._cache
+
+    def obj_list_to_data(self, objects):
+        api = self.api
+        if api.current_response_format != formats.JSON:
+            return type(api).obj_list_to_data(api, objects)
+        versions = dict([(unicode(obj.pk), getattr(obj, self.version_field)) for obj in objects])
+        cached = self.cache.get_many(versions)
+        # Objects that are not cached are serialized together, so obj_list_to_dicts handlers
+        # still see them as one batch
+        missing = [obj for obj in objects if unicode(obj.pk) not in cached]
+        new_entries = {}
+        for obj, data in zip(missing, api.obj_list_to_dicts(missing)):
+            pk = unicode(obj.pk)
+            fragment = formats.encode(data, formats.JSON)
+            new_entries[pk] = (versions[pk], fragment)
+            cached[pk] = fragment
+        self.cache.set_many(new_entries)
+        return formats.JSONFragments([cached[unicode(obj.pk)] for obj in objects])
+
+    def on_post_save(self, obj):
+        self.cache.delete(unicode(obj.pk))
+
+    def on_delete_process(self, obj):
+        # Django clears obj.pk when the object is deleted, so forget it while the pk is still set
+        self.cache.delete(unicode(obj.pk))
+
+    def on_post_delete(self, obj):
+        if obj.pk != None:
+            self.cache.delete(unicode(obj.pk))
@@ -0,0 +1,92 @@
+'''
+Stores for the responses of requests sent with an Idempotency-Key header, see
+ResourceMeta.idempotency_keys. A store needs get, add (which only stores a value for a key that
+has none, atomically), set and delete, each taking a timeout in seconds where they store.
+'''
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+PENDING = 'pending'
+COMPLETED = 'completed'
+
+# How long a request is taken to be running before a retry may run again, in case the process
+# running it died
+PENDING_TIMEOUT = 5 * 60
+
+
+class CacheStore(object):
+    '''
+    Keeps responses in a Django cache. Shared between processes with a backend such as
+    memcached, whose add() is atomic.
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def add(self, key, value, timeout):
+        return self.cache.add(key, value, timeout)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class MemoryStore(object):
+    '''
+    Keeps responses in a dict in this process, for tests and single process servers.
+    '''
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def add(self, key, value, timeout):
+        with self._lock:
+            if self._get(key) != None:
+                return False
+            self._entries[key] = (time.time() + timeout, value)
+            return True
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.time() + timeout, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry == None:
+            return None
+        if entry[0] < time.time():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store():
+    '''
+    The store used by resources that do not set ResourceMeta.idempotency_store: the Django cache
+    named by settings.SPROCKET_IDEMPOTENCY_CACHE, 'default' by default.
+    '''
+    global _default_store
+    if _default_store == None:
+        with _default_store_lock:
+            if _default_store == None:
+                _default_store = CacheStore(get_cache(getattr(settings, 'SPROCKET_IDEMPOTENCY_CACHE', 'default')))
+    return _default_store
@@ -0,0 +1,415 @@
+'''
+A resource whose objects live in memory rather than in a database, for config-like data that is
+small enough to keep in every process.
+'''
+from bisect import bisect_left, bisect_right
+import copy
+import threading
+
+from .base_resource import BaseApiResource, EndPoint, ArgFilters, UserError, GET, PUT, DELETE, POST
+from .django_model_resource import ModelEvents
+from .filters import parse_filter_params
+
+# Filter types answered by each kind of index
+HASH_FILTERS = ('exact', 'in', 'ne')
+SORTED_FILTERS = ('gt', 'gte', 'lt', 'lte', 'range')
+
+
+class UnsupportedFilter(Exception):
+    pass
+
+
+class _Snapshot(object):
+    def __init__(self, objects, hash_indexes, sorted_indexes):
+        # pk -> object
+        self.objects = objects
+        # attribute name -> {value: frozenset of pks}
+        self.hash_indexes = hash_indexes
+        # attribute name -> (sorted list of values, list of pks in the same order)
+        self.sorted_indexes = sorted_indexes
+
+
+class InMemoryStore(object):
+    '''
+    Objects keyed by primary key, with hash indexes for equality lookups and sorted indexes for
+    range lookups on other attributes.
+
+    Writes are copy-on-write: a writer builds a new snapshot of the objects and indexes while
+    holding a lock, then swaps it in with a single assignment. Readers never lock, and each query
+    runs against the snapshot it started with. That makes every write O(n), which is fine for
+    data that is read far more often than it is written.
+
+    put() stores a copy of the object, and reads hand out copies, so changing an object that was
+    put or read never changes the store or leaves its indexes out of date. Copies are shallow,
+    so attribute values such as lists must still not be changed in place.
+    '''
+    def __init__(self, hash_indexes=(), sorted_indexes=(), pk_attr='pk'):
+        self.pk_attr = pk_attr
+        self._lock = threading.Lock()
+        self._next_pk = 1
+        self._snapshot = _Snapshot(
+            {},
+            dict([(attr, {}) for attr in hash_indexes]),
+            dict([(attr, ([], [])) for attr in sorted_indexes]))
+
+    def get(self, pk):
+        obj = self._snapshot.objects.get(pk)
+        if obj == None:
+            return None
+        return copy.copy(obj)
+
+    def all(self):
+        return self._sorted_copies(self._snapshot.objects.values())
+
+    def __len__(self):
+        return len(self._snapshot.objects)
+
+    def next_pk(self):
+        with self._lock:
+            pk = self._next_pk
+            self._next_pk += 1
+            return pk
+
+    def put(self, obj):
+        obj = copy.copy(obj)
+        pk = getattr(obj, self.pk_attr)
+        with self._lock:
+            snapshot = self._snapshot
+            previous = snapshot.objects.get(pk)
+            objects = dict(snapshot.objects)
+            objects[pk] = obj
+            self._snapshot = _Snapshot(
+                objects,
+                self._updated_hash_indexes(snapshot, pk, previous, obj),
+                self._updated_sorted_indexes(snapshot, pk, previous, obj))
+            if isinstance(pk, (int, long)) and pk >= self._next_pk:
+                self._next_pk = pk + 1
+
+    def delete(self, pk):
+        with self._lock:
+            snapshot = self._snapshot
+            previous = snapshot.objects.get(pk)
+            if previous == None:
+                return False
+            objects = dict(snapshot.objects)
+            del objects[pk]
+            self._snapshot = _Snapshot(
+                objects,
+                self._updated_hash_indexes(snapshot, pk, previous, None),
+                self._updated_sorted_indexes(snapshot, pk, previous, None))
+            return True
+
+    def query(self, filters):
+        '''
+        Returns the objects matching all of the filters, ordered by pk. filters is a list of
+        (attribute name, filter type, value) tuples, as produced by parse_filter_params. Filters
+        with a matching index are answered from it, the rest are checked against each candidate.
+        '''
+        snapshot = self._snapshot
+        pks = None
+        unindexed = []
+        for attr, filter_type, value in filters:
+            matches = self._lookup(snapshot, attr, filter_type, value)
+            if matches == None:
+                unindexed.append((attr, filter_type, value))
+            elif pks == None:
+                pks = matches
+            else:
+                pks = pks & matches
+        if pks == None:
+            objects = snapshot.objects.values()
+        else:
+            objects = [snapshot.objects[pk] for pk in pks]
+        for attr, filter_type, value in unindexed:
+            objects = [obj for obj in objects if _matches(getattr(obj, attr, None), filter_type, value)]
+        return self._sorted_copies(objects)
+
+    def _sorted_copies(self, objects):
+        pk_attr = self.pk_attr
+        return [copy.copy(obj) for obj in sorted(objects, key=lambda obj: getattr(obj, pk_attr))]
+
+    def _lookup(self, snapshot, attr, filter_type, value):
+        ''' Returns the set of matching pks, or None if no index can answer the filter '''
+        if attr == self.pk_attr:
+            all_pks = snapshot.objects.viewkeys()
+            if filter_type == 'exact':
+                return all_pks & set([value])
+            elif filter_type == 'in':
+                return all_pks & set(value)
+            elif filter_type == 'ne':
+                return all_pks - set([value])
+            return None
+
+        if attr in snapshot.hash_indexes and filter_type in HASH_FILTERS:
+            index = snapshot.hash_indexes[attr]
+            if filter_type == 'exact':
+                return set(index.get(_hashable(value), ()))
+            elif filter_type == 'in':
+                pks = set()
+                for item in value:
+                    pks.update(index.get(_hashable(item), ()))
+                return pks
+            else:
+                return snapshot.objects.viewkeys() - index.get(_hashable(value), frozenset())
+
+        if attr in snapshot.sorted_indexes and filter_type in SORTED_FILTERS + ('exact',) and value != None:
+            values, pks = snapshot.sorted_indexes[attr]
+            if filter_type == 'exact':
+                return set(pks[bisect_left(values, value):bisect_right(values, value)])
+            elif filter_type == 'gt':
+                return set(pks[bisect_right(values, value):])
+            elif filter_type == 'gte':
+                return set(pks[bisect_left(values, value):])
+            elif filter_type == 'lt':
+                return set(pks[:bisect_left(values, value)])
+            elif filter_type == 'lte':
+                return set(pks[:bisect_right(values, value)])
+            else:
+                low, high = value
+                return set(pks[bisect_left(values, low):bisect_right(values, high)])
+        return None
+
+    def _updated_hash_indexes(self, snapshot, pk, previous, obj):
+        indexes = {}
+        for attr, index in snapshot.hash_indexes.items():
+            index = dict(index)
+            if previous != None:
+                key = _hashable(getattr(previous, attr, None))
+                remaining = index[key] - set([pk])
+                if remaining:
+                    index[key] = remaining
+                else:
+                    del index[key]
+            if obj != None:
+                key = _hashable(getattr(obj, attr, None))
+                index[key] = index.get(key, frozenset()) | set([pk])
+            indexes[attr] = index
+        return indexes
+
+    def _updated_sorted_indexes(self, snapshot, pk, previous, obj):
+        # None never matches a comparison, the same as NULL in SQL, so it is left out of sorted indexes
+        indexes = {}
+        for attr, (values, pks) in snapshot.sorted_indexes.items():
+            values = list(values)
+            pks = list(pks)
+            if previous != None and getattr(previous, attr, None) != None:
+                value = getattr(previous, attr)
+                low = bisect_left(values, value)
+                i = pks.index(pk, low, bisect_right(values, value))
+                del values[i]
+                del pks[i]
+            if obj != None and getattr(obj, attr, None) != None:
+                value = getattr(obj, attr)
+                i = bisect_right(values, value)
+                values.insert(i, value)
+                pks.insert(i, pk)
+            indexes[attr] = (values, pks)
+        return indexes
+
+
+def _hashable(value):
+    if isinstance(value, (list, set)):
+        return tuple(value)
+    return value
+
+
+def _matches(attr_value, filter_type, value):
+    if filter_type == 'exact':
+        return attr_value == value
+    elif filter_type == 'in':
+        return attr_value in value
+    elif filter_type == 'ne':
+        return attr_value != value
+    if attr_value == None:
+        return False
+    if filter_type == 'gt':
+        return attr_value > value
+    elif filter_type == 'gte':
+        return attr_value >= value
+    elif filter_type == 'lt':
+        return attr_value < value
+    elif filter_type == 'lte':
+        return attr_value <= value
+    elif filter_type == 'range':
+        return value[0] <= attr_value <= value[1]
+    elif filter_type == 'contains':
+        return value in attr_value
+    elif filter_type == 'icontains':
+        return value.lower() in attr_value.lower()
+    elif filter_type == 'startswith':
+        return attr_value.startswith(value)
+    elif filter_type == 'endswith':
+        return attr_value.endswith(value)
+    raise UnsupportedFilter("The %s filter is not supported" % filter_type)
+
+
+class InMemoryModelResource(BaseApiResource):
+    '''
+    A resource whose objects are kept in an InMemoryStore. It has the same endpoints and filter
+    syntax as DjangoModelResource, and fires the same ModelEvents, other than the ORM specific
+    adjust_orm_filters and chain_queryset.
+
+    A hash index is built for every field in Meta.filtering that allows exact, in or ne filters,
+    and a sorted index for every field that allows gt, gte, lt, lte or range filters.
+    model_class must have a pk attribute; pks that are not given are assigned from a counter.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(InMemoryModelResource, self).__init__(*args, **kwargs)
+        self.store = self.get_store()
+
+    def get_store(self):
+        '''
+        Override to plug in a different store. It must have the same interface as InMemoryStore.
+        '''
+        hash_indexes = []
+        sorted_indexes = []
+        for field_name, filter_types in self._meta.filtering.items():
+            field = self.field_by_name.get(field_name)
+            if field == None or field.obj_attr_name == 'pk':
+                continue
+            if [t for t in filter_types if t in HASH_FILTERS]:
+                hash_indexes.append(field.obj_attr_name)
+            if [t for t in filter_types if t in SORTED_FILTERS]:
+                sorted_indexes.append(field.obj_attr_name)
+        return InMemoryStore(hash_indexes, sorted_indexes)
+
+    def get_endpoints(self):
+        return [
+            EndPoint(
+                r"^(?P<resource_name>%s)/$" % self._meta.resource_name,
+                GET('paged_list', ArgFilters.all_from_query),
+                POST('create', ArgFilters.all_from_json),
+                ),
+            EndPoint(
+                r"^(?P<resource_name>%s)/(?P<pk>[0-9a-zA-Z\-_]+)/$" % self._meta.resource_name,
+                GET('get', ArgFilters.all_from_query),
+                PUT('update', ArgFilters.all_from_json),
+                DELETE('delete'),
+                ),
+        ]
+
+    def create(self, **kwargs):
+        obj = self.dict_to_obj(kwargs)
+        return self.create_object(obj)
+
+    def create_object(self, obj):
+        self.execute_handlers(ModelEvents.pre_save_prepare, obj)
+        self.execute_handlers(ModelEvents.pre_create_prepare, obj)
+
+        self.execute_handlers(ModelEvents.pre_save_validate, obj)
+        self.execute_handlers(ModelEvents.pre_create_validate, obj)
+
+        self.execute_handlers(ModelEvents.pre_process_save, obj)
+        self.execute_handlers(ModelEvents.pre_process_create, obj)
+
+        if getattr(obj, 'pk', None) == None:
+            obj.pk = self.store.next_pk()
+        self.store.put(obj)
+
+        self.execute_deferrable_handlers(ModelEvents.post_save, obj)
+        self.execute_deferrable_handlers(ModelEvents.post_create, obj)
+
+        return obj
+
+    def update(self, pk, **kwargs):
+        current = self.get(pk=pk)
+        if current == None:
+            raise UserError("Object not found for key %s" % pk, 404)
+        previous_data = {}
+        for name in kwargs.keys():
+            previous_data[name] = getattr(current, name, None)
+        obj = self.dict_to_obj(kwargs, current)
+
+        self.execute_handlers(ModelEvents.pre_save_prepare, obj)
+        self.execute_handlers(ModelEvents.pre_update_prepare, obj, previous_data)
+
+        self.execute_handlers(ModelEvents.pre_save_validate, obj)
+        self.execute_handlers(ModelEvents.pre_update_validate, obj, previous_data)
+
+        self.execute_handlers(ModelEvents.pre_process_save, obj)
+        self.execute_handlers(ModelEvents.pre_process_update, obj, previous_data)
+
+        self.store.put(obj)
+
+        self.execute_deferrable_handlers(ModelEvents.post_save, obj)
+        self.execute_deferrable_handlers(ModelEvents.post_update, obj, previous_data)
+
+        return obj
+
+    def delete(self, pk):
+        obj = self.get(pk=pk)
+        if not obj:
+            raise UserError("Object with key %s was not found, could not delete." % pk, 404)
+        self.execute_handlers(ModelEvents.delete_prepare, obj)
+        self.execute_handlers(ModelEvents.delete_validate, obj)
+        self.execute_handlers(ModelEvents.delete_process, obj)
+        self.store.delete(obj.pk)
+        self.execute_deferrable_handlers(ModelEvents.post_delete, obj)
+        return True
+
+    def get(self, **kwargs):
+        if kwargs.keys() == ['pk']:
+            obj = self.store.get(self._parse_pk(kwargs['pk']))
+            items = obj != None and [obj] or []
+        else:
+            items = self._list_and_count(limit=1, _include_total=False, **kwargs)
+        if items:
+            self.execute_handlers(ModelEvents.get_object, items[0])
+            return items[0]
+        else:
+            return None
+
+    def paged_list(self, offset=0, limit=20, **kwargs):
+        items, total = self._list_and_count(offset=int(offset), limit=int(limit), **kwargs)
+        data = {
+            'offset': int(offset),
+            'limit': int(limit),
+            'total_count': total,
+            'objects': self.obj_list_to_data(items)
+            }
+        return data
+
+    def list(self, **kwargs):
+        return self._list_and_count(_include_total=False, **kwargs)
+
+    def _list_and_count(self, offset=0, limit=None, _include_total=True, **kwargs):
+        try:
+            items = self.store.query(self._build_store_filters(kwargs))
+        except UnsupportedFilter, e:
+            raise UserError(str(e), 400)
+        total = len(items)
+        if limit != None:
+            items = items[offset:offset + limit]
+        items = self.execute_filters(ModelEvents.filter_objects, items)
+        items = list(items)
+        self.execute_handlers(ModelEvents.list_objects, items)
+        if _include_total:
+            return items, total
+        return items
+
+    def _build_store_filters(self, params):
+        filters = []
+        for field_name, filter_type, value in parse_filter_params(self, params):
+            if field_name == 'pk':
+                attr, parse = 'pk', self._parse_pk
+            else:
+                field = self.field_by_name[field_name]
+                attr, parse = field.obj_attr_name, field.parse_value
+            if filter_type == 'range' and len(value) != 2:
+                raise UserError("The range filter on %s needs two values" % field_name, 400)
+            try:
+                if filter_type in ('in', 'range'):
+                    value = [parse(item) for item in value]
+                elif value != None:
+                    value = parse(value)
+            except ValueError:
+                raise UserError("Invalid value %s for the field %s" % (value, field_name), 400)
+            filters.append((attr, filter_type, value))
+        return filters
+
+    def _parse_pk(self, pk):
+        # pks from urls are strings, while assigned pks are integers
+        if isinstance(pk, basestring) and pk.isdigit():
+            return int(pk)
+        return pk
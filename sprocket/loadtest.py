@@ -0,0 +1,414 @@
+'''
+An in-process load test for api resources. It calls Django's WSGI handler directly from a pool
+of threads or processes, with no web server or network in between, and reports latency
+percentiles, histograms, throughput and error rates for each endpoint.
+
+Register the resources to drive, then run:
+
+    from sprocket import loadtest
+    loadtest.register(contact_resource)
+    print loadtest.LoadTest(concurrency=8, requests_per_worker=200).run().format()
+
+or from the command line, naming modules that call register() when they are imported:
+
+    DJANGO_SETTINGS_MODULE=myproject.loadtest_settings python -m sprocket.loadtest myproject.loadtest_resources --concurrency 8
+
+Requests go to the database configured in settings, so point the settings at an SQLite database
+for this, or register InMemoryModelResources.
+'''
+from datetime import datetime, timedelta
+import math
+import multiprocessing
+from optparse import OptionParser
+import random
+import re
+from StringIO import StringIO
+import sys
+import threading
+import time
+import types
+
+from django.conf import settings
+from django.conf.urls.defaults import patterns, include
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+from django.utils import simplejson as json
+
+from .fields import IntegerField, DateTimeField, SimpleForeignKeyField
+
+# The api methods that are driven when register() is not told otherwise. Deletes are left out
+# so that the objects created during the run stay around for the get and update requests.
+DEFAULT_OPERATIONS = ('create', 'get', 'update', 'list', 'paged_list')
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, None)
+
+_group_re = re.compile(r'\(\?P<(\w+)>[^)]*\)')
+
+
+class Target(object):
+    '''
+    A resource registered for load testing.
+    '''
+    def __init__(self, resource, url_prefix, operations, payload_factory, pks):
+        self.resource = resource
+        self.url_prefix = url_prefix
+        self.payload_factory = payload_factory or synthetic_payload
+        self.pks = list(pks or ())
+        self.operations = self._find_operations(operations)
+
+    def _find_operations(self, operation_names):
+        operations = []
+        for endpoint in self.resource._get_all_endpoints():
+            for http_method, method_endpoint in sorted(endpoint.http_method_dict.items()):
+                name = method_endpoint.api_method_name
+                if not isinstance(name, basestring) or name not in operation_names:
+                    continue
+                path = self._path_template(endpoint.url_pattern)
+                if path != None:
+                    operations.append(Operation(self, http_method, name, path))
+        return operations
+
+    def _path_template(self, url_pattern):
+        '''
+        Turns a url pattern such as ^(?P<resource_name>contact)/(?P<pk>\d+)/$ into a path with a
+        %(pk)s placeholder, or returns None for patterns with other groups or regex syntax.
+        '''
+        def replace(match):
+            if match.group(1) == 'pk':
+                return '\1'
+            if match.group(1) == 'resource_name':
+                return self.resource._meta.resource_name
+            return '\0'
+        path = _group_re.sub(replace, url_pattern.lstrip('^').rstrip('$'))
+        path = re.sub(r'\\(.)', r'\1', path)
+        if re.search(r'[\0\[\]()*+?|{}]', path):
+            return None
+        return '/' + self.url_prefix + path.replace('%', '%%').replace('\1', '%(pk)s')
+
+
+class Operation(object):
+    def __init__(self, target, http_method, name, path):
+        self.target = target
+        self.http_method = http_method
+        self.name = name
+        self.path = path
+        self.needs_pk = '%(pk)s' in path
+        self.label = '%s %s %s' % (http_method, target.resource._meta.resource_name, name)
+
+
+def synthetic_payload(resource, rand):
+    '''
+    Makes up a value for each of the resource's fields, other than its primary key and foreign
+    keys, based on the type of the field.
+    '''
+    data = {}
+    for field in resource.fields:
+        if field.obj_attr_name in ('pk', 'id') or isinstance(field, SimpleForeignKeyField):
+            continue
+        if isinstance(field, IntegerField):
+            data[field.name] = rand.randint(1, 1000)
+        elif isinstance(field, DateTimeField):
+            value = datetime(2011, 1, 1) + timedelta(seconds=rand.randint(0, 86400 * 365))
+            data[field.name] = value.strftime(field.DATE_FORMAT)
+        else:
+            data[field.name] = 'loadtest-%08x' % rand.getrandbits(32)
+    return data
+
+
+_targets = []
+
+
+def register(resource, url_prefix='api/', operations=DEFAULT_OPERATIONS, payload_factory=None, pks=None):
+    '''
+    Registers a resource to be driven by load tests.
+
+    url_prefix - where the resource's urls are included, the load test mounts them there
+    operations - names of the api methods to call, such as 'get' or 'paged_list'
+    payload_factory - called with the resource and a random.Random to make the body of create
+        and update requests, defaults to synthetic_payload
+    pks - primary keys of existing objects, for get and update requests made before any
+        object was created
+    '''
+    target = Target(resource, url_prefix, operations, payload_factory, pks)
+    _targets.append(target)
+    return target
+
+
+def clear_registry():
+    del _targets[:]
+
+
+class EndpointStats(object):
+    def __init__(self, label):
+        self.label = label
+        self.latencies = []
+        self.statuses = {}
+
+    def add(self, seconds, status):
+        self.latencies.append(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def errors(self):
+        ''' Responses with a 4xx or 5xx status, and requests that raised '''
+        return sum([count for status, count in self.statuses.items() if status == None or status >= 400])
+
+    @property
+    def error_rate(self):
+        return float(self.errors) / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        ''' The latency in seconds that p percent of the requests were at or under '''
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = int(math.ceil(p / 100.0 * len(latencies))) - 1
+        return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+    def histogram(self):
+        ''' Returns (upper bound in ms or None, count) for each of HISTOGRAM_BUCKETS '''
+        counts = [0] * len(HISTOGRAM_BUCKETS)
+        for seconds in self.latencies:
+            ms = seconds * 1000
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if bound == None or ms <= bound:
+                    counts[i] += 1
+                    break
+        return zip(HISTOGRAM_BUCKETS, counts)
+
+
+class LoadTestReport(object):
+    def __init__(self, samples, elapsed, concurrency, mode):
+        self.elapsed = elapsed
+        self.concurrency = concurrency
+        self.mode = mode
+        self.endpoints = {}
+        for label, seconds, status in samples:
+            if label not in self.endpoints:
+                self.endpoints[label] = EndpointStats(label)
+            self.endpoints[label].add(seconds, status)
+
+    @property
+    def count(self):
+        return sum([stats.count for stats in self.endpoints.values()])
+
+    @property
+    def throughput(self):
+        ''' Requests per second over the whole run '''
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def format(self):
+        lines = ['%s requests in %.2fs from %s %s, %.1f requests/second' % (
+            self.count, self.elapsed, self.concurrency, self.mode, self.throughput)]
+        for label in sorted(self.endpoints):
+            stats = self.endpoints[label]
+            lines.append('')
+            lines.append('%s: %s requests, %.1f%% errors, p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms' % (
+                label, stats.count, stats.error_rate * 100, stats.percentile(50) * 1000,
+                stats.percentile(95) * 1000, stats.percentile(99) * 1000, max(stats.latencies) * 1000))
+            lines.append('  statuses: %s' % ', '.join(
+                ['%s: %s' % (status or 'raised', count) for status, count in sorted(stats.statuses.items())]))
+            histogram = stats.histogram()
+            largest = max([count for bound, count in histogram]) or 1
+            for bound, count in histogram:
+                bound_label = '<= %sms' % bound if bound != None else '>  %sms' % HISTOGRAM_BUCKETS[-2]
+                lines.append('  %10s %-40s %s' % (bound_label, '#' * int(40.0 * count / largest), count))
+        return '\n'.join(lines)
+
+
+class LoadTest(object):
+    '''
+    Runs requests against the registered resources from concurrency workers, each making
+    requests_per_worker requests, or as many as it can in duration seconds when duration is set.
+    With processes=True the workers are forked processes instead of threads, which takes the GIL
+    out of the measurement.
+    '''
+    def __init__(self, concurrency=4, requests_per_worker=100, duration=None, processes=False,
+                 targets=None, extra_environ=None, seed=None):
+        self.concurrency = concurrency
+        self.requests_per_worker = requests_per_worker
+        self.duration = duration
+        self.processes = processes
+        self.targets = targets if targets != None else list(_targets)
+        self.extra_environ = extra_environ or {}
+        self.seed = seed if seed != None else random.randint(0, sys.maxint)
+        self.handler = WSGIHandler()
+
+    def run(self):
+        if not self.targets:
+            raise ValueError("No resources are registered for the load test")
+        original_urlconf = settings.ROOT_URLCONF
+        settings.ROOT_URLCONF = self._build_urlconf()
+        try:
+            started = time.time()
+            if self.processes:
+                samples = self._run_processes()
+            else:
+                samples = self._run_threads()
+            elapsed = time.time() - started
+        finally:
+            settings.ROOT_URLCONF = original_urlconf
+        return LoadTestReport(samples, elapsed, self.concurrency, 'processes' if self.processes else 'threads')
+
+    def _build_urlconf(self):
+        urlconf = types.ModuleType('sprocket_loadtest_urls')
+        urlconf.urlpatterns = patterns('')
+        for target in self.targets:
+            urlconf.urlpatterns += patterns('', ('^' + target.url_prefix, include(target.resource.urls)))
+        return urlconf
+
+    def _run_threads(self):
+        results = [None] * self.concurrency
+        def work(index):
+            results[index] = self.run_worker(index)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        samples = []
+        for worker_samples in results:
+            samples.extend(worker_samples or [])
+        return samples
+
+    def _run_processes(self):
+        global _running_load_test
+        # Forked children must not share the parent's database connections
+        for connection in connections.all():
+            connection.close()
+        _running_load_test = self
+        pool = multiprocessing.Pool(self.concurrency)
+        try:
+            results = pool.map(_run_worker_in_process, range(self.concurrency))
+        finally:
+            pool.close()
+            pool.join()
+            _running_load_test = None
+        samples = []
+        for worker_samples in results:
+            samples.extend(worker_samples)
+        return samples
+
+    def run_worker(self, index):
+        '''
+        Makes one worker's requests, cycling through the operations of every target in a random
+        order. Returns (operation label, seconds, status) samples, with a status of None for
+        requests that raised.
+        '''
+        rand = random.Random(self.seed + index)
+        operations = [operation for target in self.targets for operation in target.operations]
+        pks = dict([(target, list(target.pks)) for target in self.targets])
+        deadline = time.time() + self.duration if self.duration else None
+        samples = []
+        made = 0
+        while True:
+            rand.shuffle(operations)
+            progressed = False
+            for operation in operations:
+                if deadline != None and time.time() >= deadline:
+                    return samples
+                if deadline == None and made >= self.requests_per_worker:
+                    return samples
+                target_pks = pks[operation.target]
+                if operation.needs_pk and not target_pks:
+                    continue
+                path = operation.path % {'pk': rand.choice(target_pks)} if operation.needs_pk else operation.path
+                body = ''
+                if operation.http_method in ('POST', 'PUT'):
+                    body = json.dumps(operation.target.payload_factory(operation.target.resource, rand))
+                started = time.time()
+                try:
+                    status, content = self.request(operation.http_method, path, body)
+                except Exception:
+                    status, content = None, ''
+                samples.append((operation.label, time.time() - started, status))
+                made += 1
+                progressed = True
+                if operation.name == 'create' and status == 200:
+                    pk = _pk_from_response(content)
+                    if pk != None:
+                        target_pks.append(pk)
+            if not progressed:
+                return samples
+
+    def request(self, method, path, body='', query_string=''):
+        ''' Calls the WSGI handler directly, returning the status code and the response body '''
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': query_string,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': 'loadtest',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': not self.processes,
+            'wsgi.multiprocess': self.processes,
+            'wsgi.run_once': False,
+        }
+        environ.update(self.extra_environ)
+        status_lines = []
+        def start_response(status, headers, exc_info=None):
+            status_lines.append(status)
+        response = self.handler(environ, start_response)
+        try:
+            content = ''.join(response)
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        return int(status_lines[0].split(' ', 1)[0]), content
+
+
+_running_load_test = None
+
+
+def _run_worker_in_process(index):
+    return _running_load_test.run_worker(index)
+
+
+def _pk_from_response(content):
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        return data.get('id', data.get('pk'))
+    return None
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] module [module ...]\n\n'
+        'Imports the modules, which should register resources with sprocket.loadtest.register(), '
+        'and runs a load test against them.')
+    parser.add_option('-c', '--concurrency', type='int', default=4, help='number of workers')
+    parser.add_option('-n', '--requests', type='int', default=100, help='requests made by each worker')
+    parser.add_option('-d', '--duration', type='float', help='run for this many seconds instead')
+    parser.add_option('-p', '--processes', action='store_true', default=False, help='use processes instead of threads')
+    parser.add_option('-s', '--seed', type='int', help='seed for the synthetic payloads')
+    options, modules = parser.parse_args(argv)
+    if not modules:
+        parser.error("Name at least one module that registers resources")
+    for module in modules:
+        __import__(module)
+    load_test = LoadTest(
+        concurrency=options.concurrency,
+        requests_per_worker=options.requests,
+        duration=options.duration,
+        processes=options.processes,
+        seed=options.seed)
+    print load_test.run().format()
+
+
+if __name__ == '__main__':
+    main()
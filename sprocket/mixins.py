@@ -1,19 +1,59 @@
+import types
 
+from .utils import class_attributes
 
 
+def batch_capable(handler):
+    '''
+    Marks an obj_to_dict handler whose work the obj_list_to_dicts handler of the same mixin also
+    does, for a whole list of objects at once. Lists are then serialized without calling it for
+    each object; a single object still is.
+
+        class TagsMixin(BaseMixin):
+            @batch_capable
+            def on_obj_to_dict(self, obj, data):
+                self.on_obj_list_to_dicts([obj], [data])
+
+            def on_obj_list_to_dicts(self, objects, dicts):
+                tags = load_tags([obj.pk for obj in objects])
+                for obj, data in zip(objects, dicts):
+                    data['tags'] = tags.get(obj.pk, [])
+    '''
+    handler.batch_capable = True
+    return handler
+
+
+class MixinType(type):
+    '''
+    Finds a mixin class's event handlers, and the public methods that get merged into its api
+    resource, once when the class is created instead of every time a mixin is instantiated.
+    '''
+    def __init__(cls, name, bases, attrs):
+        super(MixinType, cls).__init__(name, bases, attrs)
+        handler_attr_names = {}
+        mergeable_method_names = []
+        for attr_name, attr in class_attributes(cls).items():
+            if attr_name.startswith('on_'):
+                handler_attr_names[attr_name[3:]] = attr_name
+            elif attr_name.startswith('_') or attr_name == 'get_endpoints':
+                continue
+            elif isinstance(attr, (types.FunctionType, classmethod)):
+                mergeable_method_names.append(attr_name)
+        cls._handler_attr_names = handler_attr_names
+        cls._mergeable_method_names = tuple(sorted(mergeable_method_names))
 
 
 class BaseMixin(object):
+    __metaclass__ = MixinType
+
     def __init__(self, api_resource):
         self.api = api_resource
         self.event_handler_by_event_name = self._construct_events_dict()
         
     def _construct_events_dict(self):
         handlers_by_name = {}
-        for attr_name in dir(self):
-            if attr_name.startswith('on_'):
-                event_name = attr_name[3:]
-                handlers_by_name[event_name] = getattr(self, attr_name)
+        for event_name, attr_name in self._handler_attr_names.items():
+            handlers_by_name[event_name] = getattr(self, attr_name)
         return handlers_by_name
 
     def get_handler_for_event(self, event_name):
@@ -0,0 +1,159 @@
+'''
+Profiling single requests. A profiled request runs under cProfile, and optionally tracemalloc,
+and the results are written to a ProfileRing, a directory that keeps only the most recent
+profiles. tracemalloc is part of Python 3, and available for Python 2 as the pytracemalloc
+package; without it only CPU profiles are taken.
+
+Read a profile with:
+
+    python -c "import pstats; pstats.Stats('<file>.prof').sort_stats('cumulative').print_stats(30)"
+'''
+import cProfile
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PROFILE_SUFFIX = '.prof'
+MEMORY_SUFFIX = '.memory.txt'
+
+
+class ProfileRing(object):
+    '''
+    Writes profiles to a directory, deleting the oldest once there are more than max_profiles.
+    File names start with the time in milliseconds, then the process id, so they sort oldest
+    first, followed by a tag naming the resource, endpoint and HTTP method.
+    '''
+    def __init__(self, directory, max_profiles=100):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def save(self, tag, profiler, memory_stats=None):
+        '''
+        Writes the profile, and the memory statistics if there are any, and returns the name the
+        files share, without their suffix.
+        '''
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another thread or process created it first
+                pass
+        name = '%013d-%d-%d-%s' % (time.time() * 1000, os.getpid(), sequence, _safe_tag(tag))
+        profiler.dump_stats(os.path.join(self.directory, name + PROFILE_SUFFIX))
+        if memory_stats != None:
+            f = open(os.path.join(self.directory, name + MEMORY_SUFFIX), 'w')
+            try:
+                f.write('\n'.join([str(stat) for stat in memory_stats]))
+            finally:
+                f.close()
+        self._trim()
+        return name
+
+    def profiles(self):
+        ''' The names of the saved profiles, oldest first '''
+        return sorted([
+            file_name[:-len(PROFILE_SUFFIX)] for file_name in os.listdir(self.directory)
+            if file_name.endswith(PROFILE_SUFFIX)])
+
+    def _trim(self):
+        for name in self.profiles()[:-self.max_profiles]:
+            for suffix in (PROFILE_SUFFIX, MEMORY_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except OSError:
+                    # Deleted by another process trimming at the same time, or never written
+                    pass
+
+
+def _safe_tag(tag):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', tag)
+
+
+_default_ring = None
+_default_ring_lock = threading.Lock()
+
+
+def get_default_ring():
+    '''
+    The ring used by resources that do not set ResourceMeta.profile_ring. Configured by
+    settings.SPROCKET_PROFILE_DIR, by default a sprocket-profiles directory in the system's
+    temporary directory, and SPROCKET_PROFILE_MAX_FILES, 100 by default.
+    '''
+    global _default_ring
+    if _default_ring == None:
+        with _default_ring_lock:
+            if _default_ring == None:
+                _default_ring = ProfileRing(
+                    getattr(settings, 'SPROCKET_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'sprocket-profiles')),
+                    getattr(settings, 'SPROCKET_PROFILE_MAX_FILES', 100))
+    return _default_ring
+
+
+class Capture(object):
+    '''
+    Profiles the code run inside a with block with cProfile, which only sees the current thread.
+    With trace_memory and tracemalloc installed, also records the lines that allocated the most
+    memory in the block. Those are process wide, so they include allocations other threads made
+    at the same time.
+    '''
+    def __init__(self, trace_memory=False, memory_stats_limit=50):
+        self.trace_memory = trace_memory and tracemalloc != None
+        self.memory_stats_limit = memory_stats_limit
+        self.profiler = cProfile.Profile()
+        self.memory_stats = None
+        self._before = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            _start_tracing()
+            self._before = tracemalloc.take_snapshot()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profiler.disable()
+        if self._before != None:
+            after = tracemalloc.take_snapshot()
+            self.memory_stats = after.compare_to(self._before, 'lineno')[:self.memory_stats_limit]
+            self._before = None
+            _stop_tracing()
+        return False
+
+
+# Captures running at the same time in different threads share tracemalloc, which is only
+# stopped once the last of them is done, and left alone if something else started it
+_tracing_lock = threading.Lock()
+_tracing_captures = 0
+_started_tracing = False
+
+
+def _start_tracing():
+    global _tracing_captures, _started_tracing
+    with _tracing_lock:
+        if _tracing_captures == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_captures += 1
+
+
+def _stop_tracing():
+    global _tracing_captures, _started_tracing
+    with _tracing_lock:
+        _tracing_captures -= 1
+        if _tracing_captures == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
@@ -0,0 +1,88 @@
+import re
+
+from django.conf import settings
+from django.db import connections
+
+
+class QueryCounter(object):
+    '''
+    Records the SQL queries made on every configured database while it is active.
+    Use as a context manager:
+
+        with QueryCounter() as counter:
+            ...
+        counter.count, counter.total_time, counter.repeated_shapes(3)
+
+    Query recording is switched on for the duration even when DEBUG is off, and anything
+    that was recorded only because of the counter is removed again afterwards so that
+    connection.queries does not grow without bound in production.
+    '''
+    def __init__(self, aliases=None):
+        self.aliases = aliases
+        self.queries = []
+        self._starts = []
+
+    def __enter__(self):
+        self.queries = []
+        self._starts = []
+        for connection in self._get_connections():
+            was_recording = connection.use_debug_cursor or \
+                (connection.use_debug_cursor is None and settings.DEBUG)
+            self._starts.append((connection, len(connection.queries), connection.use_debug_cursor, was_recording))
+            connection.use_debug_cursor = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for connection, start, use_debug_cursor, was_recording in self._starts:
+            self.queries.extend(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+            if not was_recording:
+                del connection.queries[start:]
+        self._starts = []
+        return False
+
+    def _get_connections(self):
+        aliases = self.aliases
+        if aliases == None:
+            aliases = list(connections)
+        return [connections[alias] for alias in aliases]
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        ''' Total time spent in the database, in seconds '''
+        return sum([float(query['time']) for query in self.queries])
+
+    def repeated_shapes(self, threshold):
+        '''
+        Returns a list of (shape, count) for every query shape that ran at least threshold times,
+        most repeated first. A shape repeated once per serialized object is the signature of an
+        N+1 pattern.
+        '''
+        counts = {}
+        for query in self.queries:
+            shape = normalize_sql(query['sql'])
+            counts[shape] = counts.get(shape, 0) + 1
+        repeated = [(shape, count) for shape, count in counts.items() if count >= threshold]
+        repeated.sort(key=lambda item: item[1], reverse=True)
+        return repeated
+
+
+_string_literal_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list_re = re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE)
+_whitespace_re = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    '''
+    Reduces a query to its shape by replacing literal values with placeholders, so that
+    queries that differ only by their parameters compare equal.
+    '''
+    sql = _string_literal_re.sub('?', sql)
+    sql = _number_re.sub('?', sql)
+    sql = _in_list_re.sub('IN (...)', sql)
+    return _whitespace_re.sub(' ', sql).strip()
@@ -0,0 +1,138 @@
+'''
+Logging requests that take longer than a threshold, with a breakdown of where the time went.
+Records are handed to a background thread through a bounded queue and logged as JSON to the
+'sprocket.slow_requests' logger, so a slow request is not made slower by logging it. When the
+queue is full, records are dropped and counted rather than waited for.
+'''
+import logging
+import Queue
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.utils import simplejson as json
+
+logger = logging.getLogger('sprocket.slow_requests')
+
+# Keyword arguments, and keys of the dicts in them, are logged as '<redacted>' when a word of
+# their name matches this. Names are split into words at underscores, dashes and camelCase humps,
+# so 'api_key' and 'authToken' match while 'author' does not.
+SENSITIVE_NAMES = re.compile(
+    r'^(pass(word|wd|phrase|code)?|pwd|secrets?|(api)?keys?|(access|refresh)?tokens?|'
+    r'auth(orization|entication)?|credentials?|cards?|cvv|ssn)$')
+MAX_VALUE_LENGTH = 200
+MAX_LIST_ITEMS = 20
+
+
+class StageTimer(object):
+    '''
+    Records how long each stage of handling a request took. mark(stage) closes the stage that
+    started when the previous one ended.
+    '''
+    def __init__(self):
+        self.started = self._last = time.time()
+        self.stages = []
+        self.kwargs = None
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+
+def sanitize_kwargs(kwargs):
+    '''
+    A copy of kwargs that is safe to log: secrets redacted, also within nested dicts and lists,
+    and long values and lists cut short
+    '''
+    sanitized = {}
+    for name, value in kwargs.items():
+        if not isinstance(name, basestring):
+            name = repr(name)
+        if is_sensitive_name(name):
+            sanitized[name] = '<redacted>'
+        else:
+            sanitized[name] = _sanitize_value(value)
+    return sanitized
+
+
+def is_sensitive_name(name):
+    words = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+    return any(SENSITIVE_NAMES.match(word) for word in re.split(r'[^a-z0-9]+', words))
+
+
+def _sanitize_value(value):
+    if value == None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, dict):
+        return sanitize_kwargs(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_sanitize_value(item) for item in list(value)[:MAX_LIST_ITEMS]]
+        if len(value) > MAX_LIST_ITEMS:
+            items.append('<%s more>' % (len(value) - MAX_LIST_ITEMS))
+        return items
+    if not isinstance(value, basestring):
+        value = repr(value)
+    if len(value) > MAX_VALUE_LENGTH:
+        value = value[:MAX_VALUE_LENGTH] + '...'
+    return value
+
+
+class SlowRequestLog(object):
+    '''
+    Logs records on a daemon thread, started on first use.
+    '''
+    def __init__(self, max_queue_size=1000):
+        self._queue = Queue.Queue(max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def log(self, record):
+        if self._thread == None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        ''' Waits until every record queued so far has been logged, for tests '''
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread == None:
+                thread = threading.Thread(target=self._work, name='sprocket-slow-requests')
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _work(self):
+        while True:
+            record = self._queue.get()
+            try:
+                logger.warning("Slow request: %s", json.dumps(record), extra={'slow_request': record})
+            except Exception:
+                logger.exception("Could not log a slow request")
+            finally:
+                self._queue.task_done()
+
+
+_default_log = None
+_default_log_lock = threading.Lock()
+
+
+def get_default_log():
+    ''' Sized by settings.SPROCKET_SLOW_REQUEST_QUEUE_SIZE, 1000 by default '''
+    global _default_log
+    if _default_log == None:
+        with _default_log_lock:
+            if _default_log == None:
+                _default_log = SlowRequestLog(getattr(settings, 'SPROCKET_SLOW_REQUEST_QUEUE_SIZE', 1000))
+    return _default_log
@@ -0,0 +1,121 @@
+'''
+Measures how long it takes to construct api resources, which is what dominates process
+startup and URLconf import for projects with many resources.
+
+Run with:
+
+    DJANGO_SETTINGS_MODULE=sprocket.test.settings_for_tests python -m sprocket.test.benchmark_startup
+'''
+import time
+
+from ..base_resource import BaseApiResource, ResourceMeta, EndPoint, ArgFilters, GET, POST, PUT
+from ..mixins import BaseMixin
+
+
+RESOURCE_COUNT = 300
+ROUNDS = 5
+
+
+class AuditMixin(BaseMixin):
+    def on_post_save(self, obj):
+        pass
+
+    def on_obj_to_dict(self, obj, data):
+        pass
+
+    def audit_log(self, obj):
+        pass
+
+    def audit_entries(self, pk):
+        return []
+
+
+class SoftDeleteMixin(BaseMixin):
+    def get_endpoints(self):
+        return [
+            EndPoint(
+                r"^(?P<resource_name>%s)/(?P<pk>[\d]+)/soft-delete$" % self.api._meta.resource_name,
+                POST('soft_delete'))
+            ]
+
+    def on_chain_queryset(self, queryset):
+        return queryset
+
+    def soft_delete(self, pk):
+        return True
+
+    def undelete(self, pk):
+        return True
+
+
+class BenchmarkResource(BaseApiResource):
+    class Meta(ResourceMeta):
+        resource_name = 'benchmark-resource'
+
+    def get_endpoints(self):
+        return [
+            EndPoint(
+                r"^(?P<resource_name>%s)$" % self._meta.resource_name,
+                GET('list', ArgFilters.fields_from_query),
+                POST('create', ArgFilters.fields_from_json)
+                ),
+            EndPoint(
+                r"^(?P<resource_name>%s)/(?P<pk>[\d]+)$" % self._meta.resource_name,
+                GET('get', ArgFilters.fields_from_query),
+                PUT('update', ArgFilters.fields_from_json)
+                ),
+            ]
+
+    def get_mixins(self):
+        return [AuditMixin(self), SoftDeleteMixin(self)]
+
+    def on_authenticate(self, request):
+        pass
+
+    def list(self, **kwargs):
+        return []
+
+    def get(self, pk):
+        return None
+
+
+def _make_resource_classes(count):
+    classes = []
+    for i in range(count):
+        meta = type('Meta', (ResourceMeta,), {'resource_name': 'benchmark-resource-%s' % i})
+        classes.append(type('BenchmarkResource%s' % i, (BenchmarkResource,), {'Meta': meta}))
+    return classes
+
+
+def run(resource_count=RESOURCE_COUNT, rounds=ROUNDS):
+    started = time.time()
+    classes = _make_resource_classes(resource_count)
+    class_creation = time.time() - started
+
+    timings = []
+    for i in range(rounds):
+        started = time.time()
+        for cls in classes:
+            cls()
+        timings.append(time.time() - started)
+    best = min(timings)
+
+    # Mixin discovery and merging on its own, without the cost of compiling url patterns
+    resources = [cls() for cls in classes]
+    merge_timings = []
+    for i in range(rounds):
+        started = time.time()
+        for resource in resources:
+            resource._merge_in_mixins()
+        merge_timings.append(time.time() - started)
+    best_merge = min(merge_timings)
+
+    print "Created %s resource classes in %.1fms" % (resource_count, class_creation * 1000)
+    print "Instantiated %s resources in %.1fms (best of %s), %.1fus per resource" % (
+        resource_count, best * 1000, rounds, best * 1000000 / resource_count)
+    print "Merged in mixins for %s resources in %.1fms (best of %s), %.1fus per resource" % (
+        resource_count, best_merge * 1000, rounds, best_merge * 1000000 / resource_count)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,19 +1,32 @@
 from datetime import datetime
+import gzip
 import inspect
+import logging
+import os
+import pstats
+import shutil
+from StringIO import StringIO
+import tempfile
+import threading
 import time
+import zlib
 from unittest import TestCase
 
 from django.conf import settings
 from django.conf.urls.defaults import patterns, include, url
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.utils import simplejson
 
 from mocking_bird.mocking import MockingBirdMixin
 
+from .. import formats
+from ..profiling import ProfileRing
+from ..slow_requests import SlowRequestLog, sanitize_kwargs
 from ..mixins import BaseMixin
 from ..auth import NoAuthentication
 from ..fields import DateTimeField, ApiField
-from ..base_resource import BaseApiResource, ResourceMeta, EndPoint, ArgFilters, POST, PUT, GET, UserError, UnauthenticatedError
+from ..coalescing import SingleFlight
+from ..base_resource import BaseApiResource, ResourceMeta, EndPoint, ArgFilters, POST, PUT, GET, UserError, UnauthenticatedError, _thread_local, request_context
 
 
 class SimpleCase(TestCase, MockingBirdMixin):
@@ -110,6 +123,86 @@ class SimpleCase(TestCase, MockingBirdMixin):
         # Verify the soft-delete worked
         self.assertTrue(data['deleted'] == True)
 
+    def test_compression(self):
+        c = Client()
+
+        post_data = simplejson.dumps({'label': 'ATestLabel' * 20, 'nicknames': ['jack'] * 20})
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzip_file.write(post_data)
+        gzip_file.close()
+        r = c.post(
+            '/api/simple-resource',
+            data=buf.getvalue(),
+            content_type='application/json',
+            HTTP_CONTENT_ENCODING='gzip')
+        self.assertEquals(200, r.status_code)
+        self.assertFalse(r.has_header('Content-Encoding'))
+        pk = simplejson.loads(r.content)['pk']
+
+        r = c.get('/api/simple-resource/%s' % pk, HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals('deflate', r['Content-Encoding'])
+        self.assertTrue('Accept-Encoding' in r['Vary'])
+        data = simplejson.loads(zlib.decompress(r.content))
+        self.assertEquals('ATestLabel' * 20, data['label'])
+
+        r = c.get('/api/simple-resource/%s' % pk, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(r.has_header('Content-Encoding'))
+
+        r = c.post(
+            '/api/simple-resource',
+            data='not gzip',
+            content_type='application/json',
+            HTTP_CONTENT_ENCODING='gzip')
+        self.assertEquals(400, r.status_code)
+
+    def test_columnar_format(self):
+        c = Client()
+        for label in ('first', 'second'):
+            c.post(
+                '/api/simple-resource',
+                data=simplejson.dumps({'label': label}),
+                content_type='application/json')
+            # Primary keys are millisecond timestamps
+            time.sleep(0.002)
+
+        r = c.get('/api/simple-resource?format=columnar')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals('application/vnd.sprocket.columnar+json', r['Content-Type'])
+        data = simplejson.loads(r.content)
+        self.assertEquals(2, len(data['rows']))
+        label_index = data['fields'].index('label')
+        self.assertEquals(set(['first', 'second']), set([row[label_index] for row in data['rows']]))
+
+        r = c.get('/api/simple-resource', HTTP_ACCEPT='application/vnd.sprocket.columnar+json')
+        self.assertEquals(data, simplejson.loads(r.content))
+
+        columnar = simplejson.dumps({'fields': ['label', 'city'], 'rows': [['a', 'Boston'], ['b', None]]})
+        self.assertEquals(
+            [{'label': 'a', 'city': 'Boston'}, {'label': 'b', 'city': None}],
+            formats.decode(columnar, formats.COLUMNAR))
+
+        # Strings are sent as they are, and True as a JSON body, so both stay labelled as JSON
+        pk = data['rows'][0][data['fields'].index('pk')]
+        r = c.get('/api/simple-resource/%s/label?format=columnar' % pk)
+        self.assertEquals('application/json', r['Content-Type'])
+        self.assertTrue(simplejson.loads(r.content) in ('first', 'second'))
+        r = c.post('/api/simple-resource/%s/soft-delete?format=columnar' % pk)
+        self.assertEquals('application/json', r['Content-Type'])
+        self.assertEquals(True, simplejson.loads(r.content)['succeeded'])
+
+        self.assertEquals(formats.MSGPACK, formats.format_from_content_type(
+            'application/json;q=0.5, application/x-msgpack'))
+        self.assertEquals(formats.JSON, formats.format_from_content_type(
+            'application/x-msgpack;q=0, application/json'))
+        self.assertEquals(None, formats.format_from_content_type('application/x-msgpack; q=0'))
+
+    def test_mixin_methods_are_bound_to_the_mixin(self):
+        mixin = simple_resource.mixins_by_name['DeletedUpdatedMixin']
+        self.assertTrue(simple_resource.soft_delete.im_self is mixin)
+        self.assertEquals(['self', 'pk'], inspect.getargspec(simple_resource.soft_delete).args)
+
     def test_error_handling(self):
         c = Client()
 
@@ -141,6 +234,168 @@ class SimpleCase(TestCase, MockingBirdMixin):
         r = c.get('/api/simple-resource/%s?denyMe=true' % obj_data['pk'])
         self.assertEquals(403, r.status_code)
 
+    def test_concurrent_requests_keep_their_own_state(self):
+        factory = RequestFactory()
+        view = echo_resource.wrap(echo_resource.get_endpoints()[0])
+        failures = []
+        def work(thread_index):
+            for i in range(50):
+                n = thread_index * 1000 + i
+                response = view(factory.get('/api/echo/%s' % n), resource_name='echo', n=str(n))
+                if (response.status_code != 200 + n % 3 or response['X-Echo'] != str(n)
+                        or simplejson.loads(response.content)['n'] != n):
+                    failures.append(n)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([], failures)
+
+        # Every thread starts without a current request, not only the one that imported the module
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(_thread_local.current))
+        thread.start()
+        thread.join()
+        self.assertEquals([None], seen)
+
+        # Outside of a request, nothing set on thread_current leaks into later calls
+        echo_resource.set_response_header('X-Outside', '1')
+        self.assertEquals({}, echo_resource.thread_current.response_headers)
+        self.assertEquals(None, _thread_local.current)
+        with request_context(RequestFactory().get('/api/echo/1')) as current:
+            echo_resource.set_response_header('X-Inside', '1')
+            self.assertEquals({'x-inside': '1'}, current.response_headers)
+        self.assertEquals(None, _thread_local.current)
+
+    def test_coalescing(self):
+        factory = RequestFactory()
+        view = echo_resource.wrap(echo_resource.get_endpoints()[1])
+        EchoResource.gate = threading.Event()
+        EchoResource.gated_calls = []
+        responses = []
+        def work(n):
+            responses.append(view(factory.get('/api/echo/gated/%s' % n), resource_name='echo', n=n))
+        threads = [threading.Thread(target=work, args=('7',)) for i in range(6)]
+        threads.append(threading.Thread(target=work, args=('8',)))
+        try:
+            for thread in threads:
+                thread.start()
+            # Wait until both api methods are running and the other five requests wait for the first
+            deadline = time.time() + 5
+            while (len(EchoResource.gated_calls) < 2 or echo_resource._single_flight.waiting() < 5) \
+                    and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertEquals(5, echo_resource._single_flight.waiting())
+        finally:
+            EchoResource.gate.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals(['7', '8'], sorted(EchoResource.gated_calls))
+        self.assertEquals(7, len(responses))
+        for response in responses:
+            n = simplejson.loads(response.content)['n']
+            self.assertEquals(str(n), response['X-Echo'])
+            self.assertEquals(200, response.status_code)
+        self.assertEquals([7] * 6 + [8], sorted([simplejson.loads(r.content)['n'] for r in responses]))
+        self.assertEquals(0, echo_resource._single_flight.in_flight())
+
+    def test_single_flight_timeout(self):
+        single_flight = SingleFlight()
+        gate = threading.Event()
+        results = []
+        def slow():
+            gate.wait(5)
+            return 'leader'
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', slow)))
+        leader.start()
+        try:
+            deadline = time.time() + 5
+            while single_flight.in_flight() < 1 and time.time() < deadline:
+                time.sleep(0.001)
+            # A caller that gives up waiting runs the function itself
+            self.assertEquals(('waiter', True), single_flight.do('key', lambda: 'waiter', 0.01))
+        finally:
+            gate.set()
+            leader.join()
+        self.assertEquals([('leader', True)], results)
+        self.assertEquals(0, single_flight.waiting())
+
+    def test_profiling(self):
+        factory = RequestFactory()
+        directory = tempfile.mkdtemp()
+        endpoint = echo_resource.get_endpoints()[0]
+        view = echo_resource.wrap(endpoint)
+        echo_resource._meta.profile_ring = ProfileRing(directory, max_profiles=2)
+        settings.SPROCKET_PROFILE_TOKEN = 'letmein'
+        try:
+            response = view(factory.get('/api/echo/1'), resource_name='echo', n='1')
+            self.assertFalse(response.has_header('X-Sprocket-Profile'))
+
+            response = view(factory.get('/api/echo/1', HTTP_X_SPROCKET_PROFILE='wrong'), resource_name='echo', n='1')
+            self.assertFalse(response.has_header('X-Sprocket-Profile'))
+
+            response = view(factory.get('/api/echo/1', HTTP_X_SPROCKET_PROFILE='letmein'), resource_name='echo', n='1')
+            name = response['X-Sprocket-Profile']
+            self.assertTrue(name.endswith('-echo-echo-GET'))
+            stats = pstats.Stats(os.path.join(directory, name + '.prof'))
+            self.assertTrue([key for key in stats.stats if key[2] == 'echo'])
+
+            endpoint.profile_sample_rate = 1.0
+            for i in range(3):
+                response = view(factory.get('/api/echo/1'), resource_name='echo', n='1')
+                self.assertTrue(response.has_header('X-Sprocket-Profile'))
+            # Only the newest profiles are kept
+            self.assertEquals(2, len(os.listdir(directory)))
+            self.assertEquals(response['X-Sprocket-Profile'], echo_resource._meta.profile_ring.profiles()[-1])
+        finally:
+            del settings.SPROCKET_PROFILE_TOKEN
+            echo_resource._meta.profile_ring = None
+            shutil.rmtree(directory)
+
+    def test_slow_request_log(self):
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.slow_request)
+        handler = Handler()
+        logging.getLogger('sprocket.slow_requests').addHandler(handler)
+        factory = RequestFactory()
+        endpoint = echo_resource.get_endpoints()[0]
+        view = echo_resource.wrap(endpoint)
+        log = echo_resource._meta.slow_request_log = SlowRequestLog()
+        try:
+            view(factory.get('/api/echo/7'), resource_name='echo', n='7')
+            endpoint.slow_request_threshold = 0
+            view(factory.get('/api/echo/7'), resource_name='echo', n='7')
+            log.flush()
+        finally:
+            echo_resource._meta.slow_request_log = None
+            logging.getLogger('sprocket.slow_requests').removeHandler(handler)
+
+        self.assertEquals(1, len(records))
+        record = records[0]
+        self.assertEquals('echo', record['resource'])
+        self.assertEquals(endpoint.url_pattern, record['url_pattern'])
+        self.assertEquals('echo', record['api_method'])
+        self.assertEquals(201, record['status_code'])
+        self.assertEquals({'n': '7'}, record['kwargs'])
+        self.assertEquals(
+            set(['auth', 'arg_filters', 'api_method', 'serialization', 'response_handlers']),
+            set(record['stages_ms'].keys()))
+        self.assertTrue(record['stages_ms']['api_method'] >= 0.5)
+
+        self.assertEquals(
+            {'password': '<redacted>', 'label': 'x' * 200 + '...', 'ids': range(20) + ['<5 more>']},
+            sanitize_kwargs({'password': 'hunter2', 'label': 'x' * 300, 'ids': range(25)}))
+        # Secrets are found by the words of their names, also in nested dicts and lists
+        self.assertEquals(
+            {'author': 'ann', 'apiKey': '<redacted>', 'user': {'name': 'ann', 'auth_token': '<redacted>'},
+             'rows': [{'monkey': 1, 'Password': '<redacted>'}]},
+            sanitize_kwargs({'author': 'ann', 'apiKey': 'k', 'user': {'name': 'ann', 'auth_token': 't'},
+                             'rows': [{'monkey': 1, 'Password': 'p'}]}))
+
     url_conf = 'sprocket.test.test_base_resource'
 
     def setUp(self):
@@ -174,6 +429,8 @@ class SimpleResource(BaseApiResource):
     class Meta(ResourceMeta):
         resource_name = 'simple-resource'
         model_class = SimpleObject
+        compress_responses = True
+        compression_min_size = 100
 
     def on_init_fields(self, fields):
         for name in dir(SimpleObject):
@@ -200,6 +457,10 @@ class SimpleResource(BaseApiResource):
                 GET('get', ArgFilters.fields_from_query),
                 PUT('update', ArgFilters.fields_from_json)
                 ),
+            EndPoint(
+                r"^(?P<resource_name>%s)/(?P<pk>[\d]+)/label$" % self._meta.resource_name,
+                GET('get_label')
+                ),
             ]
         return endpoints
 
@@ -220,6 +481,9 @@ class SimpleResource(BaseApiResource):
         o = self._storage[long(pk)]
         return o
 
+    def get_label(self, pk):
+        return simplejson.dumps(self.get(pk).label)
+
     def list(self, **kwargs):
         items = []
         for item in self._storage.values():
@@ -269,7 +533,45 @@ class DeletedUpdatedMixin(BaseMixin):
         return True
 
 
+class EchoResource(BaseApiResource):
+    class Meta(ResourceMeta):
+        resource_name = 'echo'
+
+    def get_endpoints(self):
+        return [
+            EndPoint(
+                r"^(?P<resource_name>%s)/(?P<n>[\d]+)$" % self._meta.resource_name,
+                GET('echo')
+                ),
+            EndPoint(
+                r"^(?P<resource_name>%s)/gated/(?P<n>[\d]+)$" % self._meta.resource_name,
+                GET('gated_echo'),
+                coalesce=True
+                ),
+            ]
+
+    def on_authenticate(self, request):
+        pass
+
+    def echo(self, n):
+        self.set_response_header('X-Echo', n)
+        self.set_current_status_code(200 + int(n) % 3)
+        # Give other threads a chance to run between setting request state and using it
+        time.sleep(0.0005)
+        return {'n': int(n)}
+
+    gate = threading.Event()
+    gated_calls = []
+
+    def gated_echo(self, n):
+        self.gated_calls.append(n)
+        self.gate.wait(5)
+        self.set_response_header('X-Echo', n)
+        return {'n': int(n)}
+
+
 simple_resource = SimpleResource()
+echo_resource = EchoResource()
 urlpatterns = patterns('',
     (r'^api/', include(simple_resource.urls)),
 )
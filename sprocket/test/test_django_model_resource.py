@@ -1,18 +1,39 @@
 from datetime import datetime
+import gzip
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import threading
 import time
 from unittest import TestCase
 
 from django.conf import settings
 from django.conf.urls.defaults import patterns, include
+from django.core.cache import cache
 from django.db.models import Model, CharField, DateTimeField as DjDateTimeField, EmailField, IntegerField
 from django.db import connections, transaction
+from django.http import HttpRequest, HttpResponse
 from django.test.client import Client
 from django.utils import simplejson
 
 from mocking_bird.mocking import MockingBirdMixin
 
+from .. import deferred
+from .. import formats
+from .. import idempotency
+from ..deferred import deferrable, SynchronousExecutor, ThreadPoolExecutor
+from ..chunked_query import ChunkedInQuery
 from ..django_model_resource import DjangoModelResource
-from ..base_resource import ResourceMeta
+from ..change_feed import CacheChangeLog, ChangeFeedMixin
+from ..export import ExportMixin
+from ..fragment_cache import FragmentCacheMixin
+from ..idempotency import MemoryStore
+from ..mixins import BaseMixin, batch_capable
+from ..query_counter import QueryCounter
+from ..warmup import warm_up
+from ..window_count import get_mariadb_version, supports_window_count
+from ..base_resource import ResourceMeta, EndPoint, POST, request_context
 
 
 class SimpleCase(TestCase, MockingBirdMixin):
@@ -197,6 +218,534 @@ class SimpleCase(TestCase, MockingBirdMixin):
         r = c.get('/api/my-resource/%s/' % obj_data['id'])
         self.assertEquals(404, r.status_code)
 
+    def test_values_list_fast_path(self):
+        self.assertEquals(
+            ['id', 'label', 'created', 'updated', 'published_at', 'email', 'age'],
+            my_resource._values_columns)
+
+        my_resource.create(label='MyLabelz', email='amail@maila.com', age=17,
+                           published_at=datetime(2011, 7, 1, 12, 30, 0), updated=datetime(2011, 7, 2))
+        data = my_resource.paged_list()
+        self.assertEquals(1, data['total_count'])
+        self.assertEquals(my_resource.obj_list_to_dicts(my_resource.list()), data['objects'])
+        self.assertEquals('2011-07-01 12:30:00', data['objects'][0]['published_at'])
+
+        # Resources that handle or serialize the objects themselves, or through a mixin, get models
+        self.assertEquals(None, adult_resource._values_columns)
+        self.assertEquals(False, adult_resource.paged_list()['objects'][0]['is_adult'])
+        self.assertEquals(None, label_only_resource._values_columns)
+        self.assertEquals([{'label': 'MyLabelz'}], label_only_resource.paged_list()['objects'])
+        self.assertEquals(None, fragment_resource._values_columns)
+
+    def test_deferred_handlers(self):
+        c = Client()
+        created = DeferredCreateMixin.created
+        created.clear()
+
+        r = c.post(
+            '/api/deferred-resource/',
+            data=simplejson.dumps({'label': 'Deferred', 'email': 'amail@maila.com', 'age': 17}),
+            content_type='application/json')
+        self.assertEquals(200, r.status_code)
+        self.assertTrue(created.wait(5))
+        self.assertEquals(simplejson.loads(r.content)['id'], DeferredCreateMixin.created_pk)
+        self.assertEquals('sprocket-deferred-0', DeferredCreateMixin.thread_name)
+        # The worker closed the connection the handler used before taking the next call
+        checked = threading.Event()
+        open_connections = []
+        def check():
+            open_connections.append(connections['default'].connection)
+            checked.set()
+        deferred_resource._meta.deferred_executor.submit(check)
+        self.assertTrue(checked.wait(5))
+        self.assertEquals([None], open_connections)
+
+    def test_identity_map(self):
+        obj = my_resource.create(label='Label', email='amail@maila.com', age=17)
+        request = HttpRequest()
+        request.method = 'PUT'
+        with request_context(request):
+            with QueryCounter() as counter:
+                first = my_resource.get(pk=obj.pk)
+                second = my_resource.get(pk=str(obj.pk))
+            self.assertEquals(1, counter.count)
+            # Every caller gets an object of its own
+            self.assertFalse(first is second)
+            first.label = 'Changed'
+            self.assertEquals('Label', my_resource.get(pk=obj.pk).label)
+
+            # An update is loaded again, through the resource's filters, which may now hide it
+            self.assertEquals(17, minors_resource.get(pk=obj.pk).age)
+            minors_resource.update(obj.pk, label='NewLabel', age=100)
+            self.assertEquals(None, minors_resource.get(pk=obj.pk))
+            self.assertEquals('NewLabel', my_resource.get(pk=obj.pk).label)
+
+            my_resource.delete(obj.pk)
+            self.assertEquals(None, my_resource.get(pk=obj.pk))
+
+    def test_aggregate(self):
+        c = Client()
+        for label, age in (('a', 17), ('b', 21), ('c', 21)):
+            my_resource.create(label=label, email='amail@maila.com', age=age)
+            time.sleep(0.002)
+
+        r = c.get('/api/my-resource/aggregate/?aggregate=count&aggregate=age__sum&age__gte=18')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals({'count': 2, 'age__sum': 42}, simplejson.loads(r.content)['aggregates'])
+
+        r = c.get('/api/my-resource/aggregate/?aggregate=count&aggregate=age__max&group_by=age')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals(
+            [{'age': 17, 'count': 1, 'age__max': 17}, {'age': 21, 'count': 2, 'age__max': 21}],
+            simplejson.loads(r.content)['groups'])
+
+        # label is not in the group_by whitelist, and not in filtering
+        r = c.get('/api/my-resource/aggregate/?aggregate=count&group_by=label')
+        self.assertEquals(400, r.status_code)
+        r = c.get('/api/my-resource/aggregate/?aggregate=label__max')
+        self.assertEquals(400, r.status_code)
+
+    def test_order_by(self):
+        c = Client()
+        for label, age in (('a', 21), ('b', 17), ('c', 21)):
+            my_resource.create(label=label, email='amail@maila.com', age=age)
+            time.sleep(0.002)
+
+        r = c.get('/api/my-resource/?order_by=-age&limit=2')
+        self.assertEquals(200, r.status_code)
+        # Ties on age are broken by the primary key
+        self.assertEquals(['a', 'c'], [obj['label'] for obj in simplejson.loads(r.content)['objects']])
+
+        r = c.get('/api/my-resource/?order_by=age,-label')
+        self.assertEquals(['b', 'c', 'a'], [obj['label'] for obj in simplejson.loads(r.content)['objects']])
+
+        self.assertEquals(['c', 'b', 'a'], [obj.label for obj in my_resource.list(order_by='-id')])
+        self.assertEquals(['-id'], my_resource._get_ordering('-id'))
+
+        r = c.get('/api/my-resource/?order_by=email')
+        self.assertEquals(400, r.status_code)
+
+        self.assertEquals(
+            [('ordering_whitelist', 'age'), ('ordering_whitelist', 'label'), ('group_by_whitelist', 'age')],
+            my_resource._find_unindexed_fields())
+
+    def test_batch_serialization(self):
+        resource = batch_resource
+        for label in ('a', 'b', 'c'):
+            resource.create(label=label, email='amail@maila.com', age=20)
+            # Primary keys are millisecond timestamps
+            time.sleep(0.002)
+        mixin = resource.mixins_by_name['LabelLengthMixin']
+        self.assertEquals(None, resource._values_columns)
+        self.assertEquals([resource.on_obj_to_dict], list(resource._unbatched_obj_to_dict_handlers))
+
+        data = resource.paged_list()
+        self.assertEquals([1, 1, 1], [obj['label_length'] for obj in data['objects']])
+        self.assertEquals([True, True, True], [obj['is_adult'] for obj in data['objects']])
+        self.assertEquals([3], mixin.batches)
+
+        # A single object still goes through the per-object handler
+        self.assertEquals(1, resource.obj_to_dict(resource.list()[0])['label_length'])
+        self.assertEquals([3, 1], mixin.batches)
+
+        # A resource's own obj_to_dict is used for lists too, in every format
+        resource = batch_override_resource
+        mixin = resource.mixins_by_name['LabelLengthMixin']
+        objects = resource.paged_list()['objects']
+        self.assertEquals(['A', 'B', 'C'], [obj['upper'] for obj in objects])
+        self.assertEquals([1, 1, 1], [obj['label_length'] for obj in objects])
+        # The list is still done in one batch, not one per object as well
+        self.assertEquals([3], mixin.batches)
+        with request_context(None) as current:
+            current.response_format = formats.COLUMNAR
+            columns = resource.obj_list_to_data(resource.list())
+        self.assertEquals(['A', 'B', 'C'], [row[columns.fields.index('upper')] for row in columns.rows])
+        self.assertEquals([3, 3], mixin.batches)
+        self.assertEquals(1, resource.obj_to_dict(resource.list()[0])['label_length'])
+        self.assertEquals([3, 3, 1], mixin.batches)
+
+    def test_export(self):
+        c = Client()
+        resource = export_resource
+        directory = ExportModelResource.directory
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        try:
+            for label, age in ((u'caf\xe9', 21), ('b', 17), ('c', 21), ('d', 21)):
+                resource.create(label=label, email='amail@maila.com', age=age)
+                # Primary keys are millisecond timestamps
+                time.sleep(0.002)
+            expired = os.path.join(directory, 'expired.json')
+            open(expired, 'w').close()
+            os.utime(expired, (time.time() - 2 * 24 * 60 * 60,) * 2)
+
+            r = c.post('/api/export-resource/exports/', data=simplejson.dumps({'format': 'csv', 'age': 21}),
+                       content_type='application/json')
+            self.assertEquals(202, r.status_code)
+            job = simplejson.loads(r.content)
+            self.assertEquals('csv', job['format'])
+
+            # The synchronous executor has already run the job, and cleaned up old ones after it
+            r = c.get('/api/export-resource/exports/%s/' % job['id'])
+            self.assertEquals('done', simplejson.loads(r.content)['status'])
+            self.assertEquals(3, simplejson.loads(r.content)['rows'])
+            self.assertFalse(os.path.exists(expired))
+
+            # The file is already gzipped, so it is not compressed again
+            r = c.get('/api/export-resource/exports/%s/download/' % job['id'], HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEquals(200, r.status_code)
+            self.assertEquals('application/gzip', r['Content-Type'])
+            self.assertFalse(r.has_header('Content-Encoding'))
+            self.assertFalse(r.has_header('Vary'))
+            lines = gzip.GzipFile(fileobj=StringIO(r.content)).read().splitlines()
+            self.assertEquals('id,label,created,updated,published_at,email,age', lines[0])
+            self.assertEquals(['caf\xc3\xa9', 'c', 'd'], [line.split(',')[1] for line in lines[1:]])
+
+            r = c.post('/api/export-resource/exports/', data=simplejson.dumps({'format': 'ndjson'}),
+                       content_type='application/json')
+            r = c.get('/api/export-resource/exports/%s/download/' % simplejson.loads(r.content)['id'])
+            lines = gzip.GzipFile(fileobj=StringIO(r.content)).read().splitlines()
+            self.assertEquals([u'caf\xe9', 'b', 'c', 'd'], [simplejson.loads(line)['label'] for line in lines])
+
+            # A file purged after the job's status was read has expired
+            os.remove(os.path.join(directory, job['id'] + '.csv.gz'))
+            r = c.get('/api/export-resource/exports/%s/download/' % job['id'])
+            self.assertEquals(410, r.status_code)
+
+            r = c.post('/api/export-resource/exports/', data=simplejson.dumps({'format': 'xml'}),
+                       content_type='application/json')
+            self.assertEquals(400, r.status_code)
+            r = c.post('/api/export-resource/exports/', data=simplejson.dumps({'email': 'x'}),
+                       content_type='application/json')
+            self.assertEquals(400, r.status_code)
+            r = c.get('/api/export-resource/exports/%s/' % ('0' * 32))
+            self.assertEquals(404, r.status_code)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_change_feed(self):
+        c = Client()
+        resource = feed_resource
+        r = c.get('/api/feed-resource/changes/')
+        data = simplejson.loads(r.content)
+        self.assertEquals([], data['changes'])
+
+        a = resource.create(label='a', email='amail@maila.com', age=20)
+        # Primary keys are millisecond timestamps
+        time.sleep(0.002)
+        b = resource.create(label='b', email='amail@maila.com', age=20)
+        resource.update(a.pk, label='aa')
+        resource.update(b.pk, label='bb')
+        resource.delete(a.pk)
+        r = c.get('/api/feed-resource/changes/?since=%s' % data['next'])
+        data = simplejson.loads(r.content)
+        self.assertEquals([{'id': b.pk, 'op': 'create'}, {'id': a.pk, 'op': 'delete'}], data['changes'])
+        self.assertFalse(data['reset'])
+
+        # A long poll returns as soon as something changes
+        def update_later():
+            time.sleep(0.05)
+            resource.update(b.pk, label='bbb')
+        thread = threading.Thread(target=update_later)
+        thread.start()
+        started = time.time()
+        r = c.get('/api/feed-resource/changes/?since=%s&wait=5' % data['next'])
+        thread.join()
+        self.assertTrue(time.time() - started < 4)
+        self.assertEquals([{'id': b.pk, 'op': 'update'}], simplejson.loads(r.content)['changes'])
+
+        r = c.get('/api/feed-resource/changes/?since=restarted:3')
+        self.assertTrue(simplejson.loads(r.content)['reset'])
+        r = c.get('/api/feed-resource/changes/?since=nonsense')
+        self.assertEquals(400, r.status_code)
+
+        # In a shared cache, a change that another process counted but has not stored yet holds
+        # back the ones after it, and only resets clients once it has been missing a while
+        log = CacheChangeLog(cache, 'feed-test-%s' % time.time(), gap_grace=60)
+        log.append(1, 'create')
+        cache.incr(log._seq_key(log.epoch))
+        log.append(3, 'create')
+        self.assertEquals([(1, 1, 'create')], log.read(0, 10))
+        self.assertEquals([], log.read(1, 10))
+        # A long poll waits for the missing change rather than returning at once
+        log.poll_interval = 0.01
+        started = time.time()
+        log.wait(1, 0.05)
+        self.assertTrue(time.time() - started >= 0.05)
+        cache.set(log._entry_key(log.epoch, 2), (2, 'update'))
+        started = time.time()
+        log.wait(1, 5)
+        self.assertTrue(time.time() - started < 1)
+        cache.delete(log._entry_key(log.epoch, 2))
+        time.sleep(0.01)
+        log.gap_grace = 0.005
+        self.assertEquals(None, log.read(1, 10))
+
+    def test_idempotency_key(self):
+        c = Client()
+        resource = idempotent_resource
+        store = resource._meta.idempotency_store = MemoryStore()
+        calls = IdempotentModelResource.calls
+        del calls[:]
+        gate = IdempotentModelResource.gate
+        gate.set()
+
+        body = simplejson.dumps({'label': 'a', 'email': 'amail@maila.com', 'age': 20})
+        r = c.post('/api/idempotent-resource/', data=body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEquals(200, r.status_code)
+        self.assertFalse(r.has_header('Idempotent-Replayed'))
+        created = simplejson.loads(r.content)
+
+        # The retry gets the stored response instead of creating another object
+        r = c.post('/api/idempotent-resource/', data=body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals('true', r['Idempotent-Replayed'])
+        self.assertEquals(created, simplejson.loads(r.content))
+        self.assertEquals(1, len(resource.list()))
+
+        r = c.post('/api/idempotent-resource/', data=body.replace('20', '21'), content_type='application/json',
+                   HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEquals(422, r.status_code)
+
+        # Without the header, writes run every time
+        c.post('/api/idempotent-resource/', data=body, content_type='application/json')
+        self.assertEquals(2, len(resource.list()))
+
+        # Multipart bodies are told apart by their form, which authentication already read
+        form = {'label': 'a', 'file': StringIO('abc')}
+        form['file'].name = 'a.txt'
+        r = c.post('/api/idempotent-resource/upload/', data=form, HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEquals({'label': 'a', 'size': 3}, simplejson.loads(r.content))
+        form['file'].seek(0)
+        r = c.post('/api/idempotent-resource/upload/', data=form, HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEquals('true', r['Idempotent-Replayed'])
+        r = c.post('/api/idempotent-resource/upload/', data={'label': 'b'}, HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEquals(422, r.status_code)
+        self.assertEquals(['upload'], calls)
+
+        # A duplicate of a request that is still running waits for it, then gives up
+        gate.clear()
+        responses = []
+        first = threading.Thread(target=lambda: responses.append(
+            c.post('/api/idempotent-resource/upload/', data={'label': 'c'}, HTTP_IDEMPOTENCY_KEY='k3')))
+        first.start()
+        try:
+            deadline = time.time() + 5
+            while len(calls) < 2 and time.time() < deadline:
+                time.sleep(0.001)
+            r = c.post('/api/idempotent-resource/upload/', data={'label': 'c'}, HTTP_IDEMPOTENCY_KEY='k3')
+            self.assertEquals(409, r.status_code)
+        finally:
+            gate.set()
+            first.join()
+        self.assertEquals(200, responses[0].status_code)
+        self.assertEquals(['upload', 'upload'], calls)
+
+        # Responses that set cookies are stored without them, and the write runs once
+        del calls[:]
+        r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k4')
+        self.assertEquals('yes', r.cookies['visited'].value)
+        # Keys belong to the client, not to its cookies, which a retry may not have
+        c.cookies.clear()
+        r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k4', HTTP_COOKIE='other=1')
+        self.assertEquals('true', r['Idempotent-Replayed'])
+        self.assertEquals({'n': 1}, simplejson.loads(r.content))
+        self.assertFalse('visited' in r.cookies)
+        r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k4', HTTP_AUTHORIZATION='Token t2')
+        self.assertFalse(r.has_header('Idempotent-Replayed'))
+        del calls[:]
+
+        # Streamed responses cannot be stored, but their write still does not run again
+        r = c.post('/api/idempotent-resource/stream/', HTTP_IDEMPOTENCY_KEY='k5')
+        self.assertEquals({'n': 1}, simplejson.loads(r.content))
+        r = c.post('/api/idempotent-resource/stream/', HTTP_IDEMPOTENCY_KEY='k5')
+        self.assertEquals(409, r.status_code)
+        self.assertEquals(['stream'], calls)
+
+        # The response is stored once the request's deferred calls run, after its transaction
+        # commits, and a request whose transaction rolls back leaves the key free for a retry
+        store = resource._meta.idempotency_store = MemoryStore()
+        statuses = lambda: [entry[1][0] for entry in store._entries.values()]
+        deferred.start_collecting()
+        try:
+            c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k7')
+            self.assertEquals([idempotency.PENDING], statuses())
+        finally:
+            deferred.discard()
+        self.assertEquals([], statuses())
+        deferred.start_collecting()
+        try:
+            r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k7')
+            self.assertFalse(r.has_header('Idempotent-Replayed'))
+            self.assertEquals([idempotency.PENDING], statuses())
+        finally:
+            deferred.flush()
+        self.assertEquals([idempotency.COMPLETED], statuses())
+        r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k7')
+        self.assertEquals('true', r['Idempotent-Replayed'])
+        self.assertEquals(['stream', 'cookie', 'cookie'], calls)
+
+        # A store that neither keeps nor returns entries fails the request instead of looping
+        class BrokenStore(MemoryStore):
+            def get(self, key):
+                return None
+            def add(self, key, value, timeout):
+                return False
+        resource._meta.idempotency_store = BrokenStore()
+        r = c.post('/api/idempotent-resource/cookie/', HTTP_IDEMPOTENCY_KEY='k6')
+        self.assertEquals(503, r.status_code)
+        self.assertEquals(['stream', 'cookie', 'cookie'], calls)
+
+    def test_count_in_page_query(self):
+        self.assertEquals((10, 3), get_mariadb_version('5.5.5-10.3.22-MariaDB-log'))
+        self.assertEquals((10, 6), get_mariadb_version('10.6.4-MariaDB'))
+        self.assertEquals(None, get_mariadb_version('8.0.28'))
+        if not supports_window_count('default'):
+            self.skipTest("The test database has no window functions")
+        for label, age in (('a', 21), ('b', 17), ('c', 21)):
+            my_resource.create(label=label, email='amail@maila.com', age=age)
+            time.sleep(0.002)
+
+        self.assertEquals(None, counted_fragment_resource._values_columns)
+        for resource in (counted_resource, counted_fragment_resource):
+            with QueryCounter() as counter:
+                data = resource.paged_list(limit=2)
+            self.assertEquals(1, counter.count)
+            self.assertEquals(3, data['total_count'])
+            objects = simplejson.loads(formats.encode(data, formats.JSON))['objects']
+            self.assertEquals(['a', 'b'], [obj['label'] for obj in objects])
+            self.assertFalse('sprocket_total_count' in objects[0])
+
+            self.assertEquals(0, resource.paged_list(age=30)['total_count'])
+            # Past the last page the count needs a query of its own
+            with QueryCounter() as counter:
+                self.assertEquals(3, resource.paged_list(offset=5)['total_count'])
+            self.assertEquals(2, counter.count)
+
+    def test_chunked_in_filter(self):
+        c = Client()
+        pks = []
+        for label, age in (('a', 30), ('b', 17), ('c', 21), ('d', 21), ('e', 40)):
+            pks.append(my_resource.create(label=label, email='amail@maila.com', age=age).pk)
+            time.sleep(0.002)
+        ids = pks + range(1, 1200)
+
+        my_resource._meta.in_filter_chunk_size = 2
+        try:
+            objs = my_resource.list(id__in=pks, order_by='-age')
+            self.assertEquals(['e', 'a', 'c', 'd', 'b'], [obj.label for obj in objs])
+
+            items, total = my_resource._list_and_count(id__in=pks + pks, age__gte=20, order_by='age', offset=1, limit=2)
+            self.assertEquals(['d', 'a'], [obj.label for obj in items])
+            self.assertEquals(4, total)
+
+            # Text is sorted by the database's collation, so those orderings are not chunked
+            with QueryCounter() as counter:
+                objs = my_resource.list(id__in=pks, order_by='-label')
+            self.assertEquals(['e', 'd', 'c', 'b', 'a'], [obj.label for obj in objs])
+            self.assertEquals(1, counter.count)
+        finally:
+            my_resource._meta.in_filter_chunk_size = None
+
+        # Rows deleted after their pks were read are left out of the page
+        query = ChunkedInQuery(FakeModel.objects.all(), 'pk__in', pks, 2)
+        self.assertEquals(pks[:2], [obj.pk for obj in query._load(pks[:1] + [1] + pks[1:2])])
+
+        # Too many ids for the query string, and more than sqlite takes as parameters of one query
+        r = c.post(
+            '/api/my-resource/query/',
+            data=simplejson.dumps({'id__in': ids, 'order_by': '-id', 'offset': 1, 'limit': 3}),
+            content_type='application/json')
+        self.assertEquals(200, r.status_code)
+        data = simplejson.loads(r.content)
+        self.assertEquals(5, data['total_count'])
+        self.assertEquals(['d', 'c', 'b'], [obj['label'] for obj in data['objects']])
+
+    def test_fragment_cache(self):
+        cache.clear()
+        c = Client()
+        resource = fragment_resource
+        serialized = FragmentModelResource.serialized
+        del serialized[:]
+        mixin = resource.mixins_by_name['FragmentCacheMixin']
+        for label in ('a', 'b'):
+            resource.create(label=label, email='amail@maila.com', age=20, updated=datetime(2011, 7, 2))
+            # Primary keys are millisecond timestamps
+            time.sleep(0.002)
+
+        r = c.get('/api/fragment-resource/')
+        self.assertEquals(200, r.status_code)
+        data = simplejson.loads(r.content)
+        self.assertEquals(2, data['total_count'])
+        self.assertEquals(['a', 'b'], [obj['label'] for obj in data['objects']])
+        self.assertEquals([True, True], [obj['is_adult'] for obj in data['objects']])
+        self.assertEquals(2, len(serialized))
+
+        # Served from the cache, with the same output as serializing the objects
+        r = c.get('/api/fragment-resource/')
+        self.assertEquals(data, simplejson.loads(r.content))
+        self.assertEquals(2, len(serialized))
+        self.assertEquals(2, mixin.cache.hits)
+
+        # Saving drops the fragment even though the version field did not change
+        resource.update(data['objects'][0]['id'], label='c')
+        r = c.get('/api/fragment-resource/')
+        self.assertEquals(['c', 'b'], [obj['label'] for obj in simplejson.loads(r.content)['objects']])
+        self.assertEquals(3, len(serialized))
+
+        resource.delete(data['objects'][1]['id'])
+        self.assertEquals(1, len(mixin.cache))
+
+    def test_warm_up(self):
+        self.assertTrue(my_resource in warm_up(freeze=False))
+        self.assertTrue(hasattr(FakeModel._meta, '_name_map'))
+        self.assertEquals([my_resource], warm_up([my_resource]))
+        # Connections were closed before the fork, and reopen on the next query
+        self.assertEquals(0, len(my_resource.list()))
+
+    def test_read_replica_routing(self):
+        cache.clear()
+        resource = replica_resource
+        self.assertEquals(None, resource._get_read_db_alias())
+
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        with request_context(request):
+            self.assertEquals('replica', resource._get_read_db_alias())
+
+            # Reads made while handling a write go to the primary
+            request.method = 'PUT'
+            self.assertEquals(None, resource._get_read_db_alias())
+
+            # After a write, the client's reads stick to the primary
+            resource._mark_client_wrote()
+            request.method = 'GET'
+            self.assertEquals(None, resource._get_read_db_alias())
+
+            request.META['REMOTE_ADDR'] = '10.0.0.2'
+            self.assertEquals('replica', resource._get_read_db_alias())
+
+    def test_query_budget(self):
+        c = Client()
+        my_resource.create(label='Label', email='amail@maila.com', age=17)
+
+        # A paged list is one query for the page and one for the count
+        r = c.get('/api/budget-resource/')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals('2', r['X-Sprocket-Query-Count'])
+        self.assertEquals('2', r['X-Sprocket-Query-Budget'])
+
+        budget_resource._meta.query_budget = 1
+        try:
+            r = c.get('/api/budget-resource/')
+        finally:
+            budget_resource._meta.query_budget = 2
+        self.assertEquals(500, r.status_code)
+        data = simplejson.loads(r.content)
+        self.assertEquals(2, data['query_count'])
+        self.assertEquals(1, data['query_budget'])
+
     url_conf = 'sprocket.test.test_django_model_resource'
 
     def setUp(self):
@@ -233,14 +782,229 @@ class MyModelResource(DjangoModelResource):
         resource_name = 'my-resource'
         model_class = FakeModel
         filtering = {
+            'id': ['exact', 'in'],
             'email': ['exact'],
             'age': ['exact', 'range', 'gt', 'gte', 'lt', 'lte', 'in'],
             }
+        allow_aggregation = True
+        group_by_whitelist = ['age']
+        ordering_whitelist = ['id', 'age', 'label']
+        allow_query_by_post = True
 
     def on_authenticate(self, request):
         pass
 
 
+class ReplicaModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'replica-resource'
+        model_class = FakeModel
+        read_replica_alias = 'replica'
+
+
+class BudgetModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'budget-resource'
+        model_class = FakeModel
+        query_instrumentation = ('headers', 'raise')
+        query_budget = 2
+
+    def on_authenticate(self, request):
+        pass
+
+
+class DeferredCreateMixin(BaseMixin):
+    created = threading.Event()
+    created_pk = None
+    thread_name = None
+
+    @deferrable
+    def on_post_create(self, obj):
+        DeferredCreateMixin.created_pk = FakeModel.objects.get(pk=obj.pk).pk
+        DeferredCreateMixin.thread_name = threading.current_thread().name
+        DeferredCreateMixin.created.set()
+
+
+class DeferredModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'deferred-resource'
+        model_class = FakeModel
+        deferred_executor = ThreadPoolExecutor(max_workers=1)
+
+    def get_mixins(self):
+        return [DeferredCreateMixin(self)]
+
+    def on_authenticate(self, request):
+        pass
+
+
+class LabelLengthMixin(BaseMixin):
+    def __init__(self, api_resource):
+        super(LabelLengthMixin, self).__init__(api_resource)
+        self.batches = []
+
+    @batch_capable
+    def on_obj_to_dict(self, obj, data):
+        self.on_obj_list_to_dicts([obj], [data])
+
+    def on_obj_list_to_dicts(self, objects, dicts):
+        self.batches.append(len(objects))
+        for obj, data in zip(objects, dicts):
+            data['label_length'] = len(obj.label)
+
+
+class MinorsModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'minors-resource'
+        model_class = FakeModel
+
+    def on_adjust_orm_filters(self, q_filters, filters):
+        filters['age__lt'] = 100
+
+
+class AdultModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'adult-resource'
+        model_class = FakeModel
+
+    def on_obj_to_dict(self, obj, data):
+        data['is_adult'] = obj.age >= 18
+
+
+class LabelOnlyModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'label-only-resource'
+        model_class = FakeModel
+
+    def obj_to_dict(self, obj):
+        return {'label': obj.label}
+
+
+class BatchModelResource(AdultModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'batch-resource'
+        model_class = FakeModel
+
+    def get_mixins(self):
+        return [LabelLengthMixin(self)]
+
+
+class BatchOverrideModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'batch-override-resource'
+        model_class = FakeModel
+
+    def get_mixins(self):
+        return [LabelLengthMixin(self)]
+
+    def obj_to_dict(self, obj):
+        data = super(BatchOverrideModelResource, self).obj_to_dict(obj)
+        data['upper'] = obj.label.upper()
+        return data
+
+
+class FragmentModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'fragment-resource'
+        model_class = FakeModel
+
+    serialized = []
+
+    def get_mixins(self):
+        return [FragmentCacheMixin(self, version_field='updated', max_entries=10, backend=cache)]
+
+    def on_authenticate(self, request):
+        pass
+
+    def on_obj_to_dict(self, obj, data):
+        self.serialized.append(obj.pk)
+        data['is_adult'] = obj.age >= 18
+
+
+class CountedModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'counted-resource'
+        model_class = FakeModel
+        filtering = {'age': ['exact']}
+        count_in_page_query = True
+
+
+class CountedFragmentModelResource(CountedModelResource):
+    class Meta(CountedModelResource.Meta):
+        resource_name = 'counted-fragment-resource'
+
+    def get_mixins(self):
+        return [FragmentCacheMixin(self)]
+
+
+class ExportModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'export-resource'
+        model_class = FakeModel
+        filtering = {'age': ['exact']}
+        compress_responses = True
+        compression_min_size = 1
+
+    directory = os.path.join(tempfile.gettempdir(), 'sprocket-test-exports')
+
+    def get_mixins(self):
+        return [ExportMixin(self, batch_size=2, directory=self.directory, executor=SynchronousExecutor())]
+
+    def on_authenticate(self, request):
+        pass
+
+
+class FeedModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'feed-resource'
+        model_class = FakeModel
+        deferred_executor = SynchronousExecutor()
+
+    def get_mixins(self):
+        return [ChangeFeedMixin(self)]
+
+    def on_authenticate(self, request):
+        pass
+
+
+class IdempotentModelResource(DjangoModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'idempotent-resource'
+        model_class = FakeModel
+        idempotency_keys = True
+        idempotency_store = MemoryStore()
+        idempotency_wait = 0.1
+
+    gate = threading.Event()
+    calls = []
+
+    def get_endpoints(self):
+        return [
+            EndPoint(r"^(?P<resource_name>%s)/upload/$" % self._meta.resource_name, POST('upload')),
+            EndPoint(r"^(?P<resource_name>%s)/cookie/$" % self._meta.resource_name, POST('cookie')),
+            EndPoint(r"^(?P<resource_name>%s)/stream/$" % self._meta.resource_name, POST('stream')),
+            ] + super(IdempotentModelResource, self).get_endpoints()
+
+    def on_authenticate(self, request):
+        # Reading the form of a multipart request, as authentication by form fields does
+        request.POST
+
+    def upload(self):
+        self.calls.append('upload')
+        self.gate.wait(5)
+        files = self.current_request.FILES
+        return {'label': self.current_request.POST['label'], 'size': files['file'].size if 'file' in files else None}
+
+    def cookie(self):
+        self.calls.append('cookie')
+        self.set_response_cookie('visited', 'yes')
+        return {'n': len(self.calls)}
+
+    def stream(self):
+        self.calls.append('stream')
+        return HttpResponse(iter(['{"n": ', str(len(self.calls)), '}']))
+
+
 def _create_table():
     sql1 = """DROP TABLE IF EXISTS sprocket_test_fake_model"""
     sql2 = """
@@ -261,7 +1025,27 @@ def _create_table():
     return cursor.rowcount
 
 my_resource = MyModelResource()
+budget_resource = BudgetModelResource()
+replica_resource = ReplicaModelResource()
+deferred_resource = DeferredModelResource()
+minors_resource = MinorsModelResource()
+adult_resource = AdultModelResource()
+label_only_resource = LabelOnlyModelResource()
+batch_resource = BatchModelResource()
+batch_override_resource = BatchOverrideModelResource()
+fragment_resource = FragmentModelResource()
+counted_resource = CountedModelResource()
+counted_fragment_resource = CountedFragmentModelResource()
+export_resource = ExportModelResource()
+feed_resource = FeedModelResource()
+idempotent_resource = IdempotentModelResource()
 
 urlpatterns = patterns('',
     (r'^api/', include(my_resource.urls)),
+    (r'^api/', include(budget_resource.urls)),
+    (r'^api/', include(deferred_resource.urls)),
+    (r'^api/', include(fragment_resource.urls)),
+    (r'^api/', include(export_resource.urls)),
+    (r'^api/', include(feed_resource.urls)),
+    (r'^api/', include(idempotent_resource.urls)),
 )
@@ -0,0 +1,174 @@
+from unittest import TestCase
+
+from django.conf import settings
+from django.conf.urls.defaults import patterns, include
+from django.test.client import Client
+from django.utils import simplejson
+
+from mocking_bird.mocking import MockingBirdMixin
+
+from .. import loadtest
+from ..base_resource import ResourceMeta, UserError
+from ..fields import ApiField, IntegerField
+from ..in_memory_resource import InMemoryModelResource, InMemoryStore
+
+
+class SimpleCase(TestCase, MockingBirdMixin):
+    def test_direct_crud(self):
+        first = setting_resource.create(key='timeout', group='http', priority=10)
+        second = setting_resource.create(key='retries', group='http', priority=20)
+        third = setting_resource.create(key='theme', group='ui', priority=None)
+        self.assertEquals(1, first.pk)
+        self.assertEquals(3, third.pk)
+
+        self.assertEquals('timeout', setting_resource.get(pk='1').key)
+        self.assertEquals('retries', setting_resource.get(key='retries').key)
+
+        objs = setting_resource.list(group='http')
+        self.assertEquals([1, 2], [obj.pk for obj in objs])
+
+        objs = setting_resource.list(group__in=['http', 'ui'])
+        self.assertEquals(3, len(objs))
+
+        objs = setting_resource.list(group__ne='http')
+        self.assertEquals([3], [obj.pk for obj in objs])
+
+        objs = setting_resource.list(priority__gt='10')
+        self.assertEquals([2], [obj.pk for obj in objs])
+
+        objs = setting_resource.list(priority__lte=20)
+        self.assertEquals([1, 2], [obj.pk for obj in objs])
+
+        objs = setting_resource.list(priority__range=[15, 25], group='http')
+        self.assertEquals([2], [obj.pk for obj in objs])
+
+        # Updates move the object in the indexes, without changing the object readers hold
+        updated = setting_resource.update(first.pk, priority=30, group='ui')
+        self.assertEquals(10, first.priority)
+        self.assertEquals(30, updated.priority)
+        self.assertEquals([2], [obj.pk for obj in setting_resource.list(group='http')])
+        self.assertEquals([1, 2], [obj.pk for obj in setting_resource.list(priority__gte=20)])
+        self.assertEquals([1], [obj.pk for obj in setting_resource.list(priority__gt=25)])
+
+        # The store keeps copies, so changing objects that were created or read leaves it alone
+        first.priority = 1
+        setting_resource.get(pk=first.pk).priority = 2
+        setting_resource.list(group='ui')[0].group = 'http'
+        self.assertEquals(30, setting_resource.get(pk=first.pk).priority)
+        self.assertEquals([2], [obj.pk for obj in setting_resource.list(group='http')])
+        self.assertEquals([1], [obj.pk for obj in setting_resource.list(priority__gt=25)])
+
+        setting_resource.delete(second.pk)
+        self.assertEquals(None, setting_resource.get(pk=second.pk))
+        self.assertEquals([], setting_resource.list(group='http'))
+        self.assertEquals([1], [obj.pk for obj in setting_resource.list(priority__gte=20)])
+
+        self.assertRaises(UserError, setting_resource.list, priority__gt='high')
+        self.assertRaises(UserError, setting_resource.list, key__gt='a')
+        self.assertRaises(UserError, setting_resource.list, priority__range=[5])
+
+    def test_unindexed_filters(self):
+        store = InMemoryStore(hash_indexes=['group'])
+        for pk, key, group in [(1, 'a', 'x'), (2, 'b', 'x'), (3, 'c', 'y')]:
+            store.put(Setting(pk=pk, key=key, group=group, priority=pk))
+        self.assertEquals([2], [obj.pk for obj in store.query([('group', 'exact', 'x'), ('priority', 'gt', 1)])])
+        self.assertEquals([1, 3], [obj.pk for obj in store.query([('pk', 'ne', 2)])])
+        self.assertEquals(4, store.next_pk())
+
+    def test_http_crud(self):
+        c = Client()
+        r = c.post(
+            '/api/setting/',
+            data=simplejson.dumps({'key': 'timeout', 'group': 'http', 'priority': 10}),
+            content_type='application/json')
+        self.assertEquals(200, r.status_code)
+        pk = simplejson.loads(r.content)['pk']
+
+        r = c.put(
+            '/api/setting/%s/' % pk,
+            data=simplejson.dumps({'priority': 5}),
+            content_type='application/json')
+        self.assertEquals(200, r.status_code)
+
+        r = c.get('/api/setting/?priority__lt=6&group=http')
+        self.assertEquals(200, r.status_code)
+        data = simplejson.loads(r.content)
+        self.assertEquals(1, data['total_count'])
+        self.assertEquals(5, data['objects'][0]['priority'])
+
+        r = c.get('/api/setting/?priority__range=5')
+        self.assertEquals(400, r.status_code)
+
+        r = c.delete('/api/setting/%s/' % pk)
+        self.assertEquals(200, r.status_code)
+        r = c.get('/api/setting/%s/' % pk)
+        self.assertEquals(404, r.status_code)
+
+    def test_load_test(self):
+        target = loadtest.Target(setting_resource, 'api/', loadtest.DEFAULT_OPERATIONS, None, None)
+        self.assertEquals(
+            ['GET setting get', 'GET setting paged_list', 'POST setting create', 'PUT setting update'],
+            sorted([operation.label for operation in target.operations]))
+
+        report = loadtest.LoadTest(concurrency=3, requests_per_worker=20, targets=[target], seed=1).run()
+        self.assertEquals(60, report.count)
+        self.assertTrue(len(setting_resource.store) > 0)
+        for label, stats in report.endpoints.items():
+            self.assertEquals(0, stats.errors, label)
+            self.assertEquals(stats.count, sum([count for bound, count in stats.histogram()]))
+        self.assertTrue('POST setting create' in report.format())
+
+        stats = loadtest.EndpointStats('GET setting get')
+        for seconds in range(1, 101):
+            stats.add(seconds / 1000.0, 200)
+        self.assertEquals(0.05, stats.percentile(50))
+        self.assertEquals(0.099, stats.percentile(99))
+
+    url_conf = 'sprocket.test.test_in_memory_resource'
+
+    def setUp(self):
+        super(SimpleCase, self).setUp()
+        self.org_urls = settings.ROOT_URLCONF
+        settings.ROOT_URLCONF = self.url_conf
+        setting_resource.store = setting_resource.get_store()
+
+    def tearDown(self):
+        super(SimpleCase, self).tearDown()
+        settings.ROOT_URLCONF = self.org_urls
+
+
+class Setting(object):
+    pk = None
+    key = None
+    group = None
+    priority = None
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SettingResource(InMemoryModelResource):
+    class Meta(ResourceMeta):
+        resource_name = 'setting'
+        model_class = Setting
+        filtering = {
+            'key': ['exact'],
+            'group': ['exact', 'in', 'ne'],
+            'priority': ['gt', 'gte', 'lt', 'lte', 'range'],
+            }
+
+    def on_init_fields(self, fields):
+        fields.append(IntegerField('pk'))
+        fields.append(ApiField('key'))
+        fields.append(ApiField('group'))
+        fields.append(IntegerField('priority'))
+
+    def on_authenticate(self, request):
+        pass
+
+
+setting_resource = SettingResource()
+
+urlpatterns = patterns('',
+    (r'^api/', include(setting_resource.urls)),
+)
@@ -16,3 +16,16 @@ def magic_enum_meta_cls(typ, *args, **kwargs):
 class MagicEnum(object):
     __metaclass__ = magic_enum_meta_cls
 
+
+def class_attributes(cls):
+    '''
+    Returns the attributes defined on a class and its bases, the way the class would resolve them.
+    Unlike dir() plus getattr(), descriptors such as properties are returned as-is instead of
+    being evaluated.
+    '''
+    attrs = {}
+    for klass in reversed(cls.__mro__):
+        if klass is object:
+            continue
+        attrs.update(klass.__dict__)
+    return attrs
@@ -0,0 +1,64 @@
+'''
+Getting a process ready to serve requests before a pre-fork server (gunicorn with --preload,
+uWSGI without lazy-apps) starts its workers. Call warm_up() from the code that loads the WSGI
+application, after the urlconf and resources are importable:
+
+    application = WSGIHandler()
+    warmup.warm_up(wsgi_handler=application)
+
+Everything that warm_up() loads is then shared by the workers, instead of every worker loading
+it again on its first requests, and the memory it takes stays shared as long as no worker
+writes to it.
+'''
+import gc
+
+from django.core import urlresolvers
+from django.db import connections
+from django.db.models.loading import get_models
+
+from . import base_resource
+
+
+def warm_up(resources=None, wsgi_handler=None, freeze=True):
+    '''
+    Loads what requests would otherwise load lazily: the urlconf and its reverse lookup tables,
+    metadata for every installed model, each resource's own warm_up(), and the middleware of
+    wsgi_handler if one is given. Then closes the database connections, which must not be shared
+    with the workers, and with freeze runs a full garbage collection.
+
+    resources defaults to every resource constructed so far. Returns the resources warmed up.
+    '''
+    if resources == None:
+        resources = list(base_resource._resources)
+
+    resolver = urlresolvers.get_resolver(None)
+    resolver.url_patterns
+    resolver.reverse_dict
+
+    for model in get_models():
+        model._meta.get_all_field_names()
+
+    for resource in resources:
+        resource.warm_up()
+
+    if wsgi_handler != None and wsgi_handler._request_middleware == None:
+        wsgi_handler.load_middleware()
+
+    for connection in connections.all():
+        connection.close()
+
+    if freeze:
+        freeze_heap()
+    return resources
+
+
+def freeze_heap():
+    '''
+    Collects garbage now, so that every object left is long-lived, and on Pythons that have
+    gc.freeze() moves them all to a generation the collector never looks at. Otherwise each
+    worker's first collections would touch the headers of every shared object and copy the
+    memory pages they are on.
+    '''
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
@@ -0,0 +1,83 @@
+'''
+Fetching a page of a queryset together with the total number of rows, in one query. A
+COUNT(*) OVER () column gives every row of the page the count of the whole result, before the
+limit and offset apply. Backends without window functions need a separate count() query.
+'''
+import re
+
+from django.db import connections
+
+TOTAL_COUNT_COLUMN = 'sprocket_total_count'
+TOTAL_COUNT_SQL = 'COUNT(*) OVER ()'
+
+
+_supports_window_count = {}
+
+_mariadb_version_re = re.compile(r'(\d+)\.(\d+)\.\d+-MariaDB', re.IGNORECASE)
+
+
+def supports_window_count(db_alias):
+    '''
+    Whether the database behind db_alias runs window functions: PostgreSQL and Oracle, SQLite
+    from 3.25, MySQL from 8.0 and MariaDB from 10.2. Worked out once per alias, since on MySQL
+    it takes asking the server.
+    '''
+    supported = _supports_window_count.get(db_alias)
+    if supported == None:
+        supported = _supports_window_count[db_alias] = _check_window_count(connections[db_alias])
+    return supported
+
+
+def _check_window_count(connection):
+    vendor = connection.vendor
+    if vendor in ('postgresql', 'oracle'):
+        return True
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    if vendor == 'mysql':
+        # Opens the connection, which get_server_info needs
+        version = connection.get_server_version()
+        mariadb_version = get_mariadb_version(connection.connection.get_server_info())
+        if mariadb_version != None:
+            return mariadb_version >= (10, 2)
+        return version >= (8, 0)
+    return False
+
+
+def get_mariadb_version(server_info):
+    '''
+    The (major, minor) version of a MariaDB server from its version string, or None for MySQL.
+    MariaDB 10 reports itself as 5.5.5-10.x.y-MariaDB to older clients, which would otherwise
+    parse it as 5.5.5.
+    '''
+    match = _mariadb_version_re.search(server_info)
+    if match == None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def with_total_count(queryset):
+    ''' Adds the total count column to every row the queryset returns '''
+    return queryset.extra(select={TOTAL_COUNT_COLUMN: TOTAL_COUNT_SQL})
+
+
+def pop_total_count(objects):
+    '''
+    Removes the total count from objects fetched with_total_count, and returns it, or None if
+    there are no objects to read it from.
+    '''
+    total = None
+    for obj in objects:
+        total = obj.__dict__.pop(TOTAL_COUNT_COLUMN)
+    return total
+
+
+def split_total_count(rows):
+    '''
+    Like pop_total_count, for values_list rows that end with the total count column. Returns the
+    rows without it, and the count.
+    '''
+    if not rows:
+        return [], None
+    return [row[:-1] for row in rows], rows[0][-1]